@@ -0,0 +1,57 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare event deduplication lookups of the old bounded deque with EventDeduplicator as the number of ids grows.
+
+    python benchmarks/bench_dedup.py
+"""
+
+import asyncio
+import os
+import sys
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cape_slack_plugin.slack_dedup import EventDeduplicator
+
+_LOOKUPS = 2000
+
+
+def _deque_lookup(size: int) -> float:
+    processed_events = deque((f'Ev{i}' for i in range(size)), maxlen=size)
+    start = time.perf_counter()
+    for i in range(_LOOKUPS):
+        event_id = f'New{i}'
+        if event_id not in processed_events:
+            processed_events.append(event_id)
+    return (time.perf_counter() - start) / _LOOKUPS
+
+
+async def _deduplicator_lookup(size: int) -> float:
+    processed_events = EventDeduplicator(window=3600)
+    for i in range(size):
+        await processed_events.add(f'Ev{i}')
+    start = time.perf_counter()
+    for i in range(_LOOKUPS):
+        await processed_events.add(f'New{i}')
+    return (time.perf_counter() - start) / _LOOKUPS
+
+
+if __name__ == '__main__':
+    print(f"{'ids':>10} {'deque (us/event)':>18} {'deduplicator (us/event)':>25}")
+    for size in (1000, 10000, 100000, 1000000):
+        deduplicator = asyncio.get_event_loop().run_until_complete(_deduplicator_lookup(size))
+        print(f"{size:>10} {_deque_lookup(size) * 1e6:>18.2f} {deduplicator * 1e6:>25.2f}")
@@ -0,0 +1,112 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare command dispatch through the compiled command pattern with the previous linear scan of lambdas.
+
+    python benchmarks/bench_dispatch.py
+"""
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cape_slack_plugin.slack_commands import command, find_command
+
+_MESSAGES = ["what's the wifi password?", ".next", ".why", ".add where is the office | 2nd floor",
+             "how many holidays do I get <mailto:hr@example.com|hr@example.com>", ".index", "3+4", ".help"]
+_ECHO_MODE = {}
+_MAILTO_LINK = re.compile(r"<mailto:[^|]*\|([^>]*)>")
+
+
+def _echo(*args):
+    pass
+
+
+def _add_saved_reply(*args):
+    pass
+
+
+def _help(*args):
+    pass
+
+
+def _next(*args):
+    pass
+
+
+def _explain(*args):
+    pass
+
+
+def _answer(*args):
+    pass
+
+
+_ACTIONS = [
+    (lambda bot, channel, request, message: message.startswith(".echo") or _ECHO_MODE.get((bot, channel), False),
+     _echo),
+    (lambda bot, channel, request, message: message.startswith(".add"), _add_saved_reply),
+    (lambda bot, channel, request, message: "|" in message, _add_saved_reply),
+    (lambda bot, channel, request, message: message.startswith(".new"), _add_saved_reply),
+    (lambda bot, channel, request, message: message.startswith(".help"), _help),
+    (lambda bot, channel, request, message: message.startswith(".man"), _help),
+    (lambda bot, channel, request, message: message.startswith(".next"), _next),
+    (lambda bot, channel, request, message: message.startswith(".more"), _next),
+    (lambda bot, channel, request, message: message.startswith(".explain"), _explain),
+    (lambda bot, channel, request, message: message.startswith(".why"), _explain),
+    (lambda bot, channel, request, message: message.startswith(".context"), _explain),
+    (lambda bot, channel, request, message: message.startswith(".conf"), _explain),
+    (lambda bot, channel, request, message: message.startswith(".score"), _explain),
+    (lambda bot, channel, request, message: message.startswith(".index"), _explain),
+    (lambda bot, channel, request, message: True, _answer),
+]
+
+command(".add", ".new")(_add_saved_reply)
+command(".help", ".man")(_help)
+command(".next", ".more")(_next)
+command(".explain", ".why", ".context", ".conf", ".score", ".index")(_explain)
+
+
+def _linear_dispatch(bot, channel, text):
+    message = text.replace("<@%s>" % bot, "").strip()
+    message = re.sub(r"<mailto:[^|]*\|([^>]*)>", r"\1", message).strip()
+    for checker, action in _ACTIONS:
+        try:
+            checked = checker(bot, channel, None, message)
+        except Exception:
+            checked = False
+        if checked:
+            return action
+
+
+def _compiled_dispatch(bot, channel, text):
+    message = text.replace("<@%s>" % bot, "").strip()
+    message = _MAILTO_LINK.sub(r"\1", message).strip()
+    if message.startswith(".echo") or _ECHO_MODE.get((bot, channel), False):
+        return _echo
+    elif "|" in message:
+        return _add_saved_reply
+    return find_command(message) or _answer
+
+
+if __name__ == '__main__':
+    for text in _MESSAGES:
+        assert _linear_dispatch('U1', 'C1', text) is _compiled_dispatch('U1', 'C1', text), text
+    number = 20000
+    for name, dispatch in (('linear scan', _linear_dispatch), ('compiled', _compiled_dispatch)):
+        seconds = timeit.timeit(lambda: [dispatch('U1', 'C1', text) for text in _MESSAGES], number=number)
+        print(f"{name:>12}: {seconds / (number * len(_MESSAGES)) * 1e6:.2f} us/message")
@@ -0,0 +1,150 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Offline run of .learn against a synthetic channel history served by the fake Slack API.
+
+The channel mixes questions answered in threads, questions answered in the channel and approved with a reaction,
+unanswered questions, chatter and bot messages. The run can be interrupted after a number of pages and resumed, and
+reports the saved replies created against those expected, Slack calls and rate limiting, e.g.:
+
+    python benchmarks/bench_learn.py --messages 5000 --rate 20 --history-rate 25 --interrupt 5
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fake_cape import FakeCape, FakeRequest
+from fake_slack import FakeSlackApi
+
+_CHANNEL = 'CHISTORY'
+
+
+def _build_history(slack: FakeSlackApi, messages: int, seed: int) -> int:
+    """Fill the channel's history, returns the number of question and answer pairs it contains."""
+    rng = random.Random(seed)
+    history = []
+    threads = {}
+    expected = 0
+    ts = 1500000000
+    while len(history) < messages:
+        ts += 1
+        asker, helper = f'U{rng.randrange(100)}', f'U{100 + rng.randrange(100)}'
+        question = f'How do I fix problem number {len(history)}?'
+        kind = rng.choices(['thread', 'approved', 'unapproved', 'chatter', 'bot'], [3, 2, 2, 4, 1])[0]
+        if kind == 'thread':
+            replies = [{'type': 'message', 'user': helper, 'ts': f'{ts}.000002', 'thread_ts': f'{ts}.000001',
+                        'text': f'Restart the service that caused problem {len(history)}.'},
+                       {'type': 'message', 'user': asker, 'ts': f'{ts}.000003', 'thread_ts': f'{ts}.000001',
+                        'text': 'thanks!'}]
+            if rng.random() < 0.5:
+                # A first guess, the approved answer comes after it
+                replies.insert(0, {'type': 'message', 'user': f'U{200 + rng.randrange(100)}',
+                                   'ts': f'{ts}.0000015', 'thread_ts': f'{ts}.000001',
+                                   'text': 'Have you tried turning it off and on?'})
+                replies[1]['reactions'] = [{'name': 'thumbsup', 'count': 2}]
+            history.append({'type': 'message', 'user': asker, 'ts': f'{ts}.000001', 'text': question,
+                            'thread_ts': f'{ts}.000001', 'reply_count': len(replies)})
+            threads[f'{ts}.000001'] = replies
+            expected += 1
+        elif kind in {'approved', 'unapproved'}:
+            history.append({'type': 'message', 'user': asker, 'ts': f'{ts}.000001', 'text': question})
+            answer = {'type': 'message', 'user': helper, 'ts': f'{ts}.000002',
+                      'text': f'You need to clear the cache for problem {len(history)}.'}
+            if kind == 'approved':
+                answer['reactions'] = [{'name': rng.choice(['+1', 'white_check_mark', 'clap']), 'count': 1}]
+                expected += 1
+            history.append(answer)
+        elif kind == 'chatter':
+            history.append({'type': 'message', 'user': asker, 'ts': f'{ts}.000001', 'text': 'Deploying to prod now.'})
+        else:
+            history.append({'type': 'message', 'subtype': 'bot_message', 'bot_id': 'B1', 'ts': f'{ts}.000001',
+                            'text': 'Is this the answer you were looking for?'})
+    slack.add_history(_CHANNEL, history, threads)
+    return expected
+
+
+def _learn_request(user: str) -> FakeRequest:
+    return FakeRequest({'event_id': uuid4().hex, 'authed_users': ['UBOT1'],
+                        'event': {'type': 'message', 'channel': 'DADMIN', 'user': user,
+                                  'text': f'.learn <#{_CHANNEL}|support>', 'ts': f'{time.time():.6f}'}})
+
+
+async def main(args):
+    slack = FakeSlackApi(latency=args.slack_latency, history_rate=args.history_rate, retry_after=1.0)
+    os.environ['CAPE_SLACK_API_URL'] = await slack.start()
+    os.environ['CAPE_SLACK_LEARN_RATE'] = str(args.rate)
+    os.environ['CAPE_SLACK_LEARN_PAGE_SIZE'] = str(args.page_size)
+    cape = FakeCape(responder_latency=args.responder_latency)
+    cape.install()
+    from cape_slack_plugin import slack_events
+    from cape_slack_plugin.slack_utils import close_slack_session
+
+    expected = _build_history(slack, args.messages, args.seed)
+    slack.admins.add('UADMIN')
+    await slack_events.receive_event(_learn_request('UNOTADMIN'))
+    refused = sum(1 for _, _, text in slack.posted if 'only workspace admins' in text)
+
+    start = time.monotonic()
+    await slack_events.receive_event(_learn_request('UADMIN'))
+    if args.interrupt:
+        while slack_events._background_tasks and slack.calls['conversations.history'] < args.interrupt:
+            await asyncio.sleep(0.01)
+        if slack_events._background_tasks:
+            for task in list(slack_events._background_tasks):
+                task.cancel()
+            await asyncio.wait(list(slack_events._background_tasks))
+            print(f"interrupted after {slack.calls['conversations.history']} pages, "
+                  f"{cape.calls.get('create_saved_reply', 0)} saved replies")
+            await slack_events.receive_event(_learn_request('UADMIN'))
+    while slack_events._background_tasks:
+        await asyncio.wait(list(slack_events._background_tasks))
+    elapsed = time.monotonic() - start
+    checkpoint = slack_events._state.get(('learn', 'UBOT1', _CHANNEL))
+    history_calls = slack.calls['conversations.history']
+
+    # Asking again only reads what was posted since
+    await slack_events.receive_event(_learn_request('UADMIN'))
+    while slack_events._background_tasks:
+        await asyncio.wait(list(slack_events._background_tasks))
+    await close_slack_session()
+    await slack.stop()
+
+    saved = cape.calls.get('create_saved_reply', 0)
+    print(f"{args.messages} messages with {expected} answered questions, non-admin refused: {bool(refused)}")
+    print(f"learned {checkpoint.learned} saved replies from {checkpoint.read} messages in {elapsed:.1f}s, "
+          f"{saved} created in all runs, within the bot's responder quota (CAPE_SLACK_TENANT_RATE)")
+    print(f"learning again read {slack.calls['conversations.history'] - history_calls} page(s) of new messages")
+    print("slack api: " + ', '.join(f'{method} {count}' for method, count in sorted(slack.calls.items()))
+          + f", {slack.rate_limited} rate limited")
+    print(f"last progress message: {slack.edited[-1][3] if slack.edited else slack.posted[-1][2]}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--page-size', type=int, default=200)
+    parser.add_argument('--rate', type=float, default=20, help='history calls per second allowed to .learn')
+    parser.add_argument('--history-rate', type=float, default=None, help='history calls per second before a 429')
+    parser.add_argument('--interrupt', type=int, default=0, help='pages read before interrupting and resuming')
+    parser.add_argument('--slack-latency', type=float, default=0.01)
+    parser.add_argument('--responder-latency', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=0)
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
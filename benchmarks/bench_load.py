@@ -0,0 +1,284 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Offline load test of receive_event (or Socket Mode) against a fake Slack API and a fake Cape responder.
+
+Replays a synthetic stream of questions, commands, reactions to answers, file shares, Slack retries, token
+revocations and uninstalls at a fixed rate, then reports throughput, acknowledgement and answer latencies, Slack API
+usage and memory growth. Requires the plugin's public dependencies (sanic, aiohttp, peewee), but no Cape services or
+Slack credentials, e.g.:
+
+    python benchmarks/bench_load.py --rate 200 --duration 30 --responder-latency 0.05 --slack-latency 0.02
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import re
+import resource
+import sys
+import time
+from collections import defaultdict, deque
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fake_cape import FakeCape, FakeRequest
+from fake_slack import FakeSlackApi
+
+# First answers to a question, as opposed to the numbered ones given by .next
+_ANSWER = re.compile(r'answer to .*\?$')
+
+
+def _rss_mb() -> float:
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        # Peak rather than current memory outside Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def _percentile(values, percentile: float) -> float:
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+
+class LoadGenerator:
+
+    def __init__(self, args, slack: FakeSlackApi, cape: FakeCape, slack_events):
+        self.args = args
+        self.slack = slack
+        self.cape = cape
+        self.slack_events = slack_events
+        self.random = random.Random(args.seed)
+        self.questions = 0
+        self.asked = defaultdict(deque)  # channel -> submission times of unanswered questions
+        self.answer_latencies = []
+        self.hot_latencies = []  # answer latencies of UBOT0 when it is made to send a share of all events
+        self.ack_latencies = []
+        self.answers = []  # (bot, channel, ts) of posted answers, targets for reactions
+        self.sent_events = []  # payloads that can be retried
+        self.shared_files = {}  # (bot, document number) -> info of the file last shared
+        self.counts = {}
+        self.shed = 0
+        self.pending = set()
+        slack.on_post = self._on_post
+
+    def _on_post(self, channel: str, text: str, ts: str):
+        if _ANSWER.match(text):
+            if self.asked[channel]:
+                latency = time.monotonic() - self.asked[channel].popleft()
+                (self.hot_latencies if self.args.hot_share and channel.startswith('UBOT0-') else
+                 self.answer_latencies).append(latency)
+            self.answers.append((channel.split('-')[0], channel, ts))
+
+    def _payload(self, bot: str, event: dict) -> dict:
+        return {'token': 'verification', 'team_id': 'T' + bot, 'api_app_id': 'A0', 'type': 'event_callback',
+                'event_id': 'Ev' + uuid4().hex, 'event_time': int(time.time()), 'authed_users': [bot],
+                'event': event}
+
+    def _bot(self) -> str:
+        if self.args.hot_share and self.random.random() < self.args.hot_share:
+            return 'UBOT0'
+        return f'UBOT{self.random.randrange(1 if self.args.hot_share else 0, self.args.bots)}'
+
+    def _next_payload(self) -> dict:
+        kind = self.random.choices(['question', 'command', 'reaction', 'file', 'retry', 'revoke'],
+                                   [self.args.questions, self.args.commands, self.args.reactions, self.args.files,
+                                    self.args.retries, self.args.revocations])[0]
+        if kind == 'retry' and self.sent_events:
+            self.counts['retry'] = self.counts.get('retry', 0) + 1
+            return self.random.choice(self.sent_events[-1000:])
+        if kind == 'reaction' and self.answers:
+            bot, channel, ts = self.random.choice(self.answers[-1000:])
+            payload = self._payload(bot, {'type': 'reaction_added', 'user': 'UHUMAN', 'reaction': 'thumbsup',
+                                          'item': {'type': 'message', 'channel': channel, 'ts': ts}})
+        elif kind == 'revoke':
+            bot = f'UBOT{self.random.randrange(self.args.bots)}'
+            if self.random.random() < 0.5:
+                payload = self._payload(bot, {'type': 'tokens_revoked', 'tokens': {'bot': [bot]}})
+            else:
+                payload = self._payload(bot, {'type': 'app_uninstalled'})
+        else:
+            bot = self._bot()
+            channel = f'{bot}-C{self.random.randrange(self.args.channels)}'
+            event = {'type': 'message', 'channel': channel, 'user': 'UHUMAN', 'ts': f'{time.time():.6f}'}
+            if kind == 'command':
+                event['text'] = self.random.choice(['.next', '.why', '.help'])
+            elif kind == 'file':
+                # Teams share the same few runbooks again and again, either the same file or a new upload of it
+                number = self.random.randrange(self.args.documents)
+                shared = self.shared_files.get((bot, number))
+                if shared is None or self.random.random() < 0.5:
+                    shared = self.shared_files[bot, number] = self.slack.add_file(
+                        'F' + uuid4().hex[:8], f'runbook-{number}.md',
+                        f'# Runbook {number}\n\nRestart the service.\n'.encode(), 'markdown')
+                event.update(subtype='file_share', file={'id': shared['id']}, text='')
+            else:
+                kind = 'question'
+                self.questions += 1
+                # A small vocabulary of popular questions makes answer caching visible
+                event['text'] = f'what about topic {self.random.randrange(self.args.vocabulary)}?'
+                self.asked[channel].append(time.monotonic())
+            payload = self._payload(bot, event)
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        self.sent_events.append(payload)
+        return payload
+
+    async def _submit(self, payload: dict):
+        start = time.monotonic()
+        if self.args.socket:
+            acknowledged = await self.slack.send_envelope(payload)
+        else:
+            response = await self.slack_events.receive_event(FakeRequest(payload, self.args.signing_secret))
+            acknowledged = getattr(response, 'status', 200) != 503
+        self.ack_latencies.append(time.monotonic() - start)
+        if not acknowledged:
+            self.shed += 1
+
+    async def run(self) -> list:
+        memory = [(0.0, _rss_mb())]
+        start = time.monotonic()
+        interval = 1.0 / self.args.rate
+        sent = 0
+        next_sample = 1.0
+        next_refresh = self.args.socket_refresh or None
+        while True:
+            elapsed = time.monotonic() - start
+            if elapsed >= self.args.duration:
+                break
+            due = int(elapsed / interval) + 1
+            while sent < due:
+                task = asyncio.ensure_future(self._submit(self._next_payload()))
+                self.pending.add(task)
+                task.add_done_callback(self.pending.discard)
+                sent += 1
+            if elapsed >= next_sample:
+                memory.append((elapsed, _rss_mb()))
+                next_sample += 1.0
+            if next_refresh is not None and elapsed >= next_refresh:
+                await self.slack.refresh_socket()
+                next_refresh += self.args.socket_refresh
+            await asyncio.sleep(min(interval, 0.01))
+        if self.pending:
+            await asyncio.wait(list(self.pending))
+        memory.append((time.monotonic() - start, _rss_mb()))
+        return memory
+
+
+async def main(args):
+    slack = FakeSlackApi(latency=args.slack_latency, channel_rate=args.slack_channel_rate,
+                         ratelimit_probability=args.ratelimit_probability)
+    os.environ['CAPE_SLACK_API_URL'] = await slack.start()
+    os.environ['CAPE_SLACK_EVENT_MODE'] = args.mode
+    if args.metrics:
+        os.environ['CAPE_SLACK_METRICS'] = 'true'
+    if args.signing_secret:
+        os.environ['CAPE_SLACK_SIGNING_SECRET'] = args.signing_secret
+    if args.journal:
+        os.environ['CAPE_SLACK_JOURNAL_PATH'] = args.journal
+    if args.socket:
+        os.environ['CAPE_SLACK_SOCKET_MODE'] = 'true'
+        os.environ['CAPE_SLACK_APP_TOKEN'] = 'xapp-fake'
+    cape = FakeCape(responder_latency=args.responder_latency, db_latency=args.db_latency)
+    cape.install()
+    from cape_slack_plugin import slack_events
+    from cape_slack_plugin.slack_utils import close_slack_session
+
+    loop = asyncio.get_event_loop()
+    await slack_events._start_event_queue(None, loop)
+    await slack_events._replay_journal(None, loop)
+    await slack_events._start_socket_mode(None, loop)
+    if args.socket:
+        await slack.wait_socket()
+    generator = LoadGenerator(args, slack, cape, slack_events)
+    start = time.monotonic()
+    memory = await generator.run()
+    acked = time.monotonic() - start
+    # Also waits for the messages still queued to be posted
+    await slack_events._drain_event_queue(None, loop)
+    finished = time.monotonic() - start
+    await close_slack_session()
+    if slack_events._journal is not None:
+        await slack_events._journal.close()
+    await slack.stop()
+
+    events = sum(generator.counts.values())
+    print(f"mode: {args.mode}{' over socket mode' if args.socket else ''}, "
+          f"{events} events over {args.duration}s at {args.rate}/s: "
+          + ', '.join(f'{count} {kind}' for kind, count in sorted(generator.counts.items())))
+    print(f"throughput: {events / acked:.1f} events/s acknowledged, {events / finished:.1f} events/s processed "
+          f"({finished:.1f}s until all answers were posted), {generator.shed} shed")
+    print(f"ack latency: p50 {_percentile(generator.ack_latencies, 50) * 1000:.1f}ms, "
+          f"p99 {_percentile(generator.ack_latencies, 99) * 1000:.1f}ms")
+    print(f"answer latency: p50 {_percentile(generator.answer_latencies, 50) * 1000:.1f}ms, "
+          f"p99 {_percentile(generator.answer_latencies, 99) * 1000:.1f}ms, "
+          f"{len(generator.answer_latencies) + len(generator.hot_latencies)}/{generator.questions} questions answered")
+    if args.hot_share:
+        print(f"answer latency of the busy workspace: p50 {_percentile(generator.hot_latencies, 50) * 1000:.1f}ms, "
+              f"p99 {_percentile(generator.hot_latencies, 99) * 1000:.1f}ms (the rest are given above)")
+    print("slack api: " + ', '.join(f'{method} {count}' for method, count in sorted(slack.calls.items()))
+          + f", {slack.rate_limited} rate limited")
+    print("responder and db: " + ', '.join(f'{name} {count}' for name, count in sorted(cape.calls.items())))
+    print("documents: " + ', '.join(f'{name} {count}' for name, count in
+                                    sorted(slack_events._document_index.stats().items())))
+    if args.socket:
+        print(f"socket mode: {slack.socket_connections} connections, {slack.socket_retries} envelopes sent again")
+    if slack_events._journal is not None:
+        journal = slack_events._journal.stats()
+        print(f"journal: {journal['appended']} events in {journal['commits']} commits")
+    print("memory (rss MB): " + ', '.join(f'{elapsed:.0f}s {rss:.1f}' for elapsed, rss in memory[::max(1, len(
+        memory) // 10)]) + f", growth {memory[-1][1] - memory[0][1]:+.1f}")
+    if args.metrics:
+        from cape_slack_plugin.slack_metrics import render
+        print(render(), end='')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=['queue', 'inline'], default='queue')
+    parser.add_argument('--rate', type=float, default=100, help='events per second')
+    parser.add_argument('--duration', type=float, default=10, help='seconds')
+    parser.add_argument('--bots', type=int, default=20, help='workspaces')
+    parser.add_argument('--channels', type=int, default=50, help='channels per workspace')
+    parser.add_argument('--vocabulary', type=int, default=100, help='distinct question topics')
+    parser.add_argument('--documents', type=int, default=5, help='distinct documents shared per workspace')
+    parser.add_argument('--hot-share', type=float, default=0.0,
+                        help='share of the events sent by one busy workspace, UBOT0')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--metrics', action='store_true', help='print the plugin\'s metrics at the end')
+    parser.add_argument('--journal', default=None, help='journal events to this SQLite file')
+    parser.add_argument('--socket', action='store_true', help='deliver events over socket mode instead of HTTP')
+    parser.add_argument('--socket-refresh', type=float, default=0,
+                        help='seconds between the socket mode reconnections asked for by the fake Slack')
+    parser.add_argument('--signing-secret', default=None, help='sign events and have the plugin verify them')
+    parser.add_argument('--responder-latency', type=float, default=0.05, help='seconds per responder call')
+    parser.add_argument('--db-latency', type=float, default=0.002, help='seconds per Bot/User lookup')
+    parser.add_argument('--slack-latency', type=float, default=0.02, help='mean seconds per Slack API call')
+    parser.add_argument('--slack-channel-rate', type=float, default=None,
+                        help='messages per second per channel accepted by the fake Slack before answering 429')
+    parser.add_argument('--ratelimit-probability', type=float, default=0.0,
+                        help='chance of the fake Slack answering 429 to any message')
+    weights = parser.add_argument_group('event mix (relative weights)')
+    weights.add_argument('--questions', type=float, default=70)
+    weights.add_argument('--commands', type=float, default=10)
+    weights.add_argument('--reactions', type=float, default=8)
+    weights.add_argument('--files', type=float, default=2)
+    weights.add_argument('--retries', type=float, default=9)
+    weights.add_argument('--revocations', type=float, default=0.1, help='token revocations and uninstalls')
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
@@ -0,0 +1,112 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare the memory held by the conversations of many active channels, with their state in separate keys (as it
+used to be) and in one ChannelSession per channel, and the time to look up the answer a reaction is about.
+
+Each channel has asked a question, fetched three document answers, asked for the next one and had both answers
+posted, as they would be in the memory:// state store.
+
+    python benchmarks/bench_sessions.py --channels 100000
+"""
+
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cape_slack_plugin.slack_state import Answer, ChannelSession, MemoryStateStore, QuestionAnswer
+
+_ANSWERS = 3
+_CONTEXT_CHARS = 1000
+
+
+def _response_items(channel: int) -> list:
+    # What the responder returns, built anew for every channel as it is parsed from JSON
+    return [{'answerText': f'Answer {i} to the question asked in channel {channel}, ' + 'a' * 150,
+             'confidence': 0.5, 'sourceType': 'document', 'sourceId': f'document-{channel % 100}',
+             'answerContext': f'Context {i} of channel {channel} ' + 'c' * _CONTEXT_CHARS,
+             'answerTextStartOffset': 10, 'answerTextEndOffset': 60, 'answerContextStartOffset': 0}
+            for i in range(_ANSWERS)]
+
+
+def _fill_keys(store: MemoryStateStore, channels: int):
+    for channel in range(channels):
+        channel_id = f'C{channel:08d}'
+        question = f'What is the question asked in channel {channel}?'
+        answers = tuple(Answer.from_response(item) for item in _response_items(channel))
+        store.set_many({('answers', 'B1', channel_id): answers, ('cursor', 'B1', channel_id): 1,
+                        ('question', 'B1', channel_id): question, ('offset', 'B1', channel_id): None,
+                        ('echo', 'B1', channel_id): False})
+        for i, answer in enumerate(answers[:2]):
+            ts = f'{1500000000 + channel}.{i:06d}'
+            # The text of the bot's messages was stored from their message events, answers by their text
+            store.set_many({('ts', 'B1', channel_id, ts): answer.text,
+                            ('qa', 'B1', channel_id, answer.text): QuestionAnswer(question, answer)})
+
+
+def _fill_sessions(store: MemoryStateStore, channels: int):
+    for channel in range(channels):
+        channel_id = f'C{channel:08d}'
+        session = ChannelSession()
+        session.ask(f'What is the question asked in channel {channel}?',
+                    tuple(Answer.from_response(item) for item in _response_items(channel)), None)
+        session.add_posted(f'{1500000000 + channel}.000000', session.question, session.answers[0])
+        session.show(1)
+        session.add_posted(f'{1500000000 + channel}.000001', session.question, session.answers[1])
+        store.set(('session', 'B1', channel_id), session)
+
+
+def _reaction_keys(store: MemoryStateStore, channels: int) -> QuestionAnswer:
+    for channel in range(channels):
+        channel_id = f'C{channel:08d}'
+        message = store.get(('ts', 'B1', channel_id, f'{1500000000 + channel}.000001'))
+        question_answer = store.get(('qa', 'B1', channel_id, message))
+    return question_answer
+
+
+def _reaction_sessions(store: MemoryStateStore, channels: int) -> QuestionAnswer:
+    for channel in range(channels):
+        session = store.get(('session', 'B1', f'C{channel:08d}'))
+        question_answer = session.posted.get(f'{1500000000 + channel}.000001')
+    return question_answer
+
+
+def _measure(fill, react, channels: int):
+    gc.collect()
+    tracemalloc.start()
+    store = MemoryStateStore(max_entries=channels * 10)
+    fill(store, channels)
+    gc.collect()
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    start = time.perf_counter()
+    react(store, channels)
+    lookup = (time.perf_counter() - start) / channels
+    return len(store._data), memory, lookup
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--channels', type=int, default=100000)
+    args = parser.parse_args()
+    print(f"{'layout':>10} {'entries':>10} {'MB':>10} {'bytes/channel':>15} {'reaction lookup (us)':>22}")
+    for name, fill, react in (('keys', _fill_keys, _reaction_keys), ('sessions', _fill_sessions, _reaction_sessions)):
+        entries, memory, lookup = _measure(fill, react, args.channels)
+        print(f"{name:>10} {entries:>10} {memory / 2 ** 20:>10.1f} {memory / args.channels:>15.0f} "
+              f"{lookup * 1e6:>22.2f}")
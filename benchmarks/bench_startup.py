@@ -0,0 +1,113 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cold start of a worker, each run in a new process: time to import the plugin, to get ready to receive events and
+to answer the first question, received --first-event-after seconds after the worker is ready.
+
+Workers are started the way they used to be (the responder imported with the plugin, nothing opened before the first
+event), with the responder imported lazily, and warmed up in the background by warmup(). The fake responder's modules
+take --import-latency seconds each to import, the database and Slack connections --connect-latency seconds to open.
+'Until useful' is the time from the import to the first answer, less the time spent waiting for the first event, e.g.:
+
+    python benchmarks/bench_startup.py --runs 5 --import-latency 0.5 --connect-latency 0.2 --first-event-after 3
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+_MODES = ('eager', 'lazy', 'warmup')
+
+
+async def _start_worker(args):
+    """Start a worker in this process, and print its timings as JSON."""
+    from fake_cape import FakeCape, FakeRequest
+    from fake_slack import FakeSlackApi
+
+    slack = FakeSlackApi(latency=args.slack_latency, connect_latency=args.connect_latency)
+    os.environ['CAPE_SLACK_API_URL'] = await slack.start()
+    os.environ['CAPE_SLACK_WARMUP'] = str(args.mode == 'warmup').lower()
+    cape = FakeCape(responder_latency=args.responder_latency, import_latency=args.import_latency,
+                    connect_latency=args.connect_latency)
+    cape.install()
+
+    start = time.monotonic()
+    if args.mode == 'eager':
+        from cape_slack_plugin.slack_responder import import_responder
+        import_responder()
+    from cape_slack_plugin import slack_events
+    imported = time.monotonic()
+    loop = asyncio.get_event_loop()
+    await slack_events._start_event_queue(None, loop)
+    await slack_events._replay_journal(None, loop)
+    await slack_events._warmup(None, loop)
+    ready = time.monotonic()
+    await asyncio.sleep(args.first_event_after)
+
+    answered = loop.create_future()
+    slack.on_post = lambda channel, text, ts: answered.done() or answered.set_result(None)
+    await slack_events.receive_event(FakeRequest({
+        'event_id': 'Ev1', 'authed_users': ['UBOT1'],
+        'event': {'type': 'message', 'channel': 'D1', 'user': 'U1', 'text': 'How do I reset my password?',
+                  'ts': f'{time.time():.6f}'}}))
+    await answered
+    finished = time.monotonic()
+    answer_latency = finished - ready - args.first_event_after
+    await slack_events._drain_event_queue(None, loop)
+    await slack_events._close_slack_session(None, loop)
+    await slack.stop()
+    print(json.dumps({'import': imported - start, 'ready': ready - start, 'first_answer': answer_latency,
+                      'useful': ready - start + answer_latency}))
+
+
+def _run(args, mode: str) -> dict:
+    command = [sys.executable, os.path.abspath(__file__), '--worker', '--mode', mode]
+    for name in ('import_latency', 'connect_latency', 'responder_latency', 'slack_latency', 'first_event_after'):
+        command += ['--' + name.replace('_', '-'), str(getattr(args, name))]
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE).stdout.decode()
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(args):
+    print(f"{'mode':>8} {'import (ms)':>12} {'ready (ms)':>12} {'first answer (ms)':>18} {'until useful (ms)':>18}")
+    for mode in _MODES:
+        runs = [_run(args, mode) for _ in range(args.runs)]
+        medians = {name: statistics.median(run[name] for run in runs) * 1000 for name in runs[0]}
+        print(f"{mode:>8} {medians['import']:>12.0f} {medians['ready']:>12.0f} {medians['first_answer']:>18.0f} "
+              f"{medians['useful']:>18.0f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='workers started per mode, medians are reported')
+    parser.add_argument('--import-latency', type=float, default=0.5, help='seconds per responder module imported')
+    parser.add_argument('--connect-latency', type=float, default=0.2, help='seconds to open a connection')
+    parser.add_argument('--first-event-after', type=float, default=0.0,
+                        help='seconds between the worker getting ready and its first event')
+    parser.add_argument('--responder-latency', type=float, default=0.05)
+    parser.add_argument('--slack-latency', type=float, default=0.02)
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--mode', choices=_MODES, default='warmup', help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+    if arguments.worker:
+        asyncio.get_event_loop().run_until_complete(_start_worker(arguments))
+    else:
+        main(arguments)
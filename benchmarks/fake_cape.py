@@ -0,0 +1,269 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Stand-ins for the Cape responder, userdb and api_helpers, so that the plugin can be benchmarked offline.
+
+install() must be called before importing cape_slack_plugin.slack_events. The fake responder answers every question
+with 'answer to <question>' after a configurable delay, and the fake Bot and User tables hold any number of bots
+named UBOT<n> owned by users USER<n>. Importing the responder's modules and connecting to the database can be made
+to take time, as they do in Cape.
+"""
+
+import hashlib
+import hmac
+import importlib.abc
+import importlib.util
+import json
+import re
+import sys
+import threading
+import time
+import types
+from functools import wraps
+
+from peewee import DoesNotExist
+
+
+class FakeCape:
+
+    def __init__(self, responder_latency: float = 0.0, db_latency: float = 0.0, import_latency: float = 0.0,
+                 connect_latency: float = 0.0):
+        self.responder_latency = responder_latency
+        self.db_latency = db_latency
+        self.import_latency = import_latency
+        self.connect_latency = connect_latency
+        self.connected = False
+        self.calls = {}
+        self.deleted_bots = set()
+        self.documents = {}  # document id -> text
+        self._lock = threading.Lock()
+        self._connect_lock = threading.Lock()
+        self._reply_ids = 0
+
+    def _count(self, name: str):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _respond(self, name: str, result) -> types.SimpleNamespace:
+        self._count(name)
+        if self.responder_latency:
+            time.sleep(self.responder_latency)
+        return types.SimpleNamespace(body=json.dumps({'success': True, 'result': result}))
+
+    def answer(self, request):
+        question = request['args']['question']
+        number = int(request['args'].get('numberofitems', 1))
+        offset = int(request['args'].get('offset', 0))
+        items = [{'answerText': f'answer to {question}' + (f' ({i})' if i else ''),
+                  'confidence': 0.9 - 0.1 * i, 'sourceType': 'document', 'sourceId': 'runbook.md',
+                  'matchedQuestion': question, 'answerContext': f'context of answer to {question}',
+                  'answerTextStartOffset': 11, 'answerTextEndOffset': 20, 'answerContextStartOffset': 0}
+                 for i in range(offset, min(offset + number, 5))]
+        return self._respond('answer', {'items': items})
+
+    def create_saved_reply(self, request):
+        with self._lock:
+            self._reply_ids += 1
+            reply_id = f'reply{self._reply_ids}'
+        return self._respond('create_saved_reply', {'replyId': reply_id, 'answerId': reply_id})
+
+    def add_paraphrase_question(self, request):
+        return self._respond('add_paraphrase_question', {'questionId': request['args']['question']})
+
+    def upload_document(self, request):
+        with self._lock:
+            self.documents[request['args']['origin']] = request['args']['text']
+        return self._respond('upload_document', {'documentId': request['args']['origin']})
+
+    def delete_document(self, request):
+        with self._lock:
+            self.documents.pop(request['args']['documentid'], None)
+        return self._respond('delete_document', {'documentId': request['args']['documentid']})
+
+    def connect(self, reuse_if_open: bool = False):
+        with self._connect_lock:
+            if not self.connected:
+                self._count('connect')
+                time.sleep(self.connect_latency)
+                self.connected = True
+
+    def get_record(self, kind: str, field: str, value: str):
+        self.connect(reuse_if_open=True)
+        self._count('db')
+        if self.db_latency:
+            time.sleep(self.db_latency)
+        number = value[len('UBOT'):] if kind == 'bot' else value[len('USER'):]
+        if kind == 'bot' and value in self.deleted_bots or not number.isdigit():
+            raise DoesNotExist()
+        if kind == 'bot':
+            return FakeBot(bot_id=value, bot_token=f'xoxb-{number}', user_id=f'USER{number}', cape=self)
+        return types.SimpleNamespace(user_id=value, token=f'token-{number}')
+
+    def install(self):
+        """Register the fake cape_webservices, cape_userdb and cape_api_helpers modules."""
+        cape = self
+
+        class UserException(Exception):
+            def __init__(self, message):
+                super().__init__(message)
+                self.message = message
+
+        def required_parameter(request, name):
+            if name not in request['args']:
+                raise UserException(f'Missing parameter {name}')
+            return request['args'][name]
+
+        def optional_parameter(request, name, default):
+            return request['args'].get(name, default)
+
+        def respond_with_json(wrapped):
+            @wraps(wrapped)
+            def decorated(request, *args, **kwargs):
+                try:
+                    return {'success': True, 'result': wrapped(request, *args, **kwargs)}
+                except UserException as e:
+                    return {'success': False, 'result': {'message': e.message}}
+
+            return decorated
+
+        def requires_auth(wrapped):
+            return wrapped
+
+        def try_numerical_answer(question):
+            match = re.search(r'(\d+(?:\s*[-+*/]\s*\d+)+)', question)
+            if not match:
+                return None
+            expression = match.group(1)
+            return expression, str(eval(expression, {'__builtins__': {}}))
+
+        class Bot:
+            bot_id = _Field('bot_id')
+            _meta = types.SimpleNamespace(database=types.SimpleNamespace(connect=self.connect))
+
+            @staticmethod
+            def get(field, value):
+                return cape.get_record('bot', field, value)
+
+            @staticmethod
+            def delete():
+                return _DeleteBots(cape)
+
+        class User:
+            @staticmethod
+            def get(field, value):
+                return cape.get_record('user', field, value)
+
+        modules = {
+            'webservices': {},
+            'webservices.app': {},
+            'webservices.app.app_middleware': {'respond_with_json': respond_with_json, 'requires_auth': requires_auth},
+            'webservices.app.app_core': {'_answer': self.answer},
+            'webservices.app.app_saved_reply_endpoints': {'_create_saved_reply': self.create_saved_reply,
+                                                          '_add_paraphrase_question': self.add_paraphrase_question},
+            'webservices.app.app_document_endpoints': {'_upload_document': self.upload_document,
+                                                       '_delete_document': self.delete_document},
+            'webservices.bots_common': {},
+            'webservices.bots_common.utils': {'try_numerical_answer': try_numerical_answer,
+                                              'NUMERICAL_EXPRESSION_THRESHOLD': 0.8,
+                                              'NON_WORD_CHARS': re.compile(r'\.\w*\s*'),
+                                              'ERROR_HELP_MESSAGE': ''},
+            'userdb': {},
+            'userdb.bot': {'Bot': Bot},
+            'userdb.user': {'User': User},
+            'api_helpers': {},
+            'api_helpers.input': {'required_parameter': required_parameter,
+                                  'optional_parameter': optional_parameter},
+            'api_helpers.exceptions': {'UserException': UserException},
+            'api_helpers.text_responses': {'ERROR_FILE_TYPE_UNSUPPORTED': 'Unsupported file type',
+                                           'BOT_FILE_UPLOADED': 'File uploaded',
+                                           'ERROR_INVALID_SLACK_RESPONSE': 'Invalid Slack response'},
+        }
+        slow = {'webservices.app.app_core', 'webservices.app.app_saved_reply_endpoints',
+                'webservices.app.app_document_endpoints', 'webservices.bots_common.utils'}
+        if self.import_latency:
+            sys.meta_path.insert(0, _SlowImporter({name: modules.pop(name) for name in slow}, self.import_latency))
+        for name, attributes in modules.items():
+            module = types.ModuleType(name)
+            module.__dict__.update(attributes)
+            module.__all__ = list(attributes)
+            if not attributes:
+                # A package, so that its modules can be imported
+                module.__path__ = []
+            sys.modules[name] = module
+
+
+class _SlowImporter(importlib.abc.MetaPathFinder, importlib.abc.Loader):
+    """Imports fake modules, each taking import_latency seconds."""
+
+    def __init__(self, modules: dict, import_latency: float):
+        self.modules = modules
+        self.import_latency = import_latency
+
+    def find_spec(self, name, path, target=None):
+        return importlib.util.spec_from_loader(name, self) if name in self.modules else None
+
+    def create_module(self, spec):
+        return None
+
+    def exec_module(self, module):
+        time.sleep(self.import_latency)
+        module.__dict__.update(self.modules[module.__name__])
+
+
+class _Field:
+    """The peewee field expressions used by the plugin."""
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def in_(self, values):
+        return self.name, list(values)
+
+
+class _DeleteBots:
+
+    def __init__(self, cape: FakeCape):
+        self.cape = cape
+        self.bot_ids = []
+
+    def where(self, expression):
+        self.bot_ids = expression[1]
+        return self
+
+    def execute(self) -> int:
+        self.cape._count('db')
+        deleted = {bot_id for bot_id in self.bot_ids if bot_id[len('UBOT'):].isdigit()} - self.cape.deleted_bots
+        self.cape.deleted_bots.update(deleted)
+        return len(deleted)
+
+
+class FakeBot(types.SimpleNamespace):
+
+    def delete_instance(self):
+        self.cape.deleted_bots.add(self.bot_id)
+
+
+class FakeRequest(dict):
+    """What the plugin reads from a Sanic request once the Cape middleware has parsed it."""
+
+    def __init__(self, payload: dict, signing_secret: str = None):
+        super().__init__(args=dict(payload))
+        self.json = payload
+        self.body = json.dumps(payload).encode()
+        self.headers = {}
+        if signing_secret is not None:
+            timestamp = str(int(time.time()))
+            signature = hmac.new(signing_secret.encode(), b'v0:' + timestamp.encode() + b':' + self.body,
+                                 hashlib.sha256).hexdigest()
+            self.headers = {'X-Slack-Request-Timestamp': timestamp, 'X-Slack-Signature': 'v0=' + signature}
@@ -0,0 +1,292 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local stand-in for the Slack Web API and Socket Mode, with injected latency and rate limiting."""
+
+import asyncio
+import json
+import random
+import socket
+import time
+from collections import defaultdict
+from uuid import uuid4
+
+from aiohttp import web, WSMsgType
+
+
+class FakeSlackApi:
+    """Serves the Slack Web API methods used by the plugin on http://127.0.0.1:<port>/api/.
+
+    latency: mean seconds added to every call (uniformly jittered by +/-50%)
+    channel_rate: messages per second accepted per channel before answering 429 (None for no limit)
+    ratelimit_probability: chance of answering 429 to any chat.postMessage regardless of rate
+    history_rate: conversations.history and conversations.replies calls per second before answering 429 (None for no
+        limit)
+    connect_latency: seconds added to the first call over each connection, as a TLS handshake with Slack takes
+
+    Events are delivered over Socket Mode with send_envelope(), to the websocket opened with the URL returned by
+    apps.connections.open. Envelopes not acknowledged within socket_retry_after seconds are sent again, up to three
+    times, and those pending when the connection closes are sent again over the next one.
+    """
+
+    def __init__(self, latency: float = 0.0, channel_rate: float = None, ratelimit_probability: float = 0.0,
+                 retry_after: float = 1.0, history_rate: float = None, socket_retry_after: float = 3.0,
+                 connect_latency: float = 0.0):
+        self.latency = latency
+        self.channel_rate = channel_rate
+        self.ratelimit_probability = ratelimit_probability
+        self.retry_after = retry_after
+        self.history_rate = history_rate
+        self.connect_latency = connect_latency
+        self._transports = set()
+        self.posted = []  # (monotonic time, channel, text)
+        self.edited = []  # (monotonic time, channel, ts, text)
+        self.calls = defaultdict(int)
+        self.rate_limited = 0
+        self.files = {}  # file id -> (info dict, bytes)
+        self.history = {}  # channel -> messages, oldest first
+        self.threads = {}  # (channel, thread ts) -> replies, oldest first
+        self.admins = set()
+        self.on_post = None
+        self.socket_connections = 0
+        self.socket_failures = 0  # apps.connections.open calls to fail before succeeding
+        self.socket_retry_after = socket_retry_after
+        self.socket_retries = 0
+        self.ack_seconds = []
+        self._websocket = None
+        self._socket_connected = asyncio.Event()
+        self._envelopes = {}  # envelope id -> (envelope, future resolved on ack, monotonic time sent)
+        self._last_post = {}
+        self._last_history_call = 0.0
+        self._ts = 0
+        self._runner = None
+        self.url = None
+
+    async def start(self, port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_route('POST', '/api/{method}', self._api)
+        app.router.add_route('GET', '/files/{file_id}', self._download)
+        app.router.add_route('GET', '/socket', self._socket)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', port))
+        port = sock.getsockname()[1]
+        await web.SockSite(self._runner, sock).start()
+        self.url = f'http://127.0.0.1:{port}'
+        return self.url + '/api/'
+
+    async def stop(self):
+        if self._websocket is not None:
+            await self._websocket.close()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def add_file(self, file_id: str, name: str, content: bytes, filetype: str = 'text') -> dict:
+        info = {'id': file_id, 'name': name, 'title': name, 'filetype': filetype, 'size': len(content),
+                'url_private': f'{self.url}/files/{file_id}', 'timestamp': int(time.time())}
+        self.files[file_id] = (info, content)
+        return info
+
+    def add_history(self, channel: str, messages: list, threads: dict = None):
+        """Messages of a channel (oldest first) and the replies of its threads, by the ts of their parent."""
+        self.history[channel] = messages
+        for ts, replies in (threads or {}).items():
+            self.threads[channel, ts] = replies
+
+    async def wait_socket(self):
+        await self._socket_connected.wait()
+
+    def send_envelope(self, payload: dict) -> asyncio.Future:
+        """Deliver an event callback payload over Socket Mode, the future is resolved with whether it was
+        acknowledged, before it was given up."""
+        envelope = {'envelope_id': uuid4().hex, 'type': 'events_api', 'accepts_response_payload': False,
+                    'retry_attempt': 0, 'retry_reason': '', 'payload': payload}
+        future = asyncio.get_event_loop().create_future()
+        self._envelopes[envelope['envelope_id']] = (envelope, future, time.monotonic())
+        self._deliver(envelope)
+        return future
+
+    def _deliver(self, envelope: dict):
+        if self._websocket is not None:
+            asyncio.ensure_future(self._websocket.send_str(json.dumps(envelope)))
+        asyncio.get_event_loop().call_later(self.socket_retry_after, self._retry, envelope['envelope_id'])
+
+    def _retry(self, envelope_id: str):
+        if envelope_id not in self._envelopes:
+            return
+        envelope, future, _ = self._envelopes[envelope_id]
+        if envelope['retry_attempt'] == 3:
+            del self._envelopes[envelope_id]
+            future.set_result(False)
+            return
+        self.socket_retries += 1
+        envelope['retry_attempt'] += 1
+        envelope['retry_reason'] = 'timeout'
+        self._deliver(envelope)
+
+    async def refresh_socket(self):
+        """Ask the client to reconnect, as Slack does every few hours."""
+        if self._websocket is not None:
+            websocket, self._websocket = self._websocket, None
+            self._socket_connected.clear()
+            await websocket.send_str(json.dumps({'type': 'disconnect', 'reason': 'refresh_requested'}))
+            await websocket.close()
+
+    async def _socket(self, request: web.Request) -> web.WebSocketResponse:
+        websocket = web.WebSocketResponse()
+        await websocket.prepare(request)
+        self.socket_connections += 1
+        self._websocket = websocket
+        await websocket.send_str(json.dumps({'type': 'hello', 'num_connections': 1}))
+        self._socket_connected.set()
+        for envelope, _, _ in list(self._envelopes.values()):
+            # Those sent while there was no connection, or unacknowledged over the last one
+            await websocket.send_str(json.dumps(envelope))
+        async for message in websocket:
+            if message.type != WSMsgType.TEXT:
+                break
+            envelope_id = json.loads(message.data).get('envelope_id')
+            if envelope_id in self._envelopes:
+                _, future, sent = self._envelopes.pop(envelope_id)
+                self.ack_seconds.append(time.monotonic() - sent)
+                future.set_result(True)
+        if self._websocket is websocket:
+            self._websocket = None
+            self._socket_connected.clear()
+        return websocket
+
+    async def _delay(self):
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+
+    def _next_ts(self) -> str:
+        self._ts += 1
+        return f'{int(time.time())}.{self._ts:06d}'
+
+    async def _api(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        params = dict(await request.post())
+        params.update(request.query)
+        self.calls[method] += 1
+        if self.connect_latency and request.transport not in self._transports:
+            self._transports.add(request.transport)
+            await asyncio.sleep(self.connect_latency)
+        await self._delay()
+        handler = getattr(self, '_' + method.replace('.', '_'), None)
+        if handler is None:
+            return web.json_response({'ok': False, 'error': 'unknown_method'})
+        return handler(params)
+
+    def _ratelimited(self, channel: str) -> bool:
+        if self.ratelimit_probability and random.random() < self.ratelimit_probability:
+            return True
+        if self.channel_rate is None:
+            return False
+        now = time.monotonic()
+        if now - self._last_post.get(channel, 0.0) < 1.0 / self.channel_rate:
+            return True
+        self._last_post[channel] = now
+        return False
+
+    def _chat_postMessage(self, params: dict) -> web.Response:
+        channel = params.get('channel')
+        if self._ratelimited(channel):
+            self.rate_limited += 1
+            return web.json_response({'ok': False, 'error': 'ratelimited'}, status=429,
+                                     headers={'Retry-After': str(self.retry_after)})
+        ts = self._next_ts()
+        self.posted.append((time.monotonic(), channel, params.get('text', '')))
+        if self.on_post is not None:
+            self.on_post(channel, params.get('text', ''), ts)
+        return web.json_response({'ok': True, 'channel': channel, 'ts': ts,
+                                  'message': {'text': params.get('text', ''), 'ts': ts}})
+
+    def _chat_update(self, params: dict) -> web.Response:
+        self.edited.append((time.monotonic(), params.get('channel'), params.get('ts'), params.get('text', '')))
+        return web.json_response({'ok': True, 'channel': params.get('channel'), 'ts': params.get('ts'),
+                                  'text': params.get('text', '')})
+
+    def _history_ratelimited(self) -> bool:
+        now = time.monotonic()
+        if self.history_rate is not None and now - self._last_history_call < 1.0 / self.history_rate:
+            self.rate_limited += 1
+            return True
+        self._last_history_call = now
+        return False
+
+    def _page(self, messages: list, params: dict) -> web.Response:
+        # Cursors are offsets in the list of messages
+        start = int(params.get('cursor') or 0)
+        end = start + int(params.get('limit', 100))
+        more = end < len(messages)
+        return web.json_response({'ok': True, 'messages': messages[start:end], 'has_more': more,
+                                  'response_metadata': {'next_cursor': str(end) if more else ''}})
+
+    def _conversations_history(self, params: dict) -> web.Response:
+        if self._history_ratelimited():
+            return web.json_response({'ok': False, 'error': 'ratelimited'}, status=429,
+                                     headers={'Retry-After': str(self.retry_after)})
+        if params.get('channel') not in self.history:
+            return web.json_response({'ok': False, 'error': 'not_in_channel'})
+        oldest = float(params.get('oldest') or 0)
+        messages = [message for message in reversed(self.history[params['channel']])
+                    if float(message['ts']) > oldest]
+        return self._page(messages, params)
+
+    def _conversations_replies(self, params: dict) -> web.Response:
+        if self._history_ratelimited():
+            return web.json_response({'ok': False, 'error': 'ratelimited'}, status=429,
+                                     headers={'Retry-After': str(self.retry_after)})
+        replies = self.threads.get((params.get('channel'), params.get('ts')))
+        if replies is None:
+            return web.json_response({'ok': False, 'error': 'thread_not_found'})
+        parent = next(message for message in self.history[params['channel']] if message['ts'] == params['ts'])
+        response = self._page(replies, params)
+        # Slack returns the parent first on every page
+        body = json.loads(response.text)
+        body['messages'].insert(0, parent)
+        return web.json_response(body)
+
+    def _api_test(self, params: dict) -> web.Response:
+        return web.json_response({'ok': True})
+
+    def _users_info(self, params: dict) -> web.Response:
+        user = params.get('user')
+        return web.json_response({'ok': True, 'user': {'id': user, 'is_admin': user in self.admins}})
+
+    def _apps_connections_open(self, params: dict) -> web.Response:
+        if self.socket_failures:
+            self.socket_failures -= 1
+            return web.json_response({'ok': False, 'error': 'internal_error'})
+        return web.json_response({'ok': True, 'url': self.url.replace('http://', 'ws://') + '/socket'})
+
+    def _files_info(self, params: dict) -> web.Response:
+        if params.get('file') not in self.files:
+            return web.json_response({'ok': False, 'error': 'file_not_found'})
+        return web.json_response({'ok': True, 'file': self.files[params['file']][0]})
+
+    def _files_comments_add(self, params: dict) -> web.Response:
+        return web.json_response({'ok': True})
+
+    def _oauth_access(self, params: dict) -> web.Response:
+        return web.json_response({'ok': True, 'access_token': 'xoxp-fake',
+                                  'bot': {'bot_user_id': 'UBOT0', 'bot_access_token': 'xoxb-fake'}})
+
+    async def _download(self, request: web.Request) -> web.StreamResponse:
+        await self._delay()
+        file_id = request.match_info['file_id']
+        if file_id not in self.files:
+            return web.Response(status=404)
+        return web.Response(body=self.files[file_id][1])
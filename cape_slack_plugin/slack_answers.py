@@ -0,0 +1,96 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import re
+from typing import Awaitable, Callable, Optional, Tuple
+from uuid import uuid4
+
+from cape_slack_plugin.slack_cache import LRUCache
+from cape_slack_plugin.slack_state import StateStore
+
+_WHITESPACE = re.compile(r'\s+')
+_TRAILING_PUNCTUATION = re.compile(r'[\s?!.,;:]+$')
+
+
+def normalize_question(question: str) -> str:
+    return _TRAILING_PUNCTUATION.sub('', _WHITESPACE.sub(' ', question.strip().lower()))
+
+
+class AnswerCache:
+    """Responder answers per bot and normalized question, with concurrent identical questions sharing one call.
+
+    Entries are keyed by the bot's knowledge generation, which invalidate() replaces whenever the bot's saved replies
+    or documents change. With a shared store the generation is kept there, so that a change made through one worker
+    also invalidates the answers cached by the others.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, store: Optional[StateStore] = None):
+        self.store = store
+        self.coalesced = 0
+        # Grouped by bot, to forget a bot's answers at once
+        self._cache = LRUCache(max_entries, ttl=ttl, group=lambda key: key[0])
+        self._generations = {}
+        self._in_flight = {}
+
+    async def _generation(self, bot_id: str):
+        if self.store is not None:
+            return await self.store.aget(('answer-generation', bot_id))
+        return self._generations.get(bot_id)
+
+    async def invalidate(self, bot_id: str):
+        generation = uuid4().hex
+        self._generations[bot_id] = generation
+        if self.store is not None:
+            await self.store.aset(('answer-generation', bot_id), generation)
+
+    async def forget_bot(self, bot_id: str):
+        """Drop everything cached for a bot that has been removed."""
+        self._cache.pop_group(bot_id)
+        self._generations.pop(bot_id, None)
+        if self.store is not None:
+            await self.store.adelete(('answer-generation', bot_id))
+
+    async def get_or_fetch(self, bot_id: str, question: str, key: Tuple, fetch: Callable[[], Awaitable[dict]],
+                           cacheable: Callable[[dict], bool] = lambda result: True) -> dict:
+        """Cached result of fetch() for this bot, question and any extra key (e.g. number of answers)."""
+        key = (bot_id, await self._generation(bot_id), normalize_question(question)) + tuple(key)
+        result = self._cache.get(key)
+        if result is not None:
+            return result
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(in_flight)
+        future = self._in_flight[key] = asyncio.get_event_loop().create_future()
+        try:
+            result = await fetch()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody else was waiting
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            if cacheable(result):
+                self._cache.set(key, result)
+            return result
+        finally:
+            del self._in_flight[key]
+
+    def stats(self) -> dict:
+        return dict(self._cache.stats(), coalesced=self.coalesced)
@@ -12,11 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import requests
+import logging
+
 from sanic.response import redirect
 from cape_slack_plugin.slack_settings import URL_BASE
 from cape_slack_plugin.slack_settings import slack_auth_endpoints, slack_client_id, slack_client_secret, \
-    slack_app_url
+    slack_app_url, slack_warmup
+from cape_slack_plugin.slack_utils import slack_api_call, close_slack_session, warm_slack_session
+from cape_slack_plugin.slack_records import invalidate_bot, invalidate_user, connect_records
 from webservices.app.app_middleware import requires_auth
 from userdb.bot import Bot
 from api_helpers.exceptions import UserException
@@ -24,33 +27,52 @@ from api_helpers.input import required_parameter
 from api_helpers.text_responses import *
 from peewee import IntegrityError
 
+_LOGGER = logging.getLogger(__name__)
+
 _endpoint_route = lambda x: slack_auth_endpoints.route(URL_BASE + x, methods=['GET', 'POST'])
 
 
+@slack_auth_endpoints.listener('before_server_start')
+async def _warmup(app, loop):
+    # The callback saves bots and exchanges codes with Slack, a failure here only leaves it to the first callback
+    if slack_warmup:
+        try:
+            connect_records()
+            await warm_slack_session()
+        except Exception as e:
+            _LOGGER.warning("Failed to warm up the Slack OAuth callback: %r", e)
+
+
+@slack_auth_endpoints.listener('after_server_stop')
+async def _close_slack_session(app, loop):
+    await close_slack_session()
+
+
 @_endpoint_route('/auth/oauth_callback')
 @requires_auth
-def oauth_callback(request):
+async def oauth_callback(request):
     oauth_code = required_parameter(request, "code")
-    slack_request = requests.Session()
-    slack_response = slack_request.get("https://slack.com/api/oauth.access",
-                                       params={"client_id": slack_client_id,
-                                               "client_secret": slack_client_secret,
-                                               "code": oauth_code})
-    slack_request.close()
+    slack_response = await slack_api_call('oauth.access', None, client_id=slack_client_id,
+                                          client_secret=slack_client_secret, code=oauth_code)
     try:
         bot = Bot(user_id=request['user'].user_id,
-                  bot_id=slack_response.json()['bot']['bot_user_id'],
-                  bot_token=slack_response.json()['bot']['bot_access_token'],
-                  access_token=slack_response.json()['access_token'])
+                  bot_id=slack_response['bot']['bot_user_id'],
+                  bot_token=slack_response['bot']['bot_access_token'],
+                  access_token=slack_response['access_token'])
         bot.save()
+        # Forget cached 'missing' lookups from before the bot was installed
+        await invalidate_bot(bot.bot_id)
+        await invalidate_user(bot.user_id)
     except KeyError:
         raise UserException(ERROR_INVALID_SLACK_RESPONSE)
     except IntegrityError:
         # We already have this bot, so update it with new tokens
-        bot = Bot.get('bot_id', slack_response.json()['bot']['bot_user_id'])
+        bot = Bot.get('bot_id', slack_response['bot']['bot_user_id'])
         bot.user_id = request['user'].user_id
-        bot.bot_token = slack_response.json()['bot']['bot_access_token']
-        bot.access_token = slack_response.json()['access_token']
+        bot.bot_token = slack_response['bot']['bot_access_token']
+        bot.access_token = slack_response['access_token']
         bot.save()
+        await invalidate_bot(bot.bot_id)
+        await invalidate_user(bot.user_id)
         return redirect('https://thecape.ai/slack.html#complete')
     return redirect('https://thecape.ai/slack.html#complete')
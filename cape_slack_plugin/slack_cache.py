@@ -0,0 +1,136 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+def approximate_size(value, _depth=0) -> int:
+    """Approximate number of bytes held by value, following containers and __slots__ a few levels deep."""
+    size = sys.getsizeof(value)
+    if _depth > 4:
+        return size
+    if isinstance(value, dict):
+        size += sum(approximate_size(k, _depth + 1) + approximate_size(v, _depth + 1) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(approximate_size(item, _depth + 1) for item in value)
+    elif hasattr(value, '__slots__'):
+        size += sum(approximate_size(getattr(value, slot, None), _depth + 1) for slot in value.__slots__)
+    return size
+
+
+class _Entry:
+    __slots__ = ('value', 'expires', 'size')
+
+    def __init__(self, value, expires, size):
+        self.value = value
+        self.expires = expires
+        self.size = size
+
+
+class LRUCache:
+    """Least recently used cache bounded by number of entries, approximate bytes and per-entry age.
+
+    With a group function, the keys of each group (e.g. of one bot) are indexed so that pop_group() removes them
+    without scanning the others.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: Optional[int] = None, ttl: Optional[float] = None,
+                 sizeof: Callable[[Any], int] = approximate_size,
+                 group: Optional[Callable[[Any], Optional[Hashable]]] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.group = group
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._groups = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        entry = self._entries.get(key)
+        return entry is not None and (entry.expires is None or entry.expires > time.time())
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        if entry.expires is not None and entry.expires <= time.time():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry.value
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        ttl = ttl if ttl is not None else self.ttl
+        size = self.sizeof(key) + self.sizeof(value) if self.max_bytes is not None else 0
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = _Entry(value, time.time() + ttl if ttl is not None else None, size)
+        self.nbytes += size
+        if self.group is not None:
+            group = self.group(key)
+            if group is not None:
+                self._groups.setdefault(group, set()).add(key)
+        while self._entries and (len(self._entries) > self.max_entries or
+                                 self.max_bytes is not None and self.nbytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        if key not in self._entries:
+            return default
+        return self._remove(key).value
+
+    def pop_group(self, group: Hashable) -> int:
+        """Remove all the keys of a group, returns how many there were."""
+        keys = self._groups.get(group, ())
+        count = len(keys)
+        for key in list(keys):
+            self._remove(key)
+        return count
+
+    def clear(self):
+        self._entries.clear()
+        self._groups.clear()
+        self.nbytes = 0
+
+    def stats(self) -> dict:
+        return {'entries': len(self._entries), 'bytes': self.nbytes, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'expirations': self.expirations}
+
+    def _remove(self, key) -> _Entry:
+        entry = self._entries.pop(key)
+        self.nbytes -= entry.size
+        if self.group is not None:
+            group = self.group(key)
+            keys = self._groups.get(group)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._groups[group]
+        return entry
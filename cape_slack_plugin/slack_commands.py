@@ -0,0 +1,52 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+from typing import Callable, Optional
+
+# Handlers of dot commands, called with (bot, channel, request, message)
+_COMMANDS = {}
+# Compiled once all the commands are registered, by the first message or compile_commands()
+_COMMAND_PATTERN = None
+_compiled = False
+
+
+def compile_commands():
+    global _COMMAND_PATTERN, _compiled
+    # Longest names first so that a command is never shadowed by another one it starts with
+    names = sorted(_COMMANDS, key=len, reverse=True)
+    _COMMAND_PATTERN = re.compile('|'.join(re.escape(name) for name in names)) if names else None
+    _compiled = True
+
+
+def command(*names: str):
+    """Register a coroutine as the handler of messages starting with any of names, e.g. @command('.next', '.more')."""
+
+    def register(handler):
+        global _compiled
+        for name in names:
+            _COMMANDS[name] = handler
+        _compiled = False
+        return handler
+
+    return register
+
+
+def find_command(message: str) -> Optional[Callable]:
+    if not _compiled:
+        compile_commands()
+    if _COMMAND_PATTERN is None:
+        return None
+    match = _COMMAND_PATTERN.match(message)
+    return _COMMANDS[match.group(0)] if match else None
@@ -0,0 +1,71 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from collections import deque
+from typing import Optional
+
+from cape_slack_plugin.slack_state import StateStore
+
+
+class EventDeduplicator:
+    """Remembers event ids for a time window, in O(1) per event.
+
+    Ids are kept in a hash map to their expiry time, plus a queue in expiry order so that expired ids are dropped
+    from the front as new ones arrive. With a shared store, ids are also claimed there so that a retry delivered to
+    another worker is recognised as well.
+    """
+
+    def __init__(self, window: float, store: Optional[StateStore] = None):
+        self.window = window
+        self.store = store
+        self.duplicates = 0
+        self._expiries = {}
+        self._order = deque()
+
+    def __len__(self):
+        return len(self._expiries)
+
+    async def add(self, event_id: str) -> bool:
+        """Record event_id, returns False if it has already been seen within the window."""
+        now = time.time()
+        self._expire(now)
+        if event_id in self._expiries or self.store is not None and \
+                not await self.store.aadd(('event', event_id), True, self.window):
+            self.duplicates += 1
+            return False
+        expires = now + self.window
+        self._expiries[event_id] = expires
+        self._order.append((expires, event_id))
+        return True
+
+    def restore(self, event_id: str, seen: float):
+        """Remember event_id as seen at the given time, e.g. after a restart. Ids must be restored in the order they
+        were seen, before new ones are added."""
+        expires = seen + self.window
+        if expires > time.time():
+            self._expiries[event_id] = expires
+            self._order.append((expires, event_id))
+
+    async def discard(self, event_id: str):
+        """Forget event_id, so that a retry of it is processed."""
+        self._expiries.pop(event_id, None)
+        if self.store is not None:
+            await self.store.adelete(('event', event_id))
+
+    def _expire(self, now: float):
+        while self._order and self._order[0][0] <= now:
+            expires, event_id = self._order.popleft()
+            if self._expiries.get(event_id) == expires:
+                del self._expiries[event_id]
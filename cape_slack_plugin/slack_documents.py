@@ -0,0 +1,153 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import codecs
+import hashlib
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+import markdown
+from bs4 import BeautifulSoup
+from cape_slack_plugin.slack_state import StateStore, IndexedDocument
+from cape_slack_plugin.slack_utils import open_slack_file
+
+_CHUNK_BYTES = 64 * 1024
+
+# Slack file types read as plain text
+_PLAIN_TEXT_FILETYPES = {'text', 'csv', 'tsv', 'json', 'yaml', 'rst', 'latex', 'diff', 'sql', 'shell', 'python',
+                         'javascript', 'java', 'c', 'cpp', 'csharp', 'go', 'ruby', 'php', 'css', 'typescript'}
+# Slack file types whose markup is removed before sending them to the responder
+_MARKUP_FILETYPES = {'markdown', 'html', 'xml'}
+SUPPORTED_FILETYPES = _PLAIN_TEXT_FILETYPES | _MARKUP_FILETYPES
+
+
+class DocumentTooLarge(Exception):
+    pass
+
+
+async def read_slack_file(token: str, url: str, max_bytes: int,
+                          on_progress: Optional[Callable[[int], Awaitable]] = None) -> Tuple[str, str]:
+    """Download a private file in chunks, decoding and hashing it as it arrives, and stop as soon as it exceeds
+    max_bytes. Returns the text and the SHA-256 digest of the file's bytes."""
+    async with open_slack_file(token, url) as response:
+        response.raise_for_status()
+        if response.content_length is not None and response.content_length > max_bytes:
+            raise DocumentTooLarge()
+        try:
+            decoder = codecs.getincrementaldecoder(response.charset or 'utf-8')(errors='replace')
+        except LookupError:
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        digest = hashlib.sha256()
+        text = []
+        received = 0
+        async for chunk in response.content.iter_chunked(_CHUNK_BYTES):
+            received += len(chunk)
+            if received > max_bytes:
+                raise DocumentTooLarge()
+            digest.update(chunk)
+            text.append(decoder.decode(chunk))
+            if on_progress is not None:
+                await on_progress(received)
+        text.append(decoder.decode(b'', final=True))
+    # Drop a UTF-8 byte order mark
+    return ''.join(text).lstrip('\ufeff'), digest.hexdigest()
+
+
+def extract_text(filetype: str, text: str) -> str:
+    if filetype == 'markdown':
+        text = markdown.markdown(text)
+    if filetype in _MARKUP_FILETYPES:
+        soup = BeautifulSoup(text, 'html.parser')
+        for element in soup(['script', 'style']):
+            element.decompose()
+        text = soup.get_text('\n')
+    return text
+
+
+def max_document_bytes(filetype: str, max_bytes: int, markup_max_bytes: int) -> int:
+    return min(max_bytes, markup_max_bytes) if filetype in _MARKUP_FILETYPES else max_bytes
+
+
+def extract_parts(filetype: str, text: str, max_chars: int) -> List[str]:
+    """The text of a document in parts of at most max_chars, this takes seconds for large markup documents."""
+    return split_text(extract_text(filetype, text), max_chars)
+
+
+def split_text(text: str, max_chars: int) -> List[str]:
+    """Split text in parts of at most max_chars, preferably between paragraphs, then lines, then words."""
+    parts = []
+    while len(text) > max_chars:
+        cut = -1
+        for separator in ('\n\n', '\n', ' '):
+            cut = text.rfind(separator, max_chars // 2, max_chars)
+            if cut != -1:
+                break
+        if cut == -1:
+            cut = max_chars
+        parts.append(text[:cut])
+        text = text[cut:].lstrip()
+    if text or not parts:
+        parts.append(text)
+    return parts
+
+
+def _updated(slack_file: dict) -> Optional[int]:
+    return slack_file.get('updated', slack_file.get('timestamp', slack_file.get('created')))
+
+
+class DocumentIndex:
+    """What was last indexed for each bot and document name, to skip documents that are shared again unchanged.
+
+    A file whose Slack id, size and modification time match needn't be downloaded, a new file with the same content
+    (e.g. the same runbook uploaded again) is downloaded but needn't be indexed again.
+    """
+
+    def __init__(self, store: StateStore, ttl: Optional[float]):
+        self.store = store
+        self.ttl = ttl
+        self.skipped_downloads = 0
+        self.skipped_uploads = 0
+
+    async def unchanged_file(self, bot_id: str, slack_file: dict) -> bool:
+        indexed = await self.store.aget(('document', bot_id, slack_file['name']))
+        if indexed is None or indexed.file_id != slack_file.get('id') or indexed.size != slack_file.get('size') \
+                or indexed.updated != _updated(slack_file):
+            return False
+        self.skipped_downloads += 1
+        return True
+
+    async def unchanged_content(self, bot_id: str, slack_file: dict, digest: str) -> bool:
+        indexed = await self.store.aget(('document', bot_id, slack_file['name']))
+        if indexed is None or indexed.digest != digest:
+            return False
+        self.skipped_uploads += 1
+        # Remember the new file, so that sharing it again skips the download
+        await self.add(bot_id, slack_file, digest, getattr(indexed, 'part_ids', ()))
+        return True
+
+    async def part_ids(self, bot_id: str, name: str) -> Tuple[str, ...]:
+        """The responder's ids of the parts of the document last indexed with this name."""
+        indexed = await self.store.aget(('document', bot_id, name))
+        # Documents indexed before parts were recorded have none
+        return getattr(indexed, 'part_ids', ()) if indexed is not None else ()
+
+    async def add(self, bot_id: str, slack_file: dict, digest: str, part_ids: Tuple[str, ...]):
+        await self.store.aset(('document', bot_id, slack_file['name']),
+                              IndexedDocument(slack_file.get('id'), slack_file.get('size'), _updated(slack_file),
+                                              digest, part_ids), self.ttl)
+
+    async def forget_bot(self, bot_id: str):
+        await self.store.adelete_group(('document', bot_id))
+
+    def stats(self) -> dict:
+        return {'skipped_downloads': self.skipped_downloads, 'skipped_uploads': self.skipped_uploads}
@@ -12,292 +12,780 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import copy
+import hmac
 import json
+import logging
+import signal
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
-from collections import deque
-from typing import Optional
+from typing import List, Optional, Tuple
 from uuid import uuid4
 
+import aiohttp
+from sanic.response import text, json as json_response
+from sanic.exceptions import NotFound
 from cape_slack_plugin.slack_settings import URL_BASE
-from cape_slack_plugin.slack_settings import slack_event_endpoints
-from cape_slack_plugin.slack_utils import send_slack_message, get_slack_file_contents
+from cape_slack_plugin.slack_settings import slack_event_endpoints, slack_event_mode, slack_event_workers, \
+    slack_event_queue_size, slack_event_queue_timeout, slack_event_drain_timeout, slack_responder_threads, \
+    slack_state_url, slack_state_ttl, slack_state_max_entries, slack_state_max_bytes, slack_state_threads, \
+    slack_dedup_window, slack_dedup_url, slack_answer_cache_size, slack_answer_cache_ttl, slack_document_max_bytes, \
+    slack_document_part_chars, slack_document_concurrency, slack_document_index_ttl, slack_answer_page_size, \
+    slack_document_markup_max_bytes, slack_document_threads, \
+    slack_answer_max, slack_answer_prefetch, slack_numerical_processes, slack_numerical_timeout, \
+    slack_paraphrase_concurrency, slack_metrics_enabled, slack_profile_rate, slack_profile_token, \
+    slack_profile_signal, slack_tenant_concurrency, slack_tenant_rate, slack_tenant_burst, slack_tenant_max_waiting, \
+    slack_tenant_weights, slack_tenant_busy_notice, slack_journal_path, slack_journal_commit_interval, \
+    slack_journal_lease, slack_learn_rate, slack_learn_page_size, slack_learn_checkpoint_ttl, slack_socket_mode, \
+    slack_app_token, slack_socket_backoff, slack_socket_max_backoff, slack_warmup
+from cape_slack_plugin.slack_utils import close_slack_session, fetch_slack_file_info, fetch_slack_user_info, \
+    warm_slack_session, SlackRateLimited
+from cape_slack_plugin.slack_outbound import post_message, drain_messages, ProgressMessage, PRIORITY_ANSWER, \
+    PRIORITY_NOTICE
+from cape_slack_plugin.slack_queue import EventQueue, EventQueueFull
+from cape_slack_plugin.slack_numerical import NumericalEvaluator
+from cape_slack_plugin.slack_state import create_state_store, Answer, ChannelSession, HistoryCheckpoint
+from cape_slack_plugin.slack_history import ChannelHistory, SlackHistoryError, POSITIVE_REACTIONS
+from cape_slack_plugin.slack_dedup import EventDeduplicator
+from cape_slack_plugin.slack_journal import create_event_journal, EventRequest
+from cape_slack_plugin.slack_socket import SocketModeClient
+from cape_slack_plugin.slack_records import get_bot, get_user, delete_bots, warm_records
+from cape_slack_plugin.slack_answers import AnswerCache
+from cape_slack_plugin.slack_commands import command, find_command, compile_commands
+from cape_slack_plugin.slack_metrics import Counter, Gauge, STAGE_SECONDS, ACTION_SECONDS, register_cache, render
+from cape_slack_plugin.slack_profiler import get_profiler, span
+from cape_slack_plugin.slack_verify import verify_request
+from cape_slack_plugin.slack_fairness import FairScheduler, TenantBusy, parse_weights
+from cape_slack_plugin.slack_documents import read_slack_file, extract_parts, max_document_bytes, DocumentTooLarge, \
+    DocumentIndex, SUPPORTED_FILETYPES
+from cape_slack_plugin.slack_responder import answer as responder_answer, \
+    create_saved_reply as responder_create_saved_reply, add_paraphrase_question as responder_add_paraphrase_question, \
+    upload_document as responder_upload_document, delete_document as responder_delete_document, try_numerical_answer, \
+    bots_common, import_responder
 from webservices.app.app_middleware import respond_with_json
-from webservices.app.app_core import _answer as responder_answer
-from webservices.app.app_saved_reply_endpoints import _create_saved_reply as responder_create_saved_reply
-from webservices.app.app_saved_reply_endpoints import _add_paraphrase_question as responder_add_paraphrase_question
-from webservices.app.app_document_endpoints import _upload_document as responder_upload_document
 from userdb.bot import Bot
-from userdb.user import User
-from webservices.bots_common.utils import try_numerical_answer, NUMERICAL_EXPRESSION_THRESHOLD, NON_WORD_CHARS, \
-    ERROR_HELP_MESSAGE
 from api_helpers.input import required_parameter, optional_parameter
 from api_helpers.text_responses import ERROR_FILE_TYPE_UNSUPPORTED, BOT_FILE_UPLOADED
 from api_helpers.exceptions import UserException
 import re
 
+_LOGGER = logging.getLogger(__name__)
+
 _endpoint_route = lambda x: slack_event_endpoints.route(URL_BASE + x, methods=['GET', 'POST'])
 
-_processed_events = deque(maxlen=1000)
-# Answer response to the last question asked, broken down by bot and channel
-_previous_answers = {}
-# Index of the last answer provided from _previous_answers, broken down by bot and channel
-_last_answer = {}
-# Echo mode
-_ECHO_MODE = {}
+_MAILTO_LINK = re.compile(r"<mailto:[^|]*\|([^>]*)>")
+# Questions without any of these can't contain an arithmetic expression
+_NUMERICAL_HINT = re.compile(r"[\d+*/^%()]")
+# Message of a file share asking to import saved replies from the file
+_IMPORT_COMMAND = re.compile(r"(?:^|\s)\.import\b")
+# Channel mentions look like <#C0123456|general>
+_CHANNEL_MENTION = re.compile(r"<#(\w+)(?:\|[^>]*)?>")
+
+_processed_events = EventDeduplicator(slack_dedup_window, None if slack_dedup_url.startswith('memory:') else
+                                      create_state_store(slack_dedup_url, threads=slack_state_threads))
+# Events acknowledged but not processed yet, replayed on startup
+_journal = create_event_journal(slack_journal_path, slack_journal_commit_interval, slack_dedup_window,
+                                slack_journal_lease)
+# Conversation state, shared between workers. Keys:
+#   ('session', bot_id, channel) the ChannelSession of a bot in a channel
+# and, scoped by bot only:
+#   ('document', bot_id, name) metadata and content hash of the last version of a document indexed
+#   ('learn', bot_id, channel) HistoryCheckpoint of learning from a channel's history
+_state = create_state_store(slack_state_url, slack_state_max_entries, slack_state_max_bytes, slack_state_threads)
+_document_index = DocumentIndex(_state, slack_document_index_ttl)
+_answer_cache = AnswerCache(slack_answer_cache_size, slack_answer_cache_ttl,
+                            None if slack_state_url.startswith('memory:') else _state)
+
+_event_queue = EventQueue(workers=slack_event_workers, maxsize=slack_event_queue_size,
+                          put_timeout=slack_event_queue_timeout, drain_timeout=slack_event_drain_timeout)
+_responder_executor = ThreadPoolExecutor(max_workers=slack_responder_threads)
+# Responder calls are admitted fairly between bots, as many at a time as there are threads to run them
+_responder_scheduler = FairScheduler(slack_responder_threads, slack_tenant_concurrency, slack_tenant_rate,
+                                     slack_tenant_burst, slack_tenant_max_waiting, parse_weights(slack_tenant_weights))
+# Relative cost of responder calls when sharing them between bots, answers and saved replies cost 1
+_RESPONDER_COSTS = {responder_upload_document: 5.0}
+# Separate from the responder's threads, so that an expression that takes forever to evaluate only ties up this pool
+_numerical = NumericalEvaluator(try_numerical_answer, slack_numerical_processes, slack_numerical_timeout,
+                                prepare=bots_common)
+# Converts documents to text, so that the event loop keeps acknowledging events meanwhile
+_document_executor = ThreadPoolExecutor(max_workers=slack_document_threads)
+# Tasks started in the background (ingesting documents, prefetching answers), waited for on shutdown
+_background_tasks = set()
+# Journaled event ids to how many of their handler and background tasks are still running, the event is complete once
+# none are
+_event_holds = {}
+# Limits how many documents are read at once, created on the server's loop
+_ingestion_slots = None
+# (bot_id, channel) of the channels being learned from, each is read by one .learn at a time
+_learning = set()
+# Receives the events in place of /events/receive-event in Socket Mode, started with the server
+_socket_client = None
+
+_EVENTS = Counter('cape_slack_events_total', 'Events received, by type', ('type',))
+_DUPLICATE_EVENTS = Counter('cape_slack_duplicate_events_total',
+                            'Events ignored as retries of an event already received')
+_SHED_EVENTS = Counter('cape_slack_shed_events_total', 'Events refused with a 503 because the event queue was full')
+Gauge('cape_slack_event_queue_depth', 'Events waiting for a worker', _event_queue.qsize)
+Gauge('cape_slack_background_tasks', 'Documents being ingested and answers being prefetched',
+      lambda: len(_background_tasks))
+Gauge('cape_slack_journal_commits_total', 'Commits of the event journal, each for all the events received meanwhile',
+      lambda: _journal.commits if _journal is not None else 0, kind='counter')
+Gauge('cape_slack_socket_connected', 'Whether the Socket Mode connection is open',
+      lambda: int(_socket_client is not None and _socket_client.connected))
+Gauge('cape_slack_dedup_event_ids', 'Event ids remembered to recognise retries', lambda: len(_processed_events))
+Gauge('cape_slack_documents_skipped_total', 'Documents shared again unchanged, by step skipped',
+      lambda: {('download',): _document_index.skipped_downloads, ('upload',): _document_index.skipped_uploads},
+      ('step',), kind='counter')
+Gauge('cape_slack_answers_coalesced_total', 'Questions that shared the responder call of an identical question',
+      lambda: _answer_cache.coalesced, kind='counter')
+Gauge('cape_slack_numerical_given_up_total', 'Arithmetic questions not evaluated, by reason',
+      lambda: {('timeout',): _numerical.timeouts, ('busy',): _numerical.skipped}, ('reason',), kind='counter')
+Gauge('cape_slack_responder_calls', 'Responder calls running and waiting for their bot\'s turn',
+      lambda: {('running',): _responder_scheduler.running, ('waiting',): _responder_scheduler.waiting()}, ('state',))
+Gauge('cape_slack_responder_throttled_total', 'Responder calls of bots over quota, delayed (with a notice) or refused',
+      lambda: {('delayed',): _responder_scheduler.delayed, ('refused',): _responder_scheduler.rejected}, ('outcome',),
+      kind='counter')
+register_cache('answers', _answer_cache.stats)
+if hasattr(_state, 'stats'):
+    register_cache('state', _state.stats)
+
+
+@slack_event_endpoints.listener('before_server_start')
+async def _start_event_queue(app, loop):
+    if slack_event_mode == 'queue':
+        _event_queue.start(loop)
+
+
+@slack_event_endpoints.listener('before_server_start')
+async def _replay_journal(app, loop):
+    if _journal is None:
+        return
+    seen, unfinished = await loop.run_in_executor(None, _journal.recover)
+    _journal.start()
+    for event_id, received in seen:
+        _processed_events.restore(event_id, received)
+    if unfinished:
+        _LOGGER.warning("Replaying %d Slack events left unprocessed", len(unfinished))
+        _run_in_background(_replay_events(unfinished))
+
+
+async def _replay_events(unfinished: List[Tuple[str, dict]]):
+    for event_id, args in unfinished:
+        request = EventRequest(args)
+        bot_id = args['authed_users'][0]
+        event = args['event']
+        if not _event_queue.running:
+            try:
+                await _process_event(event_id, bot_id, event, request)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # The events after it are still replayed
+                _LOGGER.exception("Failed to replay Slack event %s", event_id)
+            continue
+        while True:
+            try:
+                await _event_queue.put(_event_key(bot_id, event), _process_event, event_id, bot_id, event, request)
+                break
+            except EventQueueFull:
+                # Live events come first, these ones have waited already
+                await asyncio.sleep(slack_event_queue_timeout)
+
+
+@slack_event_endpoints.listener('before_server_start')
+async def _warmup(app, loop):
+    # In the background, so that the worker starts receiving events straight away, those received meanwhile wait for
+    # what they need. Await warmup() before the server starts to only receive events once it has finished
+    if slack_warmup:
+        _run_in_background(warmup())
+
+
+async def warmup():
+    """Pay for what a worker's first events would otherwise wait for: importing the responder, opening the database,
+    Slack API and state store connections and compiling the commands. Failures are logged and left to the first
+    event."""
+    loop = asyncio.get_event_loop()
+    stores = [_state] + ([_processed_events.store] if _processed_events.store is not None else [])
+    # The responder is imported, and the database and stores connected, in other threads while this one compiles
+    steps = {'responder': loop.run_in_executor(_responder_executor, import_responder),
+             'slack': asyncio.ensure_future(warm_slack_session()),
+             'database': asyncio.ensure_future(warm_records())}
+    steps.update((f'store {index}', loop.run_in_executor(None, store.connect)) for index, store in enumerate(stores))
+    compile_commands()
+    for name, result in zip(steps, await asyncio.gather(*steps.values(), return_exceptions=True)):
+        if isinstance(result, Exception):
+            _LOGGER.warning("Failed to warm up %s: %r", name, result)
+
+
+@slack_event_endpoints.listener('before_server_start')
+async def _start_socket_mode(app, loop):
+    global _socket_client
+    if slack_socket_mode:
+        _socket_client = SocketModeClient(slack_app_token, _receive_socket_event, slack_socket_backoff,
+                                          slack_socket_max_backoff)
+        _socket_client.start()
+
+
+@slack_event_endpoints.listener('before_server_start')
+async def _install_profile_signal(app, loop):
+    if slack_profile_rate and slack_profile_signal:
+        loop.add_signal_handler(getattr(signal, slack_profile_signal), _log_slowest_events)
+
+
+def _log_slowest_events():
+    _LOGGER.warning("Slowest events profiled: %s", json.dumps(get_profiler().slowest_traces()))
+
 
-_BOT_TS_TO_MESSAGE = {}
-_BOT_MESSAGE_TO_ANSWER = {}
-_LAST_QUESTION = {}
+@slack_event_endpoints.listener('before_server_stop')
+async def _drain_event_queue(app, loop):
+    if _socket_client is not None:
+        # No more events are received while the queue drains
+        await _socket_client.stop()
+    await _event_queue.drain()
+    if _background_tasks:
+        await asyncio.wait(list(_background_tasks), timeout=slack_event_drain_timeout)
+    # The replies of the events processed meanwhile
+    await drain_messages(slack_event_drain_timeout)
+
+
+@slack_event_endpoints.listener('after_server_stop')
+async def _close_slack_session(app, loop):
+    await close_slack_session()
+    _numerical.close()
+    if _journal is not None:
+        await _journal.close()
+
+
+def _run_in_background(coroutine, request=None):
+    """Run coroutine without waiting for it. The event of request, if given, is only complete once it is done."""
+    task = asyncio.ensure_future(coroutine)
+    _background_tasks.add(task)
+    event_id = request['args'].get('event_id') if request is not None else None
+    if event_id is not None:
+        _hold_event(event_id)
+    task.add_done_callback(lambda done: _background_task_done(done, event_id))
+
+
+def _background_task_done(task: asyncio.Future, event_id: Optional[str]):
+    _background_tasks.discard(task)
+    if event_id is not None:
+        _release_event(event_id, not task.cancelled())
+    # Nothing awaits these tasks, so their failures would otherwise only surface when they are garbage collected
+    if not task.cancelled() and task.exception() is not None:
+        _LOGGER.error("Background task %r failed", task, exc_info=task.exception())
+
+
+async def _call_responder(bot_id, api_endpoint, request, on_delay=None):
+    # Responder endpoints are blocking, keep them off the event loop
+    def call():
+        return asyncio.get_event_loop().run_in_executor(_responder_executor, api_endpoint, request)
+
+    with STAGE_SECONDS.time('responder'), span('responder:' + api_endpoint.__name__.lstrip('_')):
+        try:
+            return await _responder_scheduler.run(bot_id, call, _RESPONDER_COSTS.get(api_endpoint, 1.0), on_delay,
+                                                  slack_tenant_busy_notice)
+        except TenantBusy:
+            raise UserException("Sorry, I'm very busy right now, please try again in a minute.")
+
+
+async def _get_session(bot: Bot, channel: str) -> Optional[ChannelSession]:
+    return await _state.aget(('session', bot.bot_id, channel))
+
+
+async def _save_session(bot: Bot, channel: str, session: ChannelSession):
+    await _state.aset(('session', bot.bot_id, channel), session, slack_state_ttl)
 
 
 def _needs_question(wrapped):
     @wraps(wrapped)
-    def decorated(bot, channel, *args):
+    async def decorated(bot, channel, *args):
 
-        if bot.bot_id not in _last_answer or channel not in _last_answer[bot.bot_id]:
-            send_slack_message(bot.bot_token, channel, "Please ask a question first.")
+        session = await _get_session(bot, channel)
+        if session is None or session.cursor is None:
+            await post_message(bot.bot_token, channel, "Please ask a question first.")
             return
         else:
-            return wrapped(bot, channel, *args)
+            return await wrapped(bot, channel, *args)
 
     return decorated
 
 
-def _help(bot, channel, *args):
-    send_slack_message(bot.bot_token, channel, """Hi, I am *Capebot*, I will answer all your questions, I will learn from you and your documents and improve over time.
+@command(".help", ".man")
+async def _help(bot, channel, *args):
+    await post_message(bot.bot_token, channel, """Hi, I am *Capebot*, I will answer all your questions, I will learn from you and your documents and improve over time.
 Here are my commands:
 
     *.add* _question_ | _answer_ - Create a new saved reply.
+    *.import* - Create saved replies from a text file, one _question_ | _answer_ per line.
+    *.learn* #channel - Learn saved replies from the questions answered in a channel (workspace admins only).
     *.next* - Show the next possible answer for the last question.
     *.why* - Explain why the last answer was given.
     *.help* - Display this message.
 
 You can also :
 
-    *Add* a Slack emoji reaction to bot answers with :thumbsup: or :smiley:, I will remember and improve over time. 
-    *Upload* text and markdown documents by sending them to me in a private message. I will read them when answering.
+    *Add* a Slack emoji reaction to bot answers with :thumbsup: or :smiley:, I will remember and improve over time.
+    *Upload* text, markdown and HTML documents by sending them to me in a private message, I'll use them to answer.
     *Ask* me to calculate, for example `what is 3+2?`.
 
 For more options login to your account at https://thecape.ai.
     """)
 
 
-def _process_bot_message_event(bot: Bot, event: dict):
-    if event.get('subtype', None) != 'bot_message' or 'channel' not in event or 'ts' not in event:
-        return
-    _BOT_TS_TO_MESSAGE[bot.bot_id, event['channel'], event['ts']] = event['text']
+async def _fetch_responder_api(bot_id, api_endpoint, request, on_delay=None) -> dict:
+    return json.loads((await _call_responder(bot_id, api_endpoint, request, on_delay)).body)
 
 
-def _process_answer(bot: Bot, channel: str, question: str, answer: dict):
-    _BOT_MESSAGE_TO_ANSWER[bot.bot_id, channel, answer['answerText']] = {'question': question, 'answer': answer}
+def _busy_notice(bot, channel):
+    # Called when a question waits for the bot's turn, the answer follows
+    return lambda: asyncio.ensure_future(post_message(bot.bot_token, channel,
+                                                      "I'm a bit busy right now, I'll answer shortly.",
+                                                      PRIORITY_NOTICE))
 
 
-def _process_responder_api(bot, channel, api_endpoint, request) -> Optional[dict]:
+async def _process_responder_api(bot, channel, api_endpoint, request, cached_question=None) -> Optional[dict]:
     try:
-        response = json.loads(api_endpoint(request).body)
+        if cached_question is None:
+            response = await _fetch_responder_api(bot.bot_id, api_endpoint, request)
+        else:
+            response = await _answer_cache.get_or_fetch(bot.bot_id, cached_question,
+                                                        (request['args'].get('numberofitems'),
+                                                         request['args'].get('offset')),
+                                                        lambda: _fetch_responder_api(bot.bot_id, api_endpoint, request,
+                                                                                     _busy_notice(bot, channel)),
+                                                        cacheable=lambda result: result['success'])
     except UserException as e:
-        send_slack_message(bot.bot_token, channel, e.message + ERROR_HELP_MESSAGE)
+        await post_message(bot.bot_token, channel, e.message + bots_common().ERROR_HELP_MESSAGE)
         return None
     if response['success']:
         return response
     else:
-        send_slack_message(bot.bot_token, channel, response['result']['message'] + ERROR_HELP_MESSAGE)
+        await post_message(bot.bot_token, channel,
+                           response['result']['message'] + bots_common().ERROR_HELP_MESSAGE)
         return None
 
 
-def _get_question_answer(bot: Bot, channel: str, ts: str):
-    if _BOT_TS_TO_MESSAGE.get((bot.bot_id, channel, ts), None):
-        return _BOT_MESSAGE_TO_ANSWER.get((bot.bot_id, channel, _BOT_TS_TO_MESSAGE[bot.bot_id, channel, ts]), None)
+def _copy_request(request, **args):
+    # Concurrent responder calls each need their own arguments
+    copied = copy.copy(request)
+    copied['args'] = dict(request['args'], **args)
+    return copied
+
+
+async def _try_responder_api(bot_id, api_endpoint, request,
+                             slots: asyncio.Semaphore) -> Tuple[Optional[dict], Optional[str]]:
+    """The result of a responder call, or its error message."""
+    async with slots:
+        try:
+            response = await _fetch_responder_api(bot_id, api_endpoint, request)
+        except UserException as e:
+            return None, e.message
+    if response['success']:
+        return response['result'], None
+    return None, response['result']['message']
 
 
-def _remove_question_answer(bot: Bot, channel: str, ts: str):
-    del _BOT_MESSAGE_TO_ANSWER[bot.bot_id, channel, _BOT_TS_TO_MESSAGE[bot.bot_id, channel, ts]]
+async def _save_reply(bot_id, request, questions: List[str], answer: str,
+                      slots: asyncio.Semaphore) -> List[Optional[str]]:
+    """Create a saved reply and add its paraphrases concurrently.
 
+    Returns the error message of each question, None for those saved. When the saved reply itself can't be created,
+    every question has its error.
+    """
+    result, error = await _try_responder_api(bot_id, responder_create_saved_reply,
+                                             _copy_request(request, question=questions[0], answer=answer), slots)
+    if error is not None:
+        return [error] * len(questions)
+    # we do lower() for all parameters
+    paraphrases = await asyncio.gather(*(
+        _try_responder_api(bot_id, responder_add_paraphrase_question,
+                           _copy_request(request, question=question, replyid=result['replyId']), slots)
+        for question in questions[1:]))
+    return [None] + [error for result, error in paraphrases]
 
-def _get_last_answer(bot, channel):
-    if bot.bot_id not in _last_answer or channel not in _last_answer[bot.bot_id]:
+
+def _parse_saved_reply(message: str) -> Optional[Tuple[List[str], str]]:
+    question_answer = [qa.strip() for qa in message.split('|')]
+    if len(question_answer) < 2:
         return None
-    return _previous_answers[bot.bot_id][channel][_last_answer[bot.bot_id][channel]]
+    return question_answer[:-1], question_answer[-1]
 
 
-def _add_saved_reply(bot, channel, request, message):
-    try:
-        if message.startswith("."):
-            message = message[NON_WORD_CHARS.search(message).end():]
-        question_answer = [qa.strip() for qa in message.split('|')]
-        if len(question_answer) < 2:
-            raise IndexError()
-    except IndexError:
-        send_slack_message(bot.bot_token, channel,
+# Also covers .addSavedReply, .add_saved_reply and .add-saved-reply
+@command(".add", ".new")
+async def _add_saved_reply(bot, channel, request, message):
+    if message.startswith("."):
+        message = message[bots_common().NON_WORD_CHARS.search(message).end():]
+    saved_reply = _parse_saved_reply(message)
+    if saved_reply is None:
+        await post_message(bot.bot_token, channel,
                            "Sorry, I didn't understand that. The usage for `.add` is: "
                            ".add question | answer")
         return
 
-    request['user'] = User.get('user_id', bot.user_id)
-    questions = question_answer[:-1]
-    answer = question_answer[-1]
-    request['args']['question'] = questions[0]
-    request['args']['answer'] = answer
-    response = _process_responder_api(bot, channel, responder_create_saved_reply, request)
-    if not response:
+    request['user'] = await get_user(bot.user_id)
+    questions, answer = saved_reply
+    errors = await _save_reply(bot.bot_id, request, questions, answer, asyncio.Semaphore(slack_paraphrase_concurrency))
+    if errors[0] is not None:
+        await post_message(bot.bot_token, channel, errors[0] + bots_common().ERROR_HELP_MESSAGE)
         return
-    reply_id = response['result']['replyId']
-    for question in questions[1:]:
-        request['args']['question'] = question
-        request['args']['replyid'] = reply_id  # we do lower() for all parameters
-        if not _process_responder_api(bot, channel, responder_add_paraphrase_question, request):
-            return
-    if len(questions) == 1:
-        questions_text = f'_{questions[0]}_\n'
+    await _answer_cache.invalidate(bot.bot_id)
+    saved = [question for question, error in zip(questions, errors) if error is None]
+    if len(saved) == 1:
+        questions_text = f'_{saved[0]}_\n'
     else:
         questions_text = ''
-        for question in questions:
+        for question in saved:
             questions_text += f'•_{question}_\n'
-    send_slack_message(bot.bot_token, channel,
-                       f"Thanks, I'll remember that:\n{questions_text}>>>{answer}")
+    failed = [(question, error) for question, error in zip(questions, errors) if error is not None]
+    if failed:
+        questions_text += "but I couldn't add:\n"
+        for question, error in failed:
+            questions_text += f'•_{question}_ ({error})\n'
+    await post_message(bot.bot_token, channel,
+                       f"Thanks, I'll remember that:\n{questions_text}>>>{answer}", PRIORITY_NOTICE,
+                       coalesce=True)
+
+
+@command(".import")
+async def _import_usage(bot, channel, *args):
+    await post_message(bot.bot_token, channel,
+                       "To import saved replies, share a text file with me with `.import` as its message. Each line "
+                       "of the file is a saved reply, written as for `.add`: question | answer")
+
+
+async def _import_saved_replies(bot, channel, slack_file, request):
+    progress = ProgressMessage(bot.bot_token, channel)
+    try:
+        await _import_file(bot, slack_file, request, progress)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        # Logged once the task is done
+        await progress.update(f"Sorry, something went wrong while importing _{slack_file['name']}_.", final=True)
+        raise
+
+
+async def _import_file(bot, slack_file, request, progress: ProgressMessage):
+    name = slack_file['name']
+    async with _get_ingestion_slots():
+        download = await _download_file(bot, slack_file, progress)
+    if download is None:
+        return
+    lines = [(number, line) for number, line in enumerate(download[0].splitlines(), 1)
+             if line.strip() and not line.lstrip().startswith('#')]
+    request['user'] = await get_user(bot.user_id)
+    slots = asyncio.Semaphore(slack_paraphrase_concurrency)
+    failures = []
+    imported = 0
+
+    async def import_line(number, line):
+        nonlocal imported
+        saved_reply = _parse_saved_reply(line)
+        if saved_reply is None:
+            failures.append((number, "expected question | answer"))
+            return
+        errors = await _save_reply(bot.bot_id, request, saved_reply[0], saved_reply[1], slots)
+        if errors[0] is None:
+            imported += 1
+        for error in errors:
+            if error is not None:
+                failures.append((number, error))
+                break
+        await progress.update(f"Importing saved replies from _{name}_... {imported + len(failures)} of {len(lines)}")
+
+    try:
+        with ACTION_SECONDS.time('import'):
+            await asyncio.gather(*(import_line(number, line) for number, line in lines))
+    finally:
+        if imported:
+            await _answer_cache.invalidate(bot.bot_id)
+    summary = f"Imported {imported} saved replies from _{name}_."
+    if failures:
+        failures.sort()
+        summary += f" {len(failures)} lines failed:\n" + ''.join(
+            f"•line {number}: {error}\n" for number, error in failures[:10])
+        if len(failures) > 10:
+            summary += f"and {len(failures) - 10} more."
+    await progress.update(summary.rstrip(), final=True)
+
+
+@command(".learn")
+async def _learn(bot, channel, request, message):
+    mention = _CHANNEL_MENTION.search(message)
+    if mention is None:
+        await post_message(bot.bot_token, channel,
+                           "To learn saved replies from the questions answered in a channel, use: .learn #channel")
+        return
+    source = mention.group(1)
+    if not await _is_workspace_admin(bot, request['args']['event'].get('user')):
+        await post_message(bot.bot_token, channel, "Sorry, only workspace admins can ask me to learn from a channel.")
+        return
+    if (bot.bot_id, source) in _learning:
+        await post_message(bot.bot_token, channel, f"I'm already learning from <#{source}>.")
+        return
+    _learning.add((bot.bot_id, source))
+    _run_in_background(_learn_channel(bot, channel, source, request), request)
 
 
+async def _is_workspace_admin(bot, user_id) -> bool:
+    if not user_id:
+        return False
+    response = await fetch_slack_user_info(bot.bot_token, user_id)
+    user = response.get('user', {})
+    return bool(response.get('ok') and (user.get('is_admin') or user.get('is_owner')))
+
+
+async def _learn_channel(bot, channel, source, request):
+    """Save the questions answered in a channel as saved replies, a page of its history at a time.
+
+    Progress is saved after every page, so that an interrupted run resumes where it stopped when asked again. The
+    pairs of a page are saved again if the run stops before the page is done.
+    """
+    key = ('learn', bot.bot_id, source)
+    history = ChannelHistory(bot.bot_token, source, slack_learn_rate, slack_learn_page_size)
+    progress = ProgressMessage(bot.bot_token, channel)
+    slots = asyncio.Semaphore(slack_paraphrase_concurrency)
+    learned = 0
+    following = None
+    try:
+        checkpoint = await _state.aget(key)
+        if checkpoint is None or checkpoint.done:
+            # Only the messages posted since the last run
+            checkpoint = HistoryCheckpoint(checkpoint.newest if checkpoint is not None else None)
+        request['user'] = await get_user(bot.user_id)
+        with ACTION_SECONDS.time('learn'):
+            while not checkpoint.done:
+                await progress.update(f"Learning from <#{source}>... {checkpoint.learned} saved replies from "
+                                      f"{checkpoint.read} messages so far")
+                messages, cursor = await history.page(checkpoint.cursor, checkpoint.oldest)
+                if checkpoint.newest is None and messages:
+                    checkpoint.newest = messages[0]['ts']
+                pairs = await history.question_answers(messages, following)
+                following = messages[-1] if messages else None
+                results = await asyncio.gather(*(_save_reply(bot.bot_id, request, [question], answer, slots)
+                                                 for question, answer in pairs))
+                saved = sum(1 for errors in results if errors[0] is None)
+                learned += saved
+                checkpoint.learned += saved
+                checkpoint.read += len(messages)
+                checkpoint.cursor = cursor
+                checkpoint.done = cursor is None
+                await _state.aset(key, checkpoint, slack_learn_checkpoint_ttl)
+    except SlackHistoryError as e:
+        hint = " Please invite me to the channel first." if e.error == 'not_in_channel' else ""
+        await progress.update(f"Sorry, I couldn't read <#{source}> ({e.error}).{hint}", final=True)
+        return
+    except asyncio.CancelledError:
+        # Resumed from the checkpoint when asked again
+        raise
+    except Exception:
+        # Logged once the task is done
+        await progress.update(f"Sorry, something went wrong while learning from <#{source}>.", final=True)
+        raise
+    finally:
+        _learning.discard((bot.bot_id, source))
+        if learned:
+            await _answer_cache.invalidate(bot.bot_id)
+    if checkpoint.read:
+        await progress.update(f"Learned {checkpoint.learned} saved replies from the {checkpoint.read} messages read in "
+                              f"<#{source}>.", final=True)
+    else:
+        await progress.update(f"There are no new messages in <#{source}> since I last learned from it.", final=True)
+
+
+@command(".next", ".more")
 @_needs_question
-def _next(bot, channel, *args):
-    next_answer = _last_answer[bot.bot_id][channel] + 1
-    if next_answer < len(_previous_answers[bot.bot_id][channel]):
-        answer = _previous_answers[bot.bot_id][channel][next_answer]
-        _process_answer(bot, channel, _LAST_QUESTION[bot.bot_id, channel], answer)
-        response = send_slack_message(bot.bot_token, channel, answer['answerText'])
-        _BOT_TS_TO_MESSAGE[bot.bot_id, channel, response['message']['ts']] = answer['answerText']
-        _last_answer[bot.bot_id][channel] = next_answer
+async def _next(bot, channel, request, *args):
+    session = await _get_session(bot, channel)
+    question, offset = session.question, session.offset
+    next_answer = session.cursor + 1
+    if next_answer >= len(session.answers) and offset is not None:
+        page = await _fetch_answers(bot, channel, request, question, offset)
+        if page is None:
+            return
+        # Read again, another event (e.g. a new question, from another worker) may have changed it meanwhile
+        session = await _get_session(bot, channel)
+        if session is None or session.question != question:
+            return
+        if session.offset == offset:
+            session.answers += page[0]
+            session.offset = page[1]
+        next_answer = session.cursor + 1
+    if next_answer < len(session.answers):
+        answer = session.answers[next_answer]
+        session.show(next_answer)
+        await _save_session(bot, channel, session)
+        response = await post_message(bot.bot_token, channel, answer.text, PRIORITY_ANSWER)
+        if response.get('ok'):
+            await _add_posted(bot, channel, response['ts'], question, answer)
     else:
-        send_slack_message(bot.bot_token, channel, "I'm afraid I've run out of answers to that question.")
+        await _save_session(bot, channel, session)
+        await post_message(bot.bot_token, channel, "I'm afraid I've run out of answers to that question.")
 
 
+async def _add_posted(bot, channel, ts, question, answer):
+    # Read again rather than saving the session read before posting, which may have changed meanwhile
+    session = await _get_session(bot, channel)
+    if session is not None:
+        session.add_posted(ts, question, answer)
+        await _save_session(bot, channel, session)
+
+
+@command(".explain", ".why", ".context", ".conf", ".score", ".index")
 @_needs_question
-def _explain(bot, channel, *args):
-    previous = _get_last_answer(bot, channel)
-    if previous['sourceType'] == 'document':
-        context = previous["answerContext"]
-        local_start_offset = previous['answerTextStartOffset'] - previous['answerContextStartOffset']
-        local_end_offset = previous['answerTextEndOffset'] - previous['answerContextStartOffset']
+async def _explain(bot, channel, *args):
+    previous = (await _get_session(bot, channel)).last_answer
+    if previous is None:
+        # The last question had no answer
+        await post_message(bot.bot_token, channel, "I didn't find an answer to your last question.")
+    elif previous.source_type == 'document':
+        context = previous.context
+        local_start_offset = previous.text_start - previous.context_start
+        local_end_offset = previous.text_end - previous.context_start
         bold_text = context[local_start_offset:local_end_offset].replace('\n', '')
         context = f"{context[:local_start_offset]} *{bold_text}* {context[local_end_offset:]}"
-        send_slack_message(bot.bot_token, channel,
-                           f"From _{previous['sourceId']}_ (Index {previous['confidence']:.2f})\n>>>{context}")
+        await post_message(bot.bot_token, channel,
+                           f"From _{previous.source_id}_ (Index {previous.confidence:.2f})\n>>>{context}")
     else:
-        send_slack_message(bot.bot_token, channel,
-                           f"I thought you asked (Index {previous['confidence']:.2f})\n_{previous['matchedQuestion']}_\n>>>{previous['answerText']}")
+        await post_message(bot.bot_token, channel,
+                           f"I thought you asked (Index {previous.confidence:.2f})\n_{previous.matched_question}_\n>>>{previous.text}")
 
 
-def _process_positive_reaction(bot: Bot, request, event: dict) -> Optional[bool]:
+async def _process_positive_reaction(bot: Bot, request, event: dict) -> Optional[bool]:
     if event['type'] != 'reaction_added':
         return None
-    if event['reaction'] not in {'smiley', 'smile', 'wink', 'simple_smile', 'grinning', 'kissing', 'laughing',
-                                 'satisfied', 'thumbsup', 'ok_hand', '+1', 'v', 'point_up', 'point_up_2', 'clap',
-                                 'muscle', 'raised_hands', 'arrow_up', 'up', 'ok', 'new', 'top', 'cool', '100',
-                                 'heavy_check_mark', 'ballot_box_with_check', 'white_check_mark'}:
+    if event['reaction'] not in POSITIVE_REACTIONS:
         return False
     channel = event['item']['channel']
-    question_answer = _get_question_answer(bot, channel, event['item']['ts'])
+    session = await _get_session(bot, channel)
+    question_answer = session.pop_posted(event['item']['ts']) if session is not None else None
     if not question_answer:
         return None
-    _remove_question_answer(bot, channel, event['item']['ts'])
-    question = question_answer['question']
-    last_answer = question_answer['answer']
-    if last_answer['sourceType'] == 'saved_reply':
-        if last_answer['confidence'] == 1.0:
-            send_slack_message(bot.bot_token, channel,
-                               f"Thanks for the feedback.\n_{question}_\n>>>{last_answer['answerText']}")
+    # Learn from an answer only once
+    await _save_session(bot, channel, session)
+    question = question_answer.question
+    last_answer = question_answer.answer
+    if last_answer.source_type == 'saved_reply':
+        if last_answer.confidence == 1.0:
+            await post_message(bot.bot_token, channel,
+                               f"Thanks for the feedback.\n_{question}_\n>>>{last_answer.text}", PRIORITY_NOTICE,
+                               coalesce=True)
             return True
-        request['user'] = User.get('user_id', bot.user_id)
+        request['user'] = await get_user(bot.user_id)
         request['args']['question'] = question.strip()
-        request['args']['replyid'] = last_answer['sourceId']  # we do lower() for all parameters
-        if _process_responder_api(bot, channel, responder_add_paraphrase_question, request):
-            send_slack_message(bot.bot_token, channel,
-                               f"Thanks, I'll remember that:\n_{question}_\n>>>{last_answer['answerText']}")
+        request['args']['replyid'] = last_answer.source_id  # we do lower() for all parameters
+        if await _process_responder_api(bot, channel, responder_add_paraphrase_question, request):
+            await _answer_cache.invalidate(bot.bot_id)
+            await post_message(bot.bot_token, channel,
+                               f"Thanks, I'll remember that:\n_{question}_\n>>>{last_answer.text}", PRIORITY_NOTICE,
+                               coalesce=True)
         return True
-    elif last_answer['sourceType'] == 'document':
-        request['user'] = User.get('user_id', bot.user_id)
+    elif last_answer.source_type == 'document':
+        request['user'] = await get_user(bot.user_id)
         request['args']['question'] = question.strip()
-        request['args']['answer'] = last_answer['answerText'].strip()
-        if _process_responder_api(bot, channel, responder_create_saved_reply, request):
-            send_slack_message(bot.bot_token, channel,
-                               f"Thanks, I'll remember that:\n_{question}_\n>>>{last_answer['answerText']}")
+        request['args']['answer'] = last_answer.text.strip()
+        if await _process_responder_api(bot, channel, responder_create_saved_reply, request):
+            await _answer_cache.invalidate(bot.bot_id)
+            await post_message(bot.bot_token, channel,
+                               f"Thanks, I'll remember that:\n_{question}_\n>>>{last_answer.text}", PRIORITY_NOTICE,
+                               coalesce=True)
         return True
     else:
-        send_slack_message(bot.bot_token, channel,
-                           f"Thanks for the feedback.\n_{question}_\n>>>{last_answer['answerText']}")
+        await post_message(bot.bot_token, channel,
+                           f"Thanks for the feedback.\n_{question}_\n>>>{last_answer.text}", PRIORITY_NOTICE,
+                           coalesce=True)
         return True
 
 
-def _echo(bot, channel, request, message):
+async def _echo(bot, channel, request, message):
     if message.startswith(".echo"):
-        _ECHO_MODE[bot.bot_id, channel] = not _ECHO_MODE.get((bot.bot_id, channel), False)
-        send_slack_message(bot.bot_token, channel, "Echo mode toggled")
+        session = await _get_session(bot, channel) or ChannelSession()
+        session.echo = not session.echo
+        await _save_session(bot, channel, session)
+        await post_message(bot.bot_token, channel, "Echo mode toggled", PRIORITY_NOTICE, coalesce=True)
     else:
-        send_slack_message(bot.bot_token, channel, message)
+        await post_message(bot.bot_token, channel, message)
 
 
-def _answer(bot, channel, request, question):
-    user = User.get('user_id', bot.user_id)
-    request['args']['token'] = user.token
+async def _answer_request(bot, request, question, offset):
+    request['args']['token'] = (await get_user(bot.user_id)).token
     request['args']['question'] = question
-    request['args']['numberofitems'] = '5'
-    response = _process_responder_api(bot, channel, responder_answer, request)
+    request['args']['numberofitems'] = str(min(slack_answer_page_size, slack_answer_max - offset))
+    request['args']['offset'] = str(offset)
+    return request
+
+
+def _answer_page(response, offset) -> Tuple[Tuple[Answer, ...], Optional[int]]:
+    """The answers in a responder response, and the offset of the next page if there may be one."""
+    answers = tuple(Answer.from_response(item) for item in response['result']['items'])
+    offset += len(answers)
+    if len(answers) < slack_answer_page_size or offset >= slack_answer_max:
+        return answers, None
+    return answers, offset
+
+
+async def _fetch_answers(bot, channel, request, question,
+                         offset) -> Optional[Tuple[Tuple[Answer, ...], Optional[int]]]:
+    request = await _answer_request(bot, request, question, offset)
+    response = await _process_responder_api(bot, channel, responder_answer, request, cached_question=question)
     if not response:
-        return
-    answers = response['result']['items']
-    if bot.bot_id not in _previous_answers:
-        _previous_answers[bot.bot_id] = {}
-        _last_answer[bot.bot_id] = {}
-    _previous_answers[bot.bot_id][channel] = answers
-    _last_answer[bot.bot_id][channel] = 0
-    _LAST_QUESTION[bot.bot_id, channel] = question
-    if not answers or answers[0]['confidence'] < NUMERICAL_EXPRESSION_THRESHOLD:
-        numerical_answer = try_numerical_answer(question)
-        if numerical_answer:
-            answers.insert(0, {"answerText": numerical_answer[0] + "=" + numerical_answer[1],
-                               "confidence": 0.80,
-                               "sourceType": "numerical",
-                               "sourceId": str(uuid4()),
-                               "matchedQuestion": f"What is {numerical_answer[0]} ?"
-                               })
+        return None
+    return _answer_page(response, offset)
+
+
+async def _prefetch_answers(bot, request, question, offset):
+    # Only warms the answer cache, .next picks the page up from there if it is ever typed
+    request = await _answer_request(bot, request, question, offset)
+    try:
+        await _answer_cache.get_or_fetch(bot.bot_id, question, (request['args']['numberofitems'], str(offset)),
+                                         lambda: _fetch_responder_api(bot.bot_id, responder_answer, request),
+                                         cacheable=lambda result: result['success'])
+    except UserException:
+        pass
+
+
+async def _answer(bot, channel, request, question):
+    # Evaluate any arithmetic while the responder is answering, it is only used when the responder isn't confident
+    numerical = asyncio.ensure_future(_numerical.evaluate(question)) if _NUMERICAL_HINT.search(question) else None
+    try:
+        page = await _fetch_answers(bot, channel, request, question, 0)
+        if page is None:
+            return
+        answers, offset = page
+        if numerical is not None and \
+                (not answers or answers[0].confidence < bots_common().NUMERICAL_EXPRESSION_THRESHOLD):
+            numerical_answer = await numerical
+            if numerical_answer:
+                answers = (Answer(text=numerical_answer[0] + "=" + numerical_answer[1],
+                                  confidence=0.80,
+                                  source_type="numerical",
+                                  source_id=str(uuid4()),
+                                  matched_question=f"What is {numerical_answer[0]} ?"),) + answers
+    finally:
+        if numerical is not None:
+            numerical.cancel()
+    session = await _get_session(bot, channel) or ChannelSession()
+    session.ask(question, answers, offset)
+    await _save_session(bot, channel, session)
     if len(answers) == 0:
-        send_slack_message(bot.bot_token, channel, "Sorry! I don't know the answer to that.")
+        await post_message(bot.bot_token, channel, "Sorry! I don't know the answer to that.")
     else:
-        _process_answer(bot, channel, question, answers[0])
-        response = send_slack_message(bot.bot_token, channel, answers[0]['answerText'])
-        _BOT_TS_TO_MESSAGE[bot.bot_id, channel, response['message']['ts']] = answers[0]['answerText']
-
-
-_ACTIONS = [
-    (lambda bot, channel, request, message: message.startswith(".echo") or _ECHO_MODE.get((bot.bot_id, channel), False),
-     _echo),
-    (lambda bot, channel, request, message: message.startswith(".add"), _add_saved_reply),
-    # Included in previous condition:
-    # (lambda bot, channel, request, message: message.startswith(".addSavedReply"), _add_saved_reply),
-    # (lambda bot, channel, request, message: message.startswith(".add_saved_reply"), _add_saved_reply),
-    # (lambda bot, channel, request, message: message.startswith(".add-saved-reply"), _add_saved_reply),
-    (lambda bot, channel, request, message: "|" in message, _add_saved_reply),
-    (lambda bot, channel, request, message: message.startswith(".new"), _add_saved_reply),
-    (lambda bot, channel, request, message: message.startswith(".help"), _help),
-    (lambda bot, channel, request, message: message.startswith(".man"), _help),
-    (lambda bot, channel, request, message: message.startswith(".next"), _next),
-    (lambda bot, channel, request, message: message.startswith(".more"), _next),
-    (lambda bot, channel, request, message: message.startswith(".explain"), _explain),
-    (lambda bot, channel, request, message: message.startswith(".why"), _explain),
-    (lambda bot, channel, request, message: message.startswith(".context"), _explain),
-    (lambda bot, channel, request, message: message.startswith(".conf"), _explain),
-    (lambda bot, channel, request, message: message.startswith(".score"), _explain),
-    (lambda bot, channel, request, message: message.startswith(".index"), _explain),
-    (lambda bot, channel, request, message: True, _answer),
-]
-
-
-def process_message(bot: Bot, event, request):
+        response = await post_message(bot.bot_token, channel, answers[0].text, PRIORITY_ANSWER)
+        if response.get('ok'):
+            await _add_posted(bot, channel, response['ts'], question, answers[0])
+        if slack_answer_prefetch and offset is not None:
+            _run_in_background(_prefetch_answers(bot, request, question, offset))
+
+
+async def process_message(bot: Bot, event, request):
     if 'subtype' in event:
         if event['subtype'] in {'bot_message', 'file_mention'}:
             # Don't reply to private messages from our self or other bots, don't reply to file_mentions
             return "200 OK"
         elif event['subtype'] == 'file_share':
-            process_file(event, request)
+            await process_file(event, request)
             return
         elif event['subtype'] == 'message_changed':
             event['text'] = event['message']['text']
@@ -306,49 +794,183 @@ def process_message(bot: Bot, event, request):
         return
     channel = event['channel']
     message = event['text'].replace("<@%s>" % bot.bot_id, "").strip()
-    message = re.sub("<mailto:[^|]*\|([^>]*)>", r"\1", message).strip()
-    for checker, action in _ACTIONS:
-        try:
-            checked = checker(bot, channel, request, message)
-        except Exception:
-            checked = False
-        if checked:
-            action(bot, channel, request, message)
-            break
+    message = _MAILTO_LINK.sub(r"\1", message).strip()
+    with STAGE_SECONDS.time('dispatch'):
+        session = await _get_session(bot, channel)
+        if message.startswith(".echo") or session is not None and session.echo:
+            action = _echo
+        else:
+            # Commands first, channel mentions (.learn <#C0123456|general>) contain a '|' too
+            action = find_command(message) or (_add_saved_reply if "|" in message else _answer)
+    with ACTION_SECONDS.time(action.__name__.lstrip('_')):
+        await action(bot, channel, request, message)
+
+
+async def process_tokens_revoked(event):
+    await _remove_bots(event['tokens'].get('bot', []))
 
 
-def process_tokens_revoked(event):
-    if 'bot' in event['tokens']:
-        for bot_id in event['tokens']['bot']:
-            bot = Bot.get('bot_id', bot_id)
-            bot.delete_instance()
+async def process_app_uninstalled(bot_id):
+    await _remove_bots([bot_id])
 
 
-def process_file(event, request):
+async def _remove_bots(bot_ids: List[str]):
+    """Delete bots and forget everything kept about them, bots already removed are ignored."""
+    if not bot_ids:
+        return
+    deleted = await delete_bots(bot_ids)
+    for bot_id in bot_ids:
+        await _state.adelete_group(('session', bot_id))
+        await _state.adelete_group(('learn', bot_id))
+        await _document_index.forget_bot(bot_id)
+        await _answer_cache.forget_bot(bot_id)
+    _LOGGER.info("Removed %d of %d bots", deleted, len(bot_ids))
+
+
+async def process_file(event, request):
     authed_users = required_parameter(request, 'authed_users')
     bot_id = authed_users[0]
     channel = event['channel']
-    bot = Bot.get('bot_id', bot_id)
-    slack_file = event['file']
-    if slack_file['filetype'] not in ['text', 'markdown']:
-        send_slack_message(bot.bot_token, channel, ERROR_FILE_TYPE_UNSUPPORTED)
+    bot = await get_bot(bot_id)
+    if bot is None:
+        return
+    slack_file = await _fetch_file_info(bot, event['file'])
+    if slack_file['filetype'] not in SUPPORTED_FILETYPES:
+        await post_message(bot.bot_token, channel, ERROR_FILE_TYPE_UNSUPPORTED)
+    elif slack_file.get('size', 0) > _max_bytes(slack_file):
+        await post_message(bot.bot_token, channel, _document_too_large(slack_file))
+    elif _IMPORT_COMMAND.search(event.get('text', '')):
+        _run_in_background(_import_saved_replies(bot, channel, slack_file, request), request)
+    elif await _document_index.unchanged_file(bot.bot_id, slack_file):
+        _LOGGER.info("Skipped downloading %s for %s, unchanged since it was indexed", slack_file['name'], bot.bot_id)
+        await post_message(bot.bot_token, channel, _document_unchanged(slack_file), PRIORITY_NOTICE)
     else:
-        text = get_slack_file_contents(bot.bot_token, slack_file['url_private'])
-        try:
-            request['user'] = User.get('user_id', bot.user_id)
-            request['args']['text'] = text
-            request['args']['title'] = slack_file['title']
-            request['args']['origin'] = slack_file['name']
+        # Reading and indexing a large document takes a while, acknowledge the event without waiting for it
+        _run_in_background(_ingest_file(bot, channel, slack_file, request), request)
+
+
+async def _fetch_file_info(bot, slack_file) -> dict:
+    # The event may only carry part of the file's metadata, and is stale when Slack retries it
+    try:
+        response = await fetch_slack_file_info(bot.bot_token, slack_file['id'])
+    except (SlackRateLimited, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        _LOGGER.warning("Failed to fetch file info of %s: %r", slack_file['id'], e)
+        return slack_file
+    return response['file'] if response.get('ok') else slack_file
+
+
+def _document_unchanged(slack_file) -> str:
+    return f"I've already read _{slack_file['name']}_, it hasn't changed since."
+
+
+def _max_bytes(slack_file) -> int:
+    return max_document_bytes(slack_file['filetype'], slack_document_max_bytes, slack_document_markup_max_bytes)
+
+
+def _document_too_large(slack_file) -> str:
+    return f"Sorry, _{slack_file['name']}_ is too large, I can read {slack_file['filetype']} documents of up to " \
+           f"{_max_bytes(slack_file) / (1024 * 1024):g} MB."
+
+
+def _get_ingestion_slots() -> asyncio.Semaphore:
+    global _ingestion_slots
+    if _ingestion_slots is None:
+        _ingestion_slots = asyncio.Semaphore(slack_document_concurrency)
+    return _ingestion_slots
+
+
+async def _download_file(bot, slack_file, progress: ProgressMessage) -> Optional[Tuple[str, str]]:
+    """Text and digest of a shared file, None (after telling the user) when it can't be read."""
+    name = slack_file['name']
+    await progress.update(f"Reading _{name}_...")
+
+    async def on_progress(received):
+        if slack_file.get('size'):
+            await progress.update(f"Reading _{name}_... {min(100, 100 * received // slack_file['size'])}%")
+
+    try:
+        return await read_slack_file(bot.bot_token, slack_file['url_private'], _max_bytes(slack_file), on_progress)
+    except DocumentTooLarge:
+        await progress.update(_document_too_large(slack_file), final=True)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        _LOGGER.warning("Failed to download %s: %r", name, e)
+        await progress.update(f"Sorry, I couldn't download _{name}_, please try again.", final=True)
+    return None
+
+
+async def _ingest_file(bot, channel, slack_file, request):
+    progress = ProgressMessage(bot.bot_token, channel)
+    try:
+        async with _get_ingestion_slots():
+            with ACTION_SECONDS.time('file_upload'):
+                await _index_file(bot, slack_file, request, progress)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        # Logged once the task is done
+        await progress.update(f"Sorry, something went wrong while reading _{slack_file['name']}_.", final=True)
+        raise
+
+
+async def _index_file(bot, slack_file, request, progress: ProgressMessage):
+    name = slack_file['name']
+    download = await _download_file(bot, slack_file, progress)
+    if download is None:
+        return
+    text, digest = download
+    if await _document_index.unchanged_content(bot.bot_id, slack_file, digest):
+        _LOGGER.info("Skipped indexing %s for %s, same content as when it was indexed", name, bot.bot_id)
+        await progress.update(_document_unchanged(slack_file), final=True)
+        return
+    parts = await asyncio.get_event_loop().run_in_executor(_document_executor, extract_parts, slack_file['filetype'],
+                                                           text, slack_document_part_chars)
+    del text
+    request['user'] = await get_user(bot.user_id)
+    previous_ids = await _document_index.part_ids(bot.bot_id, name)
+    part_ids = []
+    try:
+        for number, part in enumerate(parts, 1):
+            suffix = f' (part {number})' if number > 1 else ''
+            if len(parts) > 1:
+                await progress.update(f"Reading _{name}_... indexing part {number} of {len(parts)}")
+            request['args']['text'] = part
+            request['args']['title'] = slack_file['title'] + suffix
+            request['args']['origin'] = name + suffix
             request['args']['replace'] = 'true'
-            responder_upload_document(request)
-            send_slack_message(bot.bot_token, channel, BOT_FILE_UPLOADED)
-        except UserException as e:
-            send_slack_message(bot.bot_token, channel, e.message)
+            response = await _fetch_responder_api(bot.bot_id, responder_upload_document, request)
+            if not response['success']:
+                raise UserException(response['result']['message'])
+            part_ids.append(response['result']['documentId'])
+        # The parts of a previous version beyond those of this one would keep being answered from
+        await _delete_documents(bot, request, [document_id for document_id in previous_ids
+                                               if document_id not in part_ids])
+    except UserException as e:
+        await progress.update(e.message, final=True)
+        return
+    finally:
+        await _answer_cache.invalidate(bot.bot_id)
+    await _document_index.add(bot.bot_id, slack_file, digest, tuple(part_ids))
+    await progress.update(BOT_FILE_UPLOADED, final=True)
+
+
+async def _delete_documents(bot, request, document_ids: List[str]):
+    for document_id in document_ids:
+        response = await _fetch_responder_api(bot.bot_id, responder_delete_document,
+                                              _copy_request(request, documentid=document_id))
+        if not response['success']:
+            _LOGGER.warning("Failed to delete part %s of a document of %s: %s", document_id, bot.bot_id,
+                            response['result'].get('message'))
 
 
-@_endpoint_route('/events/receive-event')
 @respond_with_json
-def receive_event(request):
+def _respond(request, result):
+    # The Slack handlers are coroutines, so the JSON envelope is applied once they have finished
+    if isinstance(result, UserException):
+        raise result
+    return result
+
+
+async def _receive_event(request):
     challenge = optional_parameter(request, 'challenge', None)
     if challenge is not None:
         # Slack sends us a 'challenge' token when configuring the URL which we have to send back to confirm that we're
@@ -356,16 +978,143 @@ def receive_event(request):
         return challenge
     event = required_parameter(request, 'event')
     event_id = required_parameter(request, 'event_id')
-    if event_id in _processed_events:
+    bot_id = required_parameter(request, 'authed_users')[0]
+    _EVENTS.inc(event.get('type'))
+    if _journal is not None:
+        # Journaled before its id is claimed, a crash in between must not leave a claimed event that is never replayed.
+        # An exception leaves the event unacknowledged, so Slack will retry it
+        with STAGE_SECONDS.time('journal'):
+            # The verification token isn't needed to replay the event
+            journaled = await _journal.append(event_id, {k: v for k, v in request['args'].items() if k != 'token'})
+        if not journaled:
+            # A retry of an event this server has received already
+            _DUPLICATE_EVENTS.inc()
+            return "200 OK"
+    with STAGE_SECONDS.time('dedup'):
+        first = await _processed_events.add(event_id)
+    if not first:
         # We've already processed this event
+        if _journal is not None:
+            _journal.forget(event_id)
+        _DUPLICATE_EVENTS.inc()
         return "200 OK"
-    _processed_events.append(event_id)
-    bot: Bot = Bot.get('bot_id', required_parameter(request, 'authed_users')[0])
-    _process_bot_message_event(bot, event)
-    if _process_positive_reaction(bot, request, event):
-        return "200 OK"
-    if event['type'] == 'message' or event['type'] == 'app_mention' and 'subtype' not in event:
-        process_message(bot, event, request)
-    elif event['type'] == 'tokens_revoked':
-        process_tokens_revoked(event)
+    if _event_queue.running:
+        try:
+            with STAGE_SECONDS.time('enqueue'):
+                await _event_queue.put(_event_key(bot_id, event), _process_event, event_id, bot_id, event, request)
+        except EventQueueFull:
+            # Forget the event so that Slack's retry is processed
+            await _processed_events.discard(event_id)
+            if _journal is not None:
+                _journal.forget(event_id)
+            _SHED_EVENTS.inc()
+            raise
+    else:
+        await _process_event(event_id, bot_id, event, request)
     return "200 OK"
+
+
+def _event_key(bot_id, event) -> tuple:
+    # A channel's events are processed in the order they were received, e.g. a question before its .next
+    channel = event.get('channel') or event.get('item', {}).get('channel')
+    return bot_id, channel
+
+
+async def _process_event(event_id, bot_id, event, request):
+    _hold_event(event_id)
+    try:
+        with get_profiler().event(event):
+            await _process_bot_event(bot_id, event, request)
+    except asyncio.CancelledError:
+        # Cut short by a shutdown, the event is replayed on the next start
+        _release_event(event_id, False)
+        raise
+    except Exception:
+        # Replaying an event that failed would most likely fail again
+        _release_event(event_id, True)
+        raise
+    _release_event(event_id, True)
+
+
+def _hold_event(event_id):
+    if _journal is not None:
+        _event_holds[event_id] = _event_holds.get(event_id, 0) + 1
+
+
+def _release_event(event_id, finished: bool):
+    holds = _event_holds.pop(event_id, None)
+    if holds is None or not finished:
+        # Not journaled, or part of the event was cut short by a shutdown and it is replayed on the next start
+        return
+    if holds > 1:
+        _event_holds[event_id] = holds - 1
+    else:
+        _journal.complete(event_id)
+
+
+async def _process_bot_event(bot_id, event, request):
+    # Handled whether the bots are known or not, so that a repeated revocation or uninstall is harmless
+    if event['type'] == 'tokens_revoked':
+        await process_tokens_revoked(event)
+        return
+    if event['type'] == 'app_uninstalled':
+        await process_app_uninstalled(bot_id)
+        return
+    with STAGE_SECONDS.time('bot_lookup'):
+        bot = await get_bot(bot_id)
+    if bot is None:
+        # Unknown or uninstalled bot
+        return
+    with STAGE_SECONDS.time('reaction'):
+        if await _process_positive_reaction(bot, request, event):
+            return
+    if event['type'] == 'message' or event['type'] == 'app_mention' and 'subtype' not in event:
+        await process_message(bot, event, request)
+
+
+@_endpoint_route('/events/receive-event')
+async def receive_event(request):
+    # Before anything else looks at the request, so that forged or replayed events cost next to nothing
+    if verify_request(request.headers, request.body) is not None:
+        return text("Invalid request", status=401)
+    try:
+        with STAGE_SECONDS.time('receive'):
+            result = await _receive_event(request)
+    except UserException as e:
+        result = e
+    except EventQueueFull:
+        return text("Busy, please retry", status=503)
+    return _respond(request, result)
+
+
+async def _receive_socket_event(payload: dict) -> bool:
+    """Receive an event from the Socket Mode connection, returns whether it is acknowledged."""
+    if 'authed_users' not in payload and payload.get('authorizations'):
+        # Only the authorizations of the event are sent to apps created since authed_users was deprecated
+        payload['authed_users'] = [authorization['user_id'] for authorization in payload['authorizations']
+                                   if authorization.get('is_bot')]
+    try:
+        with STAGE_SECONDS.time('receive'):
+            await _receive_event(EventRequest(payload))
+    except UserException:
+        # Malformed, it would fail the same way when retried
+        _LOGGER.exception("Invalid Slack event received over Socket Mode")
+    except EventQueueFull:
+        return False
+    return True
+
+
+@slack_event_endpoints.route(URL_BASE + '/metrics', methods=['GET'])
+async def metrics(request):
+    if not slack_metrics_enabled:
+        raise NotFound("Metrics are disabled")
+    return text(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@slack_event_endpoints.route(URL_BASE + '/profile/slowest', methods=['GET'])
+async def slowest_events(request):
+    if not slack_profile_rate or not slack_profile_token:
+        raise NotFound("Profiling is disabled")
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + slack_profile_token):
+        return text("Unauthorized", status=401)
+    return json_response({'sampled': get_profiler().sampled, 'slowest': get_profiler().slowest_traces()})
@@ -0,0 +1,186 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional
+
+from cape_slack_plugin.slack_outbound import TokenBucket
+
+
+class TenantBusy(Exception):
+    """A bot has too many calls waiting already."""
+
+
+def parse_weights(setting: str) -> Dict[str, float]:
+    """Weights of bots given as 'bot_id=weight,bot_id=weight'."""
+    weights = {}
+    for item in setting.split(','):
+        if '=' in item:
+            bot_id, weight = item.split('=', 1)
+            weights[bot_id.strip()] = float(weight)
+    return weights
+
+
+class _Tenant:
+    __slots__ = ('bot_id', 'weight', 'bucket', 'running', 'waiting', 'last_tag')
+
+    def __init__(self, bot_id: str, weight: float, bucket: TokenBucket):
+        self.bot_id = bot_id
+        self.weight = weight
+        self.bucket = bucket
+        self.running = 0
+        self.waiting = deque()  # (tag, cost, future)
+        self.last_tag = 0.0
+
+
+class FairScheduler:
+    """Shares a limited number of concurrent calls fairly between bots.
+
+    Calls are admitted in order of their virtual finish time (start-time fair queueing): each call's tag is its
+    bot's previous tag, or the current virtual time if the bot was idle, plus its cost divided by the bot's weight.
+    A busy bot therefore only delays other bots by its fair share, whatever the number of calls it submits. On top of
+    that each bot is held to a concurrency limit and a token bucket rate, and refused once too many of its calls are
+    waiting.
+    """
+
+    def __init__(self, concurrency: int, bot_concurrency: int, bot_rate: float, bot_burst: float, max_waiting: int,
+                 weights: Optional[Dict[str, float]] = None):
+        self.concurrency = concurrency
+        self.bot_concurrency = bot_concurrency
+        self.bot_rate = bot_rate
+        self.bot_burst = bot_burst
+        self.max_waiting = max_waiting
+        self.weights = weights or {}
+        self.running = 0
+        self.rejected = 0
+        self.delayed = 0
+        self._virtual_time = 0.0
+        self._tenants = {}
+        self._backlogged = set()
+        self._timer = None
+
+    def waiting(self) -> int:
+        return sum(len(tenant.waiting) for tenant in self._backlogged)
+
+    def _tenant(self, bot_id: str) -> _Tenant:
+        tenant = self._tenants.get(bot_id)
+        if tenant is None:
+            tenant = self._tenants[bot_id] = _Tenant(bot_id, self.weights.get(bot_id, 1.0),
+                                                     TokenBucket(self.bot_rate, self.bot_burst))
+        return tenant
+
+    def _admissible(self, tenant: _Tenant, now: float) -> bool:
+        return tenant.running < self.bot_concurrency and tenant.bucket.delay(now) <= 0
+
+    async def run(self, bot_id: str, call: Callable[[], Awaitable], cost: float = 1.0,
+                  on_delay: Optional[Callable[[], None]] = None, delay_notice: float = 0.0):
+        """Await call() once it is the bot's turn. on_delay() is called if the call waits longer than delay_notice."""
+        tenant = self._tenant(bot_id)
+        tag = max(self._virtual_time, tenant.last_tag) + cost / tenant.weight
+        tenant.last_tag = tag
+        if not tenant.waiting and self.running < self.concurrency and self._admissible(tenant, time.monotonic()):
+            self._start(tenant, tag, cost)
+        else:
+            if len(tenant.waiting) >= self.max_waiting:
+                self.rejected += 1
+                tenant.last_tag -= cost / tenant.weight
+                self._forget(tenant)
+                raise TenantBusy()
+            await self._wait(tenant, tag, cost, on_delay, delay_notice)
+        try:
+            return await call()
+        finally:
+            tenant.running -= 1
+            self.running -= 1
+            self._forget(tenant)
+            self._dispatch()
+
+    async def _wait(self, tenant: _Tenant, tag: float, cost: float, on_delay, delay_notice: float):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        item = (tag, cost, future)
+        tenant.waiting.append(item)
+        self._backlogged.add(tenant)
+        notice = loop.call_later(delay_notice, self._notify_delay, future, on_delay) if on_delay else None
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Admitted just before being cancelled, give the slot back
+                tenant.running -= 1
+                self.running -= 1
+                self._dispatch()
+            elif item in tenant.waiting:
+                tenant.waiting.remove(item)
+                if not tenant.waiting:
+                    self._backlogged.discard(tenant)
+            self._forget(tenant)
+            raise
+        finally:
+            if notice is not None:
+                notice.cancel()
+
+    def _notify_delay(self, future: asyncio.Future, on_delay: Callable[[], None]):
+        if not future.done():
+            self.delayed += 1
+            on_delay()
+
+    def _start(self, tenant: _Tenant, tag: float, cost: float):
+        tenant.running += 1
+        self.running += 1
+        tenant.bucket.take(time.monotonic())
+        # The virtual time is the start tag of the last call admitted
+        self._virtual_time = max(self._virtual_time, tag - cost / tenant.weight)
+
+    def _forget(self, tenant: _Tenant):
+        # Idle bots whose allowance is full again have no state worth keeping
+        if not tenant.running and not tenant.waiting and tenant.bucket.full(time.monotonic()) and \
+                self._tenants.get(tenant.bot_id) is tenant:
+            del self._tenants[tenant.bot_id]
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        retry = None
+        while self.running < self.concurrency and self._backlogged:
+            now = time.monotonic()
+            best = None
+            for tenant in self._backlogged:
+                if tenant.running >= self.bot_concurrency:
+                    continue
+                delay = tenant.bucket.delay(now)
+                if delay > 0:
+                    retry = delay if retry is None else min(retry, delay)
+                    continue
+                if best is None or tenant.waiting[0][0] < best.waiting[0][0]:
+                    best = tenant
+            if best is None:
+                break
+            tag, cost, future = best.waiting.popleft()
+            if not best.waiting:
+                self._backlogged.discard(best)
+            if future.cancelled():
+                continue
+            self._start(best, tag, cost)
+            future.set_result(None)
+        if retry is not None and self._backlogged and self.running < self.concurrency:
+            self._timer = asyncio.get_event_loop().call_later(retry, self._dispatch)
+
+    def stats(self) -> dict:
+        return {'running': self.running, 'waiting': self.waiting(), 'tenants': len(self._tenants),
+                'rejected': self.rejected, 'delayed': self.delayed}
@@ -0,0 +1,159 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import re
+import time
+from typing import List, Optional, Tuple
+
+from cape_slack_plugin.slack_outbound import TokenBucket
+from cape_slack_plugin.slack_utils import slack_api_call, SlackRateLimited
+
+# Reactions taken as approval of a message, whether it is an answer of the bot or one found in a channel's history
+POSITIVE_REACTIONS = frozenset({'smiley', 'smile', 'wink', 'simple_smile', 'grinning', 'kissing', 'laughing',
+                                'satisfied', 'thumbsup', 'ok_hand', '+1', 'v', 'point_up', 'point_up_2', 'clap',
+                                'muscle', 'raised_hands', 'arrow_up', 'up', 'ok', 'new', 'top', 'cool', '100',
+                                'heavy_check_mark', 'ballot_box_with_check', 'white_check_mark'})
+
+_MENTION = re.compile(r"<[@!#][^>]*>")
+# Replies this short are acknowledgements rather than answers
+_MIN_ANSWER_CHARS = 10
+
+
+class SlackHistoryError(Exception):
+    def __init__(self, error: str):
+        super().__init__(f"Slack refused to read the channel's history: {error}")
+        self.error = error
+
+
+class ChannelHistory:
+    """Reads a channel's messages and threads, with calls spaced to stay within Slack's limits.
+
+    conversations.history and conversations.replies are tier 3 methods (50+ calls per minute per workspace), calls
+    that are rate limited anyway are retried once Slack says so.
+    """
+
+    def __init__(self, token: str, channel: str, rate: float, page_size: int = 200):
+        self.token = token
+        self.channel = channel
+        self.page_size = page_size
+        self.calls = 0
+        self._bucket = TokenBucket(rate, 1)
+
+    async def _call(self, method: str, **params) -> dict:
+        while True:
+            delay = self._bucket.delay(time.monotonic())
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            self._bucket.take(time.monotonic())
+            self.calls += 1
+            try:
+                response = await slack_api_call(method, self.token, **params)
+            except SlackRateLimited as e:
+                self._bucket.pause(e.retry_after)
+                continue
+            if not response.get('ok'):
+                raise SlackHistoryError(response.get('error', 'unknown'))
+            return response
+
+    async def page(self, cursor: Optional[str] = None,
+                   oldest: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        """A page of messages, newest first, and the cursor of the next (older) page, None after the last one."""
+        params = {'channel': self.channel, 'limit': str(self.page_size)}
+        if cursor:
+            params['cursor'] = cursor
+        if oldest:
+            params['oldest'] = oldest
+        response = await self._call('conversations.history', **params)
+        next_cursor = response.get('response_metadata', {}).get('next_cursor')
+        return response.get('messages', []), next_cursor if response.get('has_more') and next_cursor else None
+
+    async def replies(self, ts: str) -> List[dict]:
+        """The replies in a thread, oldest first."""
+        replies = []
+        cursor = None
+        while True:
+            params = {'channel': self.channel, 'ts': ts, 'limit': str(self.page_size)}
+            if cursor:
+                params['cursor'] = cursor
+            response = await self._call('conversations.replies', **params)
+            # The thread's parent comes first on every page
+            replies.extend(message for message in response.get('messages', []) if message.get('ts') != ts)
+            cursor = response.get('response_metadata', {}).get('next_cursor')
+            if not response.get('has_more') or not cursor:
+                return replies
+
+    async def question_answers(self, messages: List[dict],
+                               following: Optional[dict] = None) -> List[Tuple[str, str]]:
+        """Question and answer pairs in a page of messages (newest first), see find_question_answers()."""
+        threads = {}
+        for message in messages:
+            if message.get('reply_count') and _is_question(message):
+                threads[message['ts']] = await self.replies(message['ts'])
+        return find_question_answers(messages, threads, following)
+
+
+def _text(message: dict) -> str:
+    return _MENTION.sub('', message.get('text', '')).strip()
+
+
+def _by_person(message: dict) -> bool:
+    # Bot messages (including our answers), joins and other events aren't questions or answers
+    return message.get('type', 'message') == 'message' and 'subtype' not in message and 'bot_id' not in message \
+        and bool(message.get('user'))
+
+
+def _is_question(message: dict) -> bool:
+    return _by_person(message) and _text(message).endswith('?')
+
+
+def _approvals(message: dict) -> int:
+    return sum(reaction.get('count', 0) for reaction in message.get('reactions', ())
+               if reaction.get('name', '').split('::')[0] in POSITIVE_REACTIONS)
+
+
+def _is_answer(message: dict, question: dict) -> bool:
+    return _by_person(message) and message['user'] != question['user'] and len(_text(message)) >= _MIN_ANSWER_CHARS
+
+
+def find_question_answers(messages: List[dict], threads: dict,
+                          following: Optional[dict] = None) -> List[Tuple[str, str]]:
+    """Question and answer pairs in a page of a channel's history (newest first), given the replies of its threads
+    and the message following the page, if any (the oldest of the previous page).
+
+    A question is a message asked by a person ending with '?'. Its answer is the reply in its thread with the most
+    positive reactions, or the first reply by someone else, or when it has no thread, the next message in the
+    channel if it is by someone else and got a positive reaction.
+    """
+    pairs = []
+    seen = set()
+    chronological = messages[::-1] + ([following] if following is not None else [])
+    for index, message in enumerate(chronological[:len(messages)]):
+        if not _is_question(message):
+            continue
+        answer = None
+        replies = [reply for reply in threads.get(message['ts'], ()) if _is_answer(reply, message)]
+        if replies:
+            # The first reply if none was approved
+            answer = max(replies, key=_approvals)
+        elif index + 1 < len(chronological):
+            following = chronological[index + 1]
+            if _is_answer(following, message) and _approvals(following) and not following.get('thread_ts'):
+                answer = following
+        question = _text(message)
+        if answer is not None and question.lower() not in seen:
+            seen.add(question.lower())
+            pairs.append((question, _text(answer)))
+    return pairs
@@ -0,0 +1,235 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+from uuid import uuid4
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class EventRequest(dict):
+    """Stands in for the Sanic request of an event replayed from the journal or received over Socket Mode."""
+
+    def __init__(self, args: dict):
+        super().__init__(args=args)
+        self.json = args
+        self.body = json.dumps(args).encode()
+        self.headers = {}
+
+
+class EventJournal:
+    """Append-only SQLite (WAL) record of the events acknowledged to Slack, until they have been processed.
+
+    append() returns once the event is committed, so an event is never acknowledged before it is durable. Appends
+    and completions arriving while a commit is being written are committed together by the next one (group commit),
+    so the cost of a commit is shared by all the events received meanwhile. Processed events are kept, without their
+    payload, for the retention period so that the ids seen recently can be recovered after a restart.
+
+    Worker processes can share the file: events are owned by the journal that received them, and only replayed by a
+    journal that takes them over once their owner's lease has expired. Owners are random tokens rather than process
+    ids, which are reused e.g. when a container restarts, and renew their lease until they are closed.
+    """
+
+    def __init__(self, path: str, commit_interval: float, retention: float, lease: float = 30.0,
+                 max_attempts: int = 3):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.retention = retention
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.owner = uuid4().hex
+        self.commits = 0
+        self.appended = 0
+        # The connection is only used from this thread
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._connection = None
+        self._appends = []
+        self._completed = []
+        self._forgotten = []
+        self._waiters = []
+        self._scheduled = None
+        self._flushing = None
+        self._purged = 0.0
+        self._leased = 0.0
+        self._renewing = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            # Commits survive the process crashing, only an OS crash can lose the last ones
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS events (event_id TEXT PRIMARY KEY, received REAL NOT '
+                                     'NULL, payload TEXT, done INTEGER NOT NULL DEFAULT 0, attempts INTEGER NOT NULL '
+                                     'DEFAULT 0)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS events_received ON events (received)')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS owners (owner TEXT PRIMARY KEY, lease_until REAL NOT '
+                                     'NULL)')
+            columns = [row[1] for row in self._connection.execute('PRAGMA table_info(events)')]
+            if 'owner' not in columns:
+                # Journals written before workers could share them, their events are taken over by the first worker
+                try:
+                    self._connection.execute('ALTER TABLE events ADD COLUMN owner TEXT')
+                except sqlite3.OperationalError as e:
+                    # Added by another worker meanwhile
+                    if 'duplicate column' not in str(e):
+                        raise
+        return self._connection
+
+    def recover(self) -> Tuple[List[Tuple[str, float]], List[Tuple[str, dict]]]:
+        """Ids and reception times of the events received within the retention period, oldest first, and the payloads
+        of those that weren't processed. Events already replayed max_attempts times are given up."""
+        connection = self._connect()
+        now = time.time()
+        owner = self.owner
+        with connection:
+            # Taken over by a single worker when several recover at the same time
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('DELETE FROM events WHERE received < ?', (now - self.retention,))
+            connection.execute('DELETE FROM owners WHERE lease_until < ?', (now,))
+            self._write_lease(connection, now)
+            connection.execute('UPDATE events SET owner = ? WHERE done = 0 AND (owner IS NULL OR owner NOT IN '
+                               '(SELECT owner FROM owners))', (owner,))
+            abandoned = connection.execute('UPDATE events SET done = 1, payload = NULL WHERE done = 0 AND owner = ? '
+                                           'AND attempts >= ?', (owner, self.max_attempts)).rowcount
+            unfinished = [(event_id, json.loads(payload)) for event_id, payload in connection.execute(
+                'SELECT event_id, payload FROM events WHERE done = 0 AND owner = ? ORDER BY received', (owner,))]
+            connection.execute('UPDATE events SET attempts = attempts + 1 WHERE done = 0 AND owner = ?', (owner,))
+            seen = connection.execute('SELECT event_id, received FROM events ORDER BY received').fetchall()
+        if abandoned:
+            _LOGGER.warning("Gave up %d Slack events that failed to be processed %d times", abandoned,
+                            self.max_attempts)
+        return seen, unfinished
+
+    async def append(self, event_id: str, payload: dict) -> bool:
+        """Returns False if the event was already in the journal, e.g. a retry of an event still being processed."""
+        future = asyncio.get_event_loop().create_future()
+        self._appends.append((event_id, time.time(), json.dumps(payload), self.owner))
+        self._waiters.append(future)
+        self._schedule()
+        return await future
+
+    def start(self):
+        """Renew this journal's lease on its events until it is closed."""
+        if self._renewing is None:
+            self._renewing = asyncio.ensure_future(self._renew_lease())
+
+    async def _renew_lease(self):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                await asyncio.get_event_loop().run_in_executor(self._executor, self._renew)
+            except Exception:
+                _LOGGER.exception("Failed to renew the Slack event journal lease")
+
+    def _renew(self):
+        connection = self._connect()
+        with connection:
+            connection.execute('BEGIN')
+            self._write_lease(connection, time.time())
+
+    def _write_lease(self, connection: sqlite3.Connection, now: float):
+        connection.execute('INSERT OR REPLACE INTO owners (owner, lease_until) VALUES (?, ?)',
+                           (self.owner, now + self.lease))
+        self._leased = now
+
+    def complete(self, event_id: str):
+        self._completed.append((event_id,))
+        self._schedule()
+
+    def forget(self, event_id: str):
+        """Remove an event that wasn't accepted after all, so that Slack's retry of it is processed."""
+        self._forgotten.append((event_id,))
+        self._schedule()
+
+    def _schedule(self):
+        if self._scheduled is None and self._flushing is None:
+            self._scheduled = asyncio.get_event_loop().call_later(self.commit_interval, self._flush)
+
+    def _flush(self):
+        self._scheduled = None
+        appends, completed, forgotten, waiters = self._appends, self._completed, self._forgotten, self._waiters
+        self._appends, self._completed, self._forgotten, self._waiters = [], [], [], []
+        self._flushing = asyncio.ensure_future(self._commit(appends, completed, forgotten, waiters))
+
+    async def _commit(self, appends, completed, forgotten, waiters):
+        try:
+            journaled = await asyncio.get_event_loop().run_in_executor(self._executor, self._write, appends, completed,
+                                                                       forgotten)
+        except Exception as e:
+            _LOGGER.exception("Failed to write the Slack event journal")
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+        else:
+            self.commits += 1
+            self.appended += len(appends)
+            for waiter, new in zip(waiters, journaled):
+                if not waiter.done():
+                    waiter.set_result(new)
+        finally:
+            self._flushing = None
+            if self._appends or self._completed or self._forgotten:
+                self._schedule()
+
+    def _write(self, appends, completed, forgotten) -> List[bool]:
+        connection = self._connect()
+        with connection:
+            connection.execute('BEGIN')
+            journaled = [connection.execute('INSERT OR IGNORE INTO events (event_id, received, payload, owner) '
+                                            'VALUES (?, ?, ?, ?)', append).rowcount == 1 for append in appends]
+            connection.executemany('UPDATE events SET done = 1, payload = NULL WHERE event_id = ?', completed)
+            connection.executemany('DELETE FROM events WHERE event_id = ?', forgotten)
+            now = time.time()
+            if now - self._purged > 60:
+                self._purged = now
+                connection.execute('DELETE FROM events WHERE done = 1 AND received < ?', (now - self.retention,))
+            if appends and now - self._leased > self.lease / 3:
+                # Appended before start(), or while the renewal is late
+                self._write_lease(connection, now)
+        return journaled
+
+    async def close(self):
+        """Commit what is pending and close the journal, its remaining events can be taken over straight away."""
+        if self._renewing is not None:
+            self._renewing.cancel()
+            self._renewing = None
+        if self._scheduled is not None:
+            self._scheduled.cancel()
+            self._flush()
+        while self._flushing is not None:
+            await self._flushing
+        if self._connection is not None:
+            await asyncio.get_event_loop().run_in_executor(self._executor, self._release)
+            self._connection = None
+
+    def _release(self):
+        with self._connection:
+            self._connection.execute('BEGIN')
+            self._connection.execute('DELETE FROM owners WHERE owner = ?', (self.owner,))
+        self._connection.close()
+
+    def stats(self) -> dict:
+        return {'commits': self.commits, 'appended': self.appended}
+
+
+def create_event_journal(path: str, commit_interval: float, retention: float,
+                         lease: float) -> Optional[EventJournal]:
+    return EventJournal(path, commit_interval, retention, lease) if path else None
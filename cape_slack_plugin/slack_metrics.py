@@ -0,0 +1,196 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import time
+from typing import Callable, Dict, Iterable, List, Tuple, Union
+
+from cape_slack_plugin.slack_settings import slack_metrics_enabled
+
+_DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = []
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = '') -> str:
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def _label_values(values: Tuple) -> Tuple[str, ...]:
+    # Label values taken from events may be missing (None), samples are sorted by them
+    return tuple(str(value) for value in values)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != float('inf') else '+Inf'
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        _registry.append(self)
+
+    def lines(self) -> Iterable[str]:
+        raise NotImplementedError()
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self._values = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        if not slack_metrics_enabled:
+            return
+        label_values = _label_values(label_values)
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def lines(self):
+        for label_values, value in sorted(self._values.items()):
+            yield f'{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}'
+
+
+class Gauge(_Metric):
+    """Value read when metrics are scraped, from a callback returning a number or {label values: number}.
+
+    Cumulative counts kept elsewhere (e.g. cache hits in stats()) are exposed with kind='counter'.
+    """
+
+    def __init__(self, name: str, help: str, callback: Callable[[], Union[float, Dict[Tuple, float]]],
+                 labels: Tuple[str, ...] = (), kind: str = 'gauge'):
+        super().__init__(name, help, labels)
+        self.callback = callback
+        self.kind = kind
+
+    def lines(self):
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in sorted(values.items(), key=lambda item: _label_values(item[0])):
+            yield f'{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}'
+
+
+class _Timer:
+    __slots__ = ('histogram', 'label_values', 'start')
+
+    def __init__(self, histogram: 'Histogram', label_values: Tuple):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = _DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # label values -> [count per bucket (and +Inf), sum]
+
+    def observe(self, value: float, *label_values):
+        if not slack_metrics_enabled:
+            return
+        label_values = _label_values(label_values)
+        observed = self._values.get(label_values)
+        if observed is None:
+            observed = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        observed[0][bisect.bisect_left(self.buckets, value)] += 1
+        observed[1] += value
+
+    def time(self, *label_values):
+        """Context manager observing the seconds spent in its block."""
+        if not slack_metrics_enabled:
+            return _NULL_TIMER
+        return _Timer(self, label_values)
+
+    def lines(self):
+        for label_values, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="%s"' % _format_value(bound)
+                yield f'{self.name}_bucket{_format_labels(self.labels, label_values, le)} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labels, label_values)} {_format_value(total)}'
+            yield f'{self.name}_count{_format_labels(self.labels, label_values)} {cumulative}'
+
+
+_caches = {}
+
+
+def register_cache(name: str, stats: Callable[[], dict]):
+    """Expose the sizes, hits and misses reported by a cache's stats(), see LRUCache.stats()."""
+    _caches[name] = stats
+
+
+def _cache_stat(field: str) -> Callable[[], Dict[Tuple, float]]:
+    return lambda: {(name,): stats().get(field, 0) for name, stats in _caches.items()}
+
+
+def render() -> str:
+    """All registered metrics in the Prometheus text exposition format."""
+    lines: List[str] = []
+    for metric in _registry:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.lines())
+    return '\n'.join(lines) + '\n'
+
+
+# Metrics shared by several modules
+STAGE_SECONDS = Histogram('cape_slack_stage_seconds', 'Seconds spent in each stage of handling an event', ('stage',))
+ACTION_SECONDS = Histogram('cape_slack_action_seconds', 'Seconds spent answering each kind of request', ('action',))
+SLACK_API_SECONDS = Histogram('cape_slack_api_seconds', 'Seconds per Slack Web API call', ('method',))
+SLACK_API_ERRORS = Counter('cape_slack_api_errors_total', 'Slack Web API calls that failed, by error',
+                           ('method', 'error'))
+CACHE_ENTRIES = Gauge('cape_slack_cache_entries', 'Entries held by each cache', _cache_stat('entries'), ('cache',))
+CACHE_BYTES = Gauge('cape_slack_cache_bytes', 'Approximate bytes held by each cache', _cache_stat('bytes'), ('cache',))
+CACHE_HITS = Gauge('cape_slack_cache_hits_total', 'Cache lookups that found an entry', _cache_stat('hits'),
+                   ('cache',), kind='counter')
+CACHE_MISSES = Gauge('cape_slack_cache_misses_total', 'Cache lookups that found no entry', _cache_stat('misses'),
+                     ('cache',), kind='counter')
+CACHE_EVICTIONS = Gauge('cape_slack_cache_evictions_total', 'Entries evicted to make room in each cache',
+                        _cache_stat('evictions'), ('cache',), kind='counter')
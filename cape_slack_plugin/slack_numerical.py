@@ -0,0 +1,104 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import logging
+import multiprocessing
+from typing import Any, Callable, Optional
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class NumericalEvaluator:
+    """Evaluates arithmetic in a pool of worker processes, within a time limit.
+
+    A thread stuck on a pathological expression can't be stopped, a process can: when an expression takes longer
+    than the timeout its pool is terminated, the expressions it was evaluating are given up and the next ones start a
+    new pool. Expressions arriving while every process is busy are given up straight away rather than queued.
+    """
+
+    def __init__(self, evaluate: Callable[[str], Any], processes: int, timeout: float,
+                 prepare: Optional[Callable[[], Any]] = None):
+        self.evaluate_function = evaluate
+        self.processes = processes
+        self.timeout = timeout
+        # Run before the pool is started, e.g. to import what evaluate needs once rather than in every process
+        self.prepare = prepare
+        self.timeouts = 0
+        self.skipped = 0
+        # The pool and the futures of the expressions it is evaluating
+        self._pool = None
+        self._starting = None
+
+    async def evaluate(self, question: str) -> Any:
+        """The result of evaluate(question), None if it was given up."""
+        pool, pending = await self._get_pool()
+        if len(pending) >= self.processes:
+            self.skipped += 1
+            return None
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        pending.add(future)
+        # Still running if the caller stops waiting for it, so its process is only busy until the timeout
+        timer = loop.call_later(self.timeout, self._expire, pool, future)
+        future.add_done_callback(pending.discard)
+        future.add_done_callback(lambda _: timer.cancel())
+        pool.apply_async(self.evaluate_function, (question,),
+                         callback=lambda result: loop.call_soon_threadsafe(_resolve, future, result),
+                         error_callback=lambda e: loop.call_soon_threadsafe(_fail, future, e))
+        return await asyncio.shield(future)
+
+    async def _get_pool(self):
+        while self._pool is None:
+            if self._starting is None:
+                self._starting = asyncio.get_event_loop().run_in_executor(None, self._start)
+                self._starting.add_done_callback(self._started)
+            await asyncio.shield(self._starting)
+        return self._pool
+
+    def _start(self):
+        if self.prepare is not None:
+            self.prepare()
+        return multiprocessing.Pool(self.processes)
+
+    def _started(self, starting: asyncio.Future):
+        self._starting = None
+        if not starting.cancelled() and starting.exception() is None:
+            self._pool = (starting.result(), set())
+
+    def _expire(self, pool, future: asyncio.Future):
+        if future.done() or self._pool is None or self._pool[0] is not pool:
+            return
+        self.timeouts += 1
+        _LOGGER.warning("Gave up evaluating numerical answers, restarting their processes")
+        pending = self._pool[1]
+        self._pool = None
+        for given_up in list(pending):
+            _resolve(given_up, None)
+        asyncio.get_event_loop().run_in_executor(None, pool.terminate)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool[0].terminate()
+            self._pool = None
+
+
+def _resolve(future: asyncio.Future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def _fail(future: asyncio.Future, exception: BaseException):
+    if not future.done():
+        future.set_exception(exception)
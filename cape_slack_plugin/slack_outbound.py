@@ -0,0 +1,289 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+import aiohttp
+from cape_slack_plugin.slack_cache import LRUCache
+from cape_slack_plugin.slack_settings import slack_channel_rate, slack_channel_burst, slack_workspace_rate, \
+    slack_workspace_burst, slack_outbound_retries, slack_outbound_coalesce
+from cape_slack_plugin.slack_metrics import Gauge
+from cape_slack_plugin.slack_profiler import span
+from cape_slack_plugin.slack_utils import send_slack_message, update_slack_message, SlackRateLimited
+
+_LOGGER = logging.getLogger(__name__)
+
+# Lower values are sent first
+PRIORITY_ANSWER = 0
+PRIORITY_REPLY = 1
+PRIORITY_NOTICE = 2
+
+# Slack truncates messages longer than this
+_MAX_COALESCED_LENGTH = 4000
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'paused_until')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds to wait before a token is available."""
+        self._refill(now)
+        return max(self.paused_until - now, (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0)
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and self.paused_until <= now
+
+
+class _Message:
+    __slots__ = ('priority', 'seq', 'text', 'coalesce', 'futures', 'attempts')
+
+    def __init__(self, priority: int, seq: int, text: str, coalesce: bool, future: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.text = text
+        self.coalesce = coalesce
+        self.futures = [future]
+        self.attempts = 0
+
+    def __lt__(self, other: '_Message'):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class _Lane:
+    """Messages waiting for one channel, sent in priority order by a single task."""
+    __slots__ = ('token', 'channel', 'bucket', 'messages', 'wakeup')
+
+    def __init__(self, token: str, channel: str, bucket: TokenBucket):
+        self.token = token
+        self.channel = channel
+        self.bucket = bucket
+        self.messages = []
+        self.wakeup = asyncio.Event()
+
+
+class OutboundScheduler:
+    """Posts messages within Slack's per-channel and per-workspace rate limits.
+
+    Each channel with pending messages has a lane served by its own task, which waits for both the channel's and
+    the workspace's token bucket, sends answers before replies and notices, merges consecutive queued messages that
+    opted in (acknowledgements) and retries after the Retry-After delay when Slack answers 429. The future returned by
+    post() resolves to Slack's chat.postMessage response.
+    """
+
+    def __init__(self, channel_rate: float, channel_burst: float, workspace_rate: float, workspace_burst: float,
+                 max_retries: int, coalesce: bool):
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.workspace_rate = workspace_rate
+        self.workspace_burst = workspace_burst
+        self.max_retries = max_retries
+        self.coalesce = coalesce
+        self.sent = 0
+        self.coalesced = 0
+        self.rate_limited = 0
+        self.failed = 0
+        self._seq = itertools.count()
+        self._lanes = {}
+        self._tasks = set()
+        self._draining = False
+        self._workspaces = LRUCache(10000)
+
+    def pending(self) -> int:
+        return sum(len(lane.messages) for lane in self._lanes.values())
+
+    def post(self, token: str, channel: str, text: str, priority: int = PRIORITY_REPLY,
+             coalesce: bool = False) -> asyncio.Future:
+        future = asyncio.get_event_loop().create_future()
+        lane = self._lanes.get((token, channel))
+        if lane is None:
+            lane = self._lanes[token, channel] = _Lane(token, channel,
+                                                       TokenBucket(self.channel_rate, self.channel_burst))
+            task = asyncio.ensure_future(self._run(lane))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        heapq.heappush(lane.messages, _Message(priority, next(self._seq), text, coalesce and self.coalesce, future))
+        lane.wakeup.set()
+        return future
+
+    async def drain(self, timeout: float):
+        """Send the messages queued (up to timeout) and stop the lanes, the senders of those left get an error."""
+        self._draining = True
+        for lane in self._lanes.values():
+            lane.wakeup.set()
+        if self._tasks:
+            _, unfinished = await asyncio.wait(list(self._tasks), timeout=timeout)
+            for task in unfinished:
+                task.cancel()
+            if unfinished:
+                await asyncio.wait(unfinished)
+
+    def _workspace_bucket(self, token: str) -> TokenBucket:
+        bucket = self._workspaces.get(token)
+        if bucket is None:
+            bucket = TokenBucket(self.workspace_rate, self.workspace_burst)
+            self._workspaces.set(token, bucket)
+        return bucket
+
+    def _next_message(self, lane: _Lane) -> _Message:
+        message = heapq.heappop(lane.messages)
+        while message.coalesce and lane.messages and lane.messages[0].coalesce and \
+                lane.messages[0].priority == message.priority and \
+                len(message.text) + len(lane.messages[0].text) < _MAX_COALESCED_LENGTH:
+            merged = heapq.heappop(lane.messages)
+            message.text += '\n' + merged.text
+            message.futures.extend(merged.futures)
+            self.coalesced += 1
+        return message
+
+    async def _run(self, lane: _Lane):
+        workspace = self._workspace_bucket(lane.token)
+        try:
+            while True:
+                if not lane.messages:
+                    if self._draining:
+                        return
+                    # Linger until the channel's allowance is refilled, so that a new lane can't burst past it
+                    lane.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(lane.wakeup.wait(), self.channel_burst / self.channel_rate)
+                    except asyncio.TimeoutError:
+                        if not lane.messages:
+                            return
+                    continue
+                delay = max(lane.bucket.delay(time.monotonic()), workspace.delay(time.monotonic()))
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                now = time.monotonic()
+                lane.bucket.take(now)
+                workspace.take(now)
+                await self._send(lane, workspace, self._next_message(lane))
+        finally:
+            del self._lanes[lane.token, lane.channel]
+            for message in lane.messages:
+                for future in message.futures:
+                    if not future.done():
+                        future.set_result({'ok': False, 'error': 'scheduler_stopped'})
+
+    async def _send(self, lane: _Lane, workspace: TokenBucket, message: _Message):
+        try:
+            response = await send_slack_message(lane.token, lane.channel, message.text)
+        except SlackRateLimited as e:
+            self.rate_limited += 1
+            lane.bucket.pause(e.retry_after)
+            workspace.pause(e.retry_after)
+            message.attempts += 1
+            if message.attempts <= self.max_retries:
+                heapq.heappush(lane.messages, message)
+                return
+            response = {'ok': False, 'error': 'ratelimited'}
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            _LOGGER.warning("Failed to post Slack message to %s: %r", lane.channel, e)
+            response = {'ok': False, 'error': 'request_failed'}
+        except Exception:
+            # Whatever the failure, the message's senders must get a response, and the lane must keep going
+            _LOGGER.exception("Failed to post Slack message to %s", lane.channel)
+            response = {'ok': False, 'error': 'request_failed'}
+        if response.get('ok'):
+            self.sent += 1
+        else:
+            self.failed += 1
+        for future in message.futures:
+            if not future.done():
+                future.set_result(response)
+
+
+_scheduler = OutboundScheduler(slack_channel_rate, slack_channel_burst, slack_workspace_rate, slack_workspace_burst,
+                               slack_outbound_retries, slack_outbound_coalesce)
+
+
+Gauge('cape_slack_outbound_pending', 'Messages waiting to be posted', _scheduler.pending)
+Gauge('cape_slack_outbound_channels', 'Channels with messages waiting to be posted', lambda: len(_scheduler._lanes))
+Gauge('cape_slack_outbound_messages_total', 'Messages handled by the outbound scheduler, by outcome',
+      lambda: {('sent',): _scheduler.sent, ('coalesced',): _scheduler.coalesced,
+               ('rate_limited',): _scheduler.rate_limited, ('failed',): _scheduler.failed}, ('outcome',),
+      kind='counter')
+
+
+async def post_message(token: str, channel: str, text: str, priority: int = PRIORITY_REPLY,
+                       coalesce: bool = False) -> dict:
+    """Queue a chat.postMessage and wait for Slack's response, e.g. to record the posted message's ts. Only
+    acknowledgements should coalesce, the text of a merged message isn't the one posted."""
+    with span('post_message'):
+        return await _scheduler.post(token, channel, text, priority, coalesce)
+
+
+async def drain_messages(timeout: float):
+    """Post the messages still queued, on shutdown."""
+    await _scheduler.drain(timeout)
+
+
+class ProgressMessage:
+    """A status message posted once and then edited in place, at most once per interval unless final."""
+
+    def __init__(self, token: str, channel: str, interval: float = 2.0):
+        self.token = token
+        self.channel = channel
+        self.interval = interval
+        self._ts = None
+        self._text = None
+        self._updated = 0.0
+        self._failed = False
+
+    async def update(self, text: str, final: bool = False):
+        if text == self._text or not final and (self._failed or time.monotonic() - self._updated < self.interval):
+            return
+        self._text = text
+        self._updated = time.monotonic()
+        if self._ts is None:
+            response = await post_message(self.token, self.channel, text, PRIORITY_NOTICE)
+            if response.get('ok'):
+                self._ts = response['ts']
+            else:
+                # Intermediate progress is dropped rather than posted anew by every update, the final status is posted
+                self._failed = True
+                _LOGGER.warning("Failed to post Slack message in %s: %s", self.channel, response.get('error'))
+            return
+        try:
+            response = await update_slack_message(self.token, self.channel, self._ts, text)
+        except (SlackRateLimited, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            response = {'ok': False, 'error': repr(e)}
+        if not response.get('ok'):
+            # Intermediate progress can be dropped, the final status is posted as a new message instead
+            _LOGGER.warning("Failed to update Slack message in %s: %s", self.channel, response.get('error'))
+            if final:
+                await post_message(self.token, self.channel, text, PRIORITY_NOTICE)
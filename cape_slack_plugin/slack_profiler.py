@@ -0,0 +1,164 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from typing import List
+from weakref import WeakKeyDictionary
+
+from cape_slack_plugin.slack_settings import slack_profile_rate, slack_profile_slowest
+
+# asyncio.current_task() was added in Python 3.7
+_current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+
+
+class Trace:
+    """Timings of the calls made while processing one event. Only the shape of the event is kept, never its text."""
+    __slots__ = ('event', 'started', 'start', 'duration', 'spans')
+
+    def __init__(self, event: dict):
+        self.event = _redact(event)
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.spans = []  # (name, seconds since the start of the event, seconds)
+
+    def to_dict(self) -> dict:
+        return {'event': self.event, 'started': self.started, 'seconds': self.duration,
+                'spans': [{'name': name, 'offset': offset, 'seconds': seconds}
+                          for name, offset, seconds in self.spans]}
+
+
+def _redact(event: dict) -> dict:
+    summary = {'type': event.get('type'), 'subtype': event.get('subtype'), 'channel': event.get('channel')}
+    text = event.get('text')
+    if text:
+        summary['text_length'] = len(text)
+        # Commands tell what was asked for, anything else could be confidential
+        words = text.split()
+        if words and words[0].startswith('.'):
+            summary['command'] = words[0][:32]
+    return summary
+
+
+class _Span:
+    __slots__ = ('trace', 'name', 'start')
+
+    def __init__(self, trace: Trace, name: str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter()
+        self.trace.spans.append((self.name, self.start - self.trace.start, end - self.start))
+
+
+class _NullContext:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_CONTEXT = _NullContext()
+
+
+class Profiler:
+    """Traces a random sample of events and keeps the slowest ones.
+
+    The trace of an event is bound to the task processing it, so that span() records the calls awaited by that task
+    without passing the trace around. Work handed to other tasks (e.g. documents ingested in the background) isn't
+    traced.
+    """
+
+    def __init__(self, rate: float, slowest: int):
+        self.rate = rate
+        self.slowest = slowest
+        self.sampled = 0
+        self._traces = WeakKeyDictionary()  # task -> trace
+        self._slowest = []  # heap of (duration, seq, trace)
+        self._seq = itertools.count()
+
+    def event(self, event: dict):
+        """Context manager tracing the processing of event, if it is sampled."""
+        if not self.rate or random.random() >= self.rate:
+            return _NULL_CONTEXT
+        return _EventTrace(self, event)
+
+    def span(self, name: str):
+        """Context manager recording a call in the trace of the current task's event, if any."""
+        if not self._traces:
+            return _NULL_CONTEXT
+        try:
+            trace = self._traces.get(_current_task())
+        except RuntimeError:
+            # Not called from a task, e.g. from a responder thread
+            return _NULL_CONTEXT
+        return _NULL_CONTEXT if trace is None else _Span(trace, name)
+
+    def _finish(self, trace: Trace):
+        self.sampled += 1
+        item = (trace.duration, next(self._seq), trace)
+        if len(self._slowest) < self.slowest:
+            heapq.heappush(self._slowest, item)
+        elif self._slowest and item > self._slowest[0]:
+            heapq.heapreplace(self._slowest, item)
+
+    def slowest_traces(self) -> List[dict]:
+        return [trace.to_dict() for duration, seq, trace in sorted(self._slowest, reverse=True)]
+
+    def clear(self):
+        self._slowest = []
+
+
+class _EventTrace:
+    __slots__ = ('profiler', 'trace', 'task')
+
+    def __init__(self, profiler: Profiler, event: dict):
+        self.profiler = profiler
+        self.trace = Trace(event)
+        self.task = None
+
+    def __enter__(self):
+        self.task = _current_task()
+        if self.task is not None:
+            self.profiler._traces[self.task] = self.trace
+        return self.trace
+
+    def __exit__(self, *exc_info):
+        self.trace.duration = time.perf_counter() - self.trace.start
+        if self.task is not None:
+            self.profiler._traces.pop(self.task, None)
+        self.profiler._finish(self.trace)
+
+
+_profiler = Profiler(slack_profile_rate, slack_profile_slowest)
+
+
+def get_profiler() -> Profiler:
+    return _profiler
+
+
+def span(name: str):
+    return _profiler.span(name)
@@ -0,0 +1,116 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import logging
+from collections import deque
+from typing import Hashable
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class EventQueueFull(Exception):
+    pass
+
+
+class EventQueue:
+    """Bounded queue of coroutine jobs drained by a fixed pool of worker tasks.
+
+    Jobs put with the same key (e.g. a bot's channel) run one after another in the order they were put, jobs with
+    different keys run concurrently.
+    """
+
+    def __init__(self, workers: int, maxsize: int, put_timeout: float, drain_timeout: float):
+        self.workers = workers
+        self.maxsize = maxsize
+        self.put_timeout = put_timeout
+        self.drain_timeout = drain_timeout
+        self.shed = 0
+        self._queue = None
+        # Jobs waiting for the job of the same key a worker is running, which runs them next
+        self._pending = {}
+        # Jobs put and not started yet, whether queued or pending
+        self._slots = None
+        self._tasks = []
+        self._accepting = False
+
+    def start(self, loop=None):
+        loop = loop or asyncio.get_event_loop()
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.maxsize)
+        self._pending = {}
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+        self._accepting = True
+
+    @property
+    def running(self) -> bool:
+        return self._accepting
+
+    def qsize(self) -> int:
+        if self._queue is None:
+            return 0
+        return self._queue.qsize() + sum(len(jobs) for jobs in self._pending.values())
+
+    async def put(self, key: Hashable, job, *args):
+        if not self._accepting:
+            raise EventQueueFull()
+        if self._slots.locked():
+            # Backpressure: hold the request for a moment in case a worker frees a slot, then shed it
+            try:
+                await asyncio.wait_for(self._slots.acquire(), self.put_timeout)
+            except asyncio.TimeoutError:
+                self.shed += 1
+                raise EventQueueFull()
+        else:
+            await self._slots.acquire()
+        self._queue.put_nowait((key, job, args))
+
+    async def drain(self):
+        """Stop accepting jobs, finish the queued ones (up to drain_timeout) and stop the workers."""
+        if self._queue is None:
+            return
+        self._accepting = False
+        try:
+            await asyncio.wait_for(self._queue.join(), self.drain_timeout)
+        except asyncio.TimeoutError:
+            _LOGGER.warning("Dropping %d queued Slack events after waiting %.1fs to drain", self.qsize(),
+                            self.drain_timeout)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    async def _worker(self):
+        while True:
+            key, job, args = await self._queue.get()
+            if key in self._pending:
+                self._pending[key].append((job, args))
+                continue
+            self._pending[key] = pending = deque()
+            try:
+                await self._run(job, args)
+                while pending:
+                    await self._run(*pending.popleft())
+            finally:
+                del self._pending[key]
+
+    async def _run(self, job, args):
+        self._slots.release()
+        try:
+            await job(*args)
+        except Exception:
+            _LOGGER.exception("Error processing Slack event")
+        finally:
+            self._queue.task_done()
@@ -0,0 +1,122 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
+from uuid import uuid4
+
+from peewee import DoesNotExist
+from cape_slack_plugin.slack_cache import LRUCache
+from cape_slack_plugin.slack_settings import slack_record_cache_size, slack_record_cache_ttl, \
+    slack_record_cache_negative_ttl, slack_record_generation_ttl, slack_record_threads, slack_state_url, \
+    slack_state_threads
+from cape_slack_plugin.slack_state import create_state_store
+from cape_slack_plugin.slack_metrics import STAGE_SECONDS, register_cache
+from cape_slack_plugin.slack_profiler import span
+from userdb.bot import Bot
+from userdb.user import User
+
+_MISSING = object()
+
+# Read-through caches in front of the userdb lookups done for every event, missing records are cached as None.
+# Records are cached by their generation, which invalidate_bot() and invalidate_user() replace in the shared state
+# store (if any) so that a change made through one worker (e.g. the OAuth callback) also invalidates the record cached
+# by the others. Each worker reads a generation again from the store at most every slack_record_generation_ttl seconds
+_bots = LRUCache(slack_record_cache_size, ttl=slack_record_cache_ttl, group=lambda key: key[0])
+_users = LRUCache(slack_record_cache_size, ttl=slack_record_cache_ttl, group=lambda key: key[0])
+_generations = None if slack_state_url.startswith('memory:') else \
+    create_state_store(slack_state_url, threads=slack_state_threads)
+_local_generations = LRUCache(slack_record_cache_size, ttl=slack_record_generation_ttl)
+# Lookups block on the database, they are kept off the event loop. The database connections belong to these threads
+_record_executor = ThreadPoolExecutor(max_workers=slack_record_threads)
+register_cache('bot', _bots.stats)
+register_cache('user', _users.stats)
+
+
+async def _cached_get(cache: LRUCache, model, field: str, value: str):
+    key = (value, await _generation(model.__name__, value))
+    record = cache.get(key, _MISSING)
+    if record is _MISSING:
+        with STAGE_SECONDS.time('db'), span('db'):
+            record = await asyncio.get_event_loop().run_in_executor(_record_executor, _lookup, model, field, value)
+        cache.set(key, record, slack_record_cache_ttl if record is not None else slack_record_cache_negative_ttl)
+    return record
+
+
+def _lookup(model, field: str, value: str):
+    try:
+        return model.get(field, value)
+    except DoesNotExist:
+        return None
+
+
+async def _generation(kind: str, record_id: str) -> Optional[str]:
+    if _generations is None:
+        return None
+    generation = _local_generations.get((kind, record_id), _MISSING)
+    if generation is _MISSING:
+        generation = await _generations.aget(('generation', kind, record_id))
+        _local_generations.set((kind, record_id), generation)
+    return generation
+
+
+async def _new_generation(kind: str, record_id: str):
+    if _generations is not None:
+        generation = uuid4().hex
+        await _generations.aset(('generation', kind, record_id), generation)
+        _local_generations.set((kind, record_id), generation)
+
+
+async def get_bot(bot_id: str) -> Optional[Bot]:
+    return await _cached_get(_bots, Bot, 'bot_id', bot_id)
+
+
+async def get_user(user_id: str) -> Optional[User]:
+    return await _cached_get(_users, User, 'user_id', user_id)
+
+
+def connect_records():
+    """Open the calling thread's database connection ahead of its first query."""
+    Bot._meta.database.connect(reuse_if_open=True)
+
+
+async def warm_records():
+    """Open the database connection used by the lookups ahead of the first event."""
+    await asyncio.get_event_loop().run_in_executor(_record_executor, connect_records)
+
+
+async def invalidate_bot(bot_id: str):
+    """Must be called whenever a bot's tokens change or it is deleted."""
+    _bots.pop_group(bot_id)
+    await _new_generation(Bot.__name__, bot_id)
+
+
+async def invalidate_user(user_id: str):
+    """Must be called whenever a user's record changes or it is created."""
+    _users.pop_group(user_id)
+    await _new_generation(User.__name__, user_id)
+
+
+async def delete_bots(bot_ids: Iterable[str]) -> int:
+    """Delete the bots in one query, bots already deleted are ignored. Returns how many were deleted."""
+    bot_ids = list(bot_ids)
+    if not bot_ids:
+        return 0
+    with STAGE_SECONDS.time('db'), span('db'):
+        deleted = await asyncio.get_event_loop().run_in_executor(
+            _record_executor, lambda: Bot.delete().where(Bot.bot_id.in_(bot_ids)).execute())
+    for bot_id in bot_ids:
+        await invalidate_bot(bot_id)
+    return deleted
@@ -0,0 +1,63 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The responder's endpoints and helpers, imported on first use.
+
+The responder's modules load its models and numexpr, which takes longer than starting the rest of a worker, so they
+are only imported by the first event that needs them, or by import_responder() when the worker warms up.
+"""
+
+import importlib
+from types import ModuleType
+
+_CORE = 'webservices.app.app_core'
+_SAVED_REPLIES = 'webservices.app.app_saved_reply_endpoints'
+_DOCUMENTS = 'webservices.app.app_document_endpoints'
+_BOTS_COMMON = 'webservices.bots_common.utils'
+
+
+def import_responder():
+    for name in (_CORE, _SAVED_REPLIES, _DOCUMENTS, _BOTS_COMMON):
+        importlib.import_module(name)
+
+
+def bots_common() -> ModuleType:
+    """webservices.bots_common.utils, with the numerical answers and the messages shared by Cape's bots."""
+    return importlib.import_module(_BOTS_COMMON)
+
+
+# Named after the endpoints they call, which name their responder metrics and profiling spans
+
+def answer(request):
+    return importlib.import_module(_CORE)._answer(request)
+
+
+def create_saved_reply(request):
+    return importlib.import_module(_SAVED_REPLIES)._create_saved_reply(request)
+
+
+def add_paraphrase_question(request):
+    return importlib.import_module(_SAVED_REPLIES)._add_paraphrase_question(request)
+
+
+def upload_document(request):
+    return importlib.import_module(_DOCUMENTS)._upload_document(request)
+
+
+def delete_document(request):
+    return importlib.import_module(_DOCUMENTS)._delete_document(request)
+
+
+def try_numerical_answer(question: str):
+    return bots_common().try_numerical_answer(question)
@@ -22,5 +22,130 @@ slack_event_endpoints = Blueprint('slack_event_endpoints')
 slack_client_id = os.getenv("CAPE_SLACK_CLIENT_ID", "REPLACEME")
 slack_client_secret = os.getenv("CAPE_SLACK_CLIENT_SECRET", "REPLACEME")
 slack_verification = os.getenv("CAPE_SLACK_VERIFICATION", "REPLACEME")
+slack_signing_secret = os.getenv("CAPE_SLACK_SIGNING_SECRET", "REPLACEME")
+# Seconds a signed request may be older or newer than the server's clock
+slack_signature_max_skew = float(os.getenv("CAPE_SLACK_SIGNATURE_MAX_SKEW", "300"))
 slack_app_url = os.getenv("CAPE_SLACK_APP_URL", "REPLACEME")
 
+# Slack Web API, and the connection pool shared by every call made to it from a worker
+slack_api_url = os.getenv("CAPE_SLACK_API_URL", "https://slack.com/api/")
+slack_pool_size = int(os.getenv("CAPE_SLACK_POOL_SIZE", "200"))
+slack_pool_per_host = int(os.getenv("CAPE_SLACK_POOL_PER_HOST", "100"))
+slack_keepalive_timeout = float(os.getenv("CAPE_SLACK_KEEPALIVE_TIMEOUT", "30"))
+slack_connect_timeout = float(os.getenv("CAPE_SLACK_CONNECT_TIMEOUT", "5"))
+slack_request_timeout = float(os.getenv("CAPE_SLACK_REQUEST_TIMEOUT", "30"))
+
+# 'queue' acknowledges events straight away and answers them from a pool of background workers, 'inline' answers them
+# before acknowledging
+slack_event_mode = os.getenv("CAPE_SLACK_EVENT_MODE", "queue")
+slack_event_workers = int(os.getenv("CAPE_SLACK_EVENT_WORKERS", "16"))
+slack_event_queue_size = int(os.getenv("CAPE_SLACK_EVENT_QUEUE_SIZE", "1000"))
+# Seconds an incoming event may wait for space in a full queue before it is shed and left for Slack to retry
+slack_event_queue_timeout = float(os.getenv("CAPE_SLACK_EVENT_QUEUE_TIMEOUT", "0.5"))
+slack_event_drain_timeout = float(os.getenv("CAPE_SLACK_EVENT_DRAIN_TIMEOUT", "30"))
+# Receive events over a Socket Mode websocket opened with an app-level token (xapp-...) rather than as HTTP callbacks,
+# so that workers need no public endpoint. Seconds waited before opening it again after a failure, doubling up to max
+slack_socket_mode = os.getenv("CAPE_SLACK_SOCKET_MODE", "false").lower() == "true"
+slack_app_token = os.getenv("CAPE_SLACK_APP_TOKEN", "REPLACEME")
+slack_socket_backoff = float(os.getenv("CAPE_SLACK_SOCKET_BACKOFF", "1"))
+slack_socket_max_backoff = float(os.getenv("CAPE_SLACK_SOCKET_MAX_BACKOFF", "60"))
+# Threads running the (blocking) responder calls, so that workers can answer concurrently
+slack_responder_threads = int(os.getenv("CAPE_SLACK_RESPONDER_THREADS", "8"))
+# Responder calls are shared fairly between bots (workspaces): calls running and per second for one bot, calls of one
+# bot waiting for their turn before further ones are refused, seconds after which a waiting question is told the bot is
+# busy, and weights of bots given a larger share, as 'bot_id=weight,bot_id=weight'
+slack_tenant_concurrency = int(os.getenv("CAPE_SLACK_TENANT_CONCURRENCY", "4"))
+slack_tenant_rate = float(os.getenv("CAPE_SLACK_TENANT_RATE", "10"))
+slack_tenant_burst = float(os.getenv("CAPE_SLACK_TENANT_BURST", "20"))
+slack_tenant_max_waiting = int(os.getenv("CAPE_SLACK_TENANT_MAX_WAITING", "100"))
+slack_tenant_busy_notice = float(os.getenv("CAPE_SLACK_TENANT_BUSY_NOTICE", "3"))
+slack_tenant_weights = os.getenv("CAPE_SLACK_TENANT_WEIGHTS", "")
+
+# Conversation state shared by workers: 'memory://', 'sqlite:///path/to/state.db' or 'redis://host:port/db'
+slack_state_url = os.getenv("CAPE_SLACK_STATE_URL", "memory://")
+# Seconds of inactivity after which a conversation (.next, .why, reactions to answers) is forgotten
+slack_state_ttl = float(os.getenv("CAPE_SLACK_STATE_TTL", "604800"))
+# Budgets for the in-process (memory://) state store, least recently used conversations are evicted first
+slack_state_max_entries = int(os.getenv("CAPE_SLACK_STATE_MAX_ENTRIES", "100000"))
+slack_state_max_bytes = int(os.getenv("CAPE_SLACK_STATE_MAX_BYTES", str(256 * 1024 * 1024)))
+# Threads making calls to a redis:// state store at the same time, away from the event loop (SQLite uses one)
+slack_state_threads = int(os.getenv("CAPE_SLACK_STATE_THREADS", "4"))
+
+# Seconds during which a retried event id is recognised as a duplicate
+slack_dedup_window = float(os.getenv("CAPE_SLACK_DEDUP_WINDOW", "3600"))
+# Store shared by workers to recognise retries delivered to another worker, 'memory://' for this worker only
+slack_dedup_url = os.getenv("CAPE_SLACK_DEDUP_URL", slack_state_url)
+
+# SQLite file where events are journaled from before they are acknowledged until they are processed, so that they're
+# replayed after a crash or restart, '' to disable. Shared by the worker processes of a server, a worker replays the
+# events of those that stopped
+slack_journal_path = os.getenv("CAPE_SLACK_JOURNAL_PATH", "")
+# Seconds events wait to be committed to the journal together
+slack_journal_commit_interval = float(os.getenv("CAPE_SLACK_JOURNAL_COMMIT_INTERVAL", "0.002"))
+# Seconds a worker's events stay its own without it renewing its lease, after which another worker replays them
+slack_journal_lease = float(os.getenv("CAPE_SLACK_JOURNAL_LEASE", "30"))
+
+# Read-through cache of Bot and User records, seconds before a record (or a missing record) is looked up again
+slack_record_cache_size = int(os.getenv("CAPE_SLACK_RECORD_CACHE_SIZE", "10000"))
+slack_record_cache_ttl = float(os.getenv("CAPE_SLACK_RECORD_CACHE_TTL", "60"))
+slack_record_cache_negative_ttl = float(os.getenv("CAPE_SLACK_RECORD_CACHE_NEGATIVE_TTL", "10"))
+# Seconds a worker uses the generation of a record before reading it again from the state store, i.e. how long a record
+# changed through another worker can be stale
+slack_record_generation_ttl = float(os.getenv("CAPE_SLACK_RECORD_GENERATION_TTL", "1"))
+# Threads the record lookups run on, each with its own database connection
+slack_record_threads = int(os.getenv("CAPE_SLACK_RECORD_THREADS", "2"))
+
+# Outbound message scheduling, rates are in messages per second, bursts in messages
+slack_channel_rate = float(os.getenv("CAPE_SLACK_CHANNEL_RATE", "1"))
+slack_channel_burst = float(os.getenv("CAPE_SLACK_CHANNEL_BURST", "2"))
+slack_workspace_rate = float(os.getenv("CAPE_SLACK_WORKSPACE_RATE", "10"))
+slack_workspace_burst = float(os.getenv("CAPE_SLACK_WORKSPACE_BURST", "20"))
+slack_outbound_retries = int(os.getenv("CAPE_SLACK_OUTBOUND_RETRIES", "3"))
+# Merge queued acknowledgements (e.g. thanks for a reaction) to the same channel into a single message, other messages
+# are never merged
+slack_outbound_coalesce = os.getenv("CAPE_SLACK_OUTBOUND_COALESCE", "true").lower() == "true"
+
+# Responder answers cached per bot and question, until the bot's saved replies or documents change
+slack_answer_cache_size = int(os.getenv("CAPE_SLACK_ANSWER_CACHE_SIZE", "10000"))
+slack_answer_cache_ttl = float(os.getenv("CAPE_SLACK_ANSWER_CACHE_TTL", "300"))
+# Answers requested from the responder at a time, the next page is requested when .next runs out of answers, or as
+# soon as the first answer is posted when prefetching; at most slack_answer_max answers are given to a question
+slack_answer_page_size = int(os.getenv("CAPE_SLACK_ANSWER_PAGE_SIZE", "1"))
+slack_answer_max = int(os.getenv("CAPE_SLACK_ANSWER_MAX", "5"))
+slack_answer_prefetch = os.getenv("CAPE_SLACK_ANSWER_PREFETCH", "false").lower() == "true"
+# Responder calls made at the same time for the paraphrases of a saved reply (.add) or the lines of a .import
+slack_paraphrase_concurrency = int(os.getenv("CAPE_SLACK_PARAPHRASE_CONCURRENCY", "4"))
+# Learning saved replies from a channel's history (.learn): Slack API calls per second (conversations.history and
+# conversations.replies allow 50 per minute), messages per page and seconds the progress is kept to resume
+slack_learn_rate = float(os.getenv("CAPE_SLACK_LEARN_RATE", "0.8"))
+slack_learn_page_size = int(os.getenv("CAPE_SLACK_LEARN_PAGE_SIZE", "200"))
+slack_learn_checkpoint_ttl = float(os.getenv("CAPE_SLACK_LEARN_CHECKPOINT_TTL", str(30 * 24 * 3600)))
+# Arithmetic questions are evaluated while the responder is answering, by a few processes and within a time limit after
+# which the processes are restarted
+slack_numerical_processes = int(os.getenv("CAPE_SLACK_NUMERICAL_PROCESSES", "2"))
+slack_numerical_timeout = float(os.getenv("CAPE_SLACK_NUMERICAL_TIMEOUT", "0.5"))
+
+# Documents shared with the bot: largest file read (markdown, HTML and XML take far longer to convert to text),
+# characters per document sent to the responder (larger documents are split in parts), documents ingested at the same
+# time per worker and threads converting them to text
+slack_document_max_bytes = int(os.getenv("CAPE_SLACK_DOCUMENT_MAX_BYTES", str(10 * 1024 * 1024)))
+slack_document_markup_max_bytes = int(os.getenv("CAPE_SLACK_DOCUMENT_MARKUP_MAX_BYTES", str(1024 * 1024)))
+slack_document_part_chars = int(os.getenv("CAPE_SLACK_DOCUMENT_PART_CHARS", "100000"))
+slack_document_concurrency = int(os.getenv("CAPE_SLACK_DOCUMENT_CONCURRENCY", "4"))
+slack_document_threads = int(os.getenv("CAPE_SLACK_DOCUMENT_THREADS", "2"))
+# Seconds the content hash of an indexed document is remembered to skip re-indexing it when it is shared again
+slack_document_index_ttl = float(os.getenv("CAPE_SLACK_DOCUMENT_INDEX_TTL", str(30 * 24 * 3600)))
+
+# Import the responder and open the database, Slack API and state store connections when a worker starts, rather than
+# when it receives its first event
+slack_warmup = os.getenv("CAPE_SLACK_WARMUP", "true").lower() == "true"
+
+# Prometheus metrics served on /slack/metrics, nothing is measured when disabled
+slack_metrics_enabled = os.getenv("CAPE_SLACK_METRICS", "false").lower() == "true"
+
+# Fraction of events traced (0 disables profiling), the slowest traces are kept and can be fetched from
+# /slack/profile/slowest with this token as a bearer token, or logged by sending the signal to the worker
+slack_profile_rate = float(os.getenv("CAPE_SLACK_PROFILE_RATE", "0"))
+slack_profile_slowest = int(os.getenv("CAPE_SLACK_PROFILE_SLOWEST", "20"))
+slack_profile_token = os.getenv("CAPE_SLACK_PROFILE_TOKEN", "")
+slack_profile_signal = os.getenv("CAPE_SLACK_PROFILE_SIGNAL", "SIGUSR2")
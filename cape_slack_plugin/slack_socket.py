@@ -0,0 +1,146 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import json
+import logging
+import random
+from typing import Awaitable, Callable
+
+import aiohttp
+
+from cape_slack_plugin.slack_metrics import Counter
+from cape_slack_plugin.slack_utils import slack_api_call, SlackRateLimited
+
+_LOGGER = logging.getLogger(__name__)
+
+_ENVELOPES = Counter('cape_slack_socket_envelopes_total', 'Socket Mode envelopes received, by type', ('type',))
+_RECONNECTS = Counter('cape_slack_socket_reconnects_total', 'Socket Mode connections opened again, by reason',
+                      ('reason',))
+
+
+class SocketModeError(Exception):
+    pass
+
+
+class SocketModeClient:
+    """Receives events over Slack's Socket Mode websocket instead of HTTP callbacks, see
+    https://api.slack.com/apis/connections/socket.
+
+    The events of every workspace the app is installed in arrive over one connection, opened with an app-level
+    token. Each envelope is handed to handle(), concurrently, and acknowledged once handle() returns True, like an
+    HTTP callback answered with a 200. Envelopes that aren't acknowledged are retried by Slack. The connection is
+    opened again when Slack asks for it or when it drops, after an exponential backoff if it can't be opened.
+    """
+
+    def __init__(self, app_token: str, handle: Callable[[dict], Awaitable[bool]], backoff: float = 1.0,
+                 max_backoff: float = 60.0, heartbeat: float = 30.0):
+        self.app_token = app_token
+        self.handle = handle
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.heartbeat = heartbeat
+        self.connected = False
+        self.connections = 0
+        self._task = None
+        self._session = None
+        self._handling = set()
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stop receiving events. Those being handled can't be acknowledged anymore, Slack retries them."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.wait([self._task])
+            self._task = None
+        if self._handling:
+            await asyncio.wait(list(self._handling))
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _run(self):
+        delay = self.backoff
+        reason = 'start'
+        while True:
+            try:
+                url = await self._open_connection()
+                reason = await self._receive(url)
+                delay = self.backoff
+            except asyncio.CancelledError:
+                raise
+            except (SocketModeError, SlackRateLimited, aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                self.connected = False
+                reason = 'error'
+                # Full jitter, so that the workers of a deployment don't all reconnect at once
+                wait = random.uniform(0, delay)
+                _LOGGER.warning("Slack Socket Mode connection failed (%s), retrying in %.1fs", e, wait)
+                await asyncio.sleep(wait)
+                delay = min(delay * 2, self.max_backoff)
+            _RECONNECTS.inc(reason)
+
+    async def _open_connection(self) -> str:
+        response = await slack_api_call('apps.connections.open', self.app_token)
+        if not response.get('ok'):
+            raise SocketModeError(f"apps.connections.open failed: {response.get('error')}")
+        return response['url']
+
+    async def _receive(self, url: str) -> str:
+        """Handle the envelopes received over one connection, returns why it ended once it was established."""
+        if self._session is None:
+            # Apart from the pool of Web API calls, whose timeouts would cut the connection short
+            self._session = aiohttp.ClientSession()
+        reason = 'closed'
+        async with self._session.ws_connect(url, heartbeat=self.heartbeat) as websocket:
+            self.connections += 1
+            try:
+                async for message in websocket:
+                    if message.type != aiohttp.WSMsgType.TEXT:
+                        break
+                    envelope = json.loads(message.data)
+                    kind = envelope.get('type')
+                    _ENVELOPES.inc(kind)
+                    if kind == 'hello':
+                        self.connected = True
+                    elif kind == 'disconnect':
+                        # Sent before Slack closes the connection, e.g. every few hours to refresh it
+                        reason = envelope.get('reason', 'disconnect')
+                        break
+                    elif 'envelope_id' in envelope:
+                        task = asyncio.ensure_future(self._handle(websocket, envelope))
+                        self._handling.add(task)
+                        task.add_done_callback(self._handling.discard)
+            finally:
+                established = self.connected
+                self.connected = False
+        if not established or reason == 'link_disabled':
+            # Opening it again straight away would fail the same way
+            raise SocketModeError(f"connection {reason} before it was established" if not established else
+                                  "Socket Mode is disabled for this app")
+        return reason
+
+    async def _handle(self, websocket: aiohttp.ClientWebSocketResponse, envelope: dict):
+        # Only events are handled, the interactivity and slash commands this app doesn't use are acknowledged
+        if envelope.get('type') == 'events_api':
+            try:
+                accepted = await self.handle(envelope.get('payload', {}))
+            except Exception:
+                _LOGGER.exception("Failed to handle a Socket Mode event")
+                accepted = False
+            if not accepted:
+                return
+        if not websocket.closed:
+            await websocket.send_str(json.dumps({'envelope_id': envelope['envelope_id']}))
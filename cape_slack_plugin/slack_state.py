@@ -0,0 +1,418 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import os
+import pickle
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from cape_slack_plugin.slack_cache import LRUCache
+
+# Keys are tuples of strings, e.g. ('session', bot_id, channel). Keys of more than two parts are grouped by their
+# first two, e.g. all the sessions of a bot, see StateStore.delete_group()
+Key = Tuple[str, ...]
+
+
+def _group(key: Key) -> Optional[Key]:
+    return key[:2] if len(key) > 2 else None
+
+
+class Answer:
+    """Compact record of one item of a responder answer."""
+    __slots__ = ('text', 'confidence', 'source_type', 'source_id', 'matched_question', 'context', 'text_start',
+                 'text_end', 'context_start')
+
+    def __init__(self, text: str, confidence: float, source_type: str, source_id: str,
+                 matched_question: Optional[str] = None, context: Optional[str] = None, text_start: int = 0,
+                 text_end: int = 0, context_start: int = 0):
+        self.text = text
+        self.confidence = confidence
+        self.source_type = source_type
+        self.source_id = source_id
+        self.matched_question = matched_question
+        self.context = context
+        self.text_start = text_start
+        self.text_end = text_end
+        self.context_start = context_start
+
+    @classmethod
+    def from_response(cls, item: dict) -> 'Answer':
+        # Only document answers are ever explained with their context
+        document = item['sourceType'] == 'document'
+        return cls(item['answerText'], item['confidence'], item['sourceType'], item['sourceId'],
+                   item.get('matchedQuestion'),
+                   item.get('answerContext') if document else None,
+                   item.get('answerTextStartOffset', 0) if document else 0,
+                   item.get('answerTextEndOffset', 0) if document else 0,
+                   item.get('answerContextStartOffset', 0) if document else 0)
+
+
+class QuestionAnswer:
+    __slots__ = ('question', 'answer')
+
+    def __init__(self, question: str, answer: Answer):
+        self.question = question
+        self.answer = answer
+
+
+class ChannelSession:
+    """Conversation of a bot in one channel: the last question asked, its answers fetched so far, the answer given
+    last, and the answers posted recently by the ts of their message, to learn from reactions to them."""
+    __slots__ = ('question', 'answers', 'cursor', 'offset', 'echo', 'posted')
+
+    # Answers posted earlier than that can't be reacted to anymore
+    MAX_POSTED = 16
+
+    def __init__(self):
+        self.question = None
+        self.answers = ()
+        self.cursor = None  # index in answers of the answer given last
+        self.offset = None  # of the next page of answers, None once there are no more
+        self.echo = False
+        self.posted = None  # ts -> QuestionAnswer, oldest first
+
+    @property
+    def last_answer(self) -> Optional[Answer]:
+        return self.answers[self.cursor] if self.cursor is not None and self.cursor < len(self.answers) else None
+
+    def ask(self, question: str, answers: Tuple[Answer, ...], offset: Optional[int]):
+        self._forget_contexts(len(self.answers))
+        self.question = question
+        self.answers = answers
+        self.cursor = 0
+        self.offset = offset
+
+    def show(self, index: int):
+        """Make answers[index] the answer given last."""
+        self._forget_contexts(index)
+        self.cursor = index
+
+    def _forget_contexts(self, end: int):
+        # Only the answer given last can be explained
+        for answer in self.answers[:end]:
+            answer.context = None
+
+    def add_posted(self, ts: str, question: str, answer: Answer):
+        """Remember the answer to question posted in the message ts, the question may have been asked before the
+        current one."""
+        if self.posted is None:
+            self.posted = {}
+        self.posted[ts] = QuestionAnswer(question, answer)
+        if len(self.posted) > self.MAX_POSTED:
+            del self.posted[next(iter(self.posted))]
+
+    def pop_posted(self, ts: str) -> Optional[QuestionAnswer]:
+        return self.posted.pop(ts, None) if self.posted else None
+
+
+class IndexedDocument:
+    """Slack metadata and content hash of the last version of a document sent to the responder, and the responder's
+    ids of its parts."""
+    __slots__ = ('file_id', 'size', 'updated', 'digest', 'part_ids')
+
+    def __init__(self, file_id: str, size: int, updated: Optional[int], digest: str, part_ids: Tuple[str, ...] = ()):
+        self.file_id = file_id
+        self.size = size
+        self.updated = updated
+        self.digest = digest
+        self.part_ids = part_ids
+
+
+class HistoryCheckpoint:
+    """Progress of learning from a channel's history with .learn, saved after every page of messages.
+
+    A run reads the messages newer than oldest, from the newest one down. Once done, the next run starts from the
+    newest message of this one.
+    """
+    __slots__ = ('cursor', 'oldest', 'newest', 'read', 'learned', 'done')
+
+    def __init__(self, oldest: Optional[str] = None):
+        self.cursor = None  # of the next page to read
+        self.oldest = oldest
+        self.newest = None
+        self.read = 0
+        self.learned = 0
+        self.done = False
+
+
+class StateStore:
+    """Key/value store for conversation state with per-key TTLs (in seconds, None for no expiry).
+
+    The coroutines (aget(), aset()...) are to be used from the event loop: stores that block on I/O run the calls by
+    their own threads.
+    """
+
+    # Threads running the calls of a store that blocks, None to run them on the calling thread
+    _executor = None
+
+    def get(self, key: Key, default=None) -> Any:
+        return self.get_many([key], default)[0]
+
+    def set(self, key: Key, value: Any, ttl: Optional[float] = None):
+        self.set_many({key: value}, ttl)
+
+    def delete(self, key: Key):
+        self.delete_many([key])
+
+    def get_many(self, keys: Iterable[Key], default=None) -> List[Any]:
+        raise NotImplementedError()
+
+    def set_many(self, items: Dict[Key, Any], ttl: Optional[float] = None):
+        raise NotImplementedError()
+
+    def delete_many(self, keys: Iterable[Key]):
+        raise NotImplementedError()
+
+    def add(self, key: Key, value: Any, ttl: Optional[float] = None) -> bool:
+        """Atomically set key only if it is absent (or expired), returns whether it was set."""
+        raise NotImplementedError()
+
+    def delete_group(self, group: Key):
+        """Delete all the keys starting with the two parts of group, in time proportional to their number."""
+        raise NotImplementedError()
+
+    def connect(self):
+        """Open the connection to the store ahead of its first use."""
+        pass
+
+    async def _run(self, method, *args):
+        if self._executor is None:
+            return method(*args)
+        return await asyncio.get_event_loop().run_in_executor(self._executor, method, *args)
+
+    async def aget(self, key: Key, default=None) -> Any:
+        return await self._run(self.get, key, default)
+
+    async def aset(self, key: Key, value: Any, ttl: Optional[float] = None):
+        await self._run(self.set, key, value, ttl)
+
+    async def adelete(self, key: Key):
+        await self._run(self.delete, key)
+
+    async def aget_many(self, keys: Iterable[Key], default=None) -> List[Any]:
+        return await self._run(self.get_many, list(keys), default)
+
+    async def aset_many(self, items: Dict[Key, Any], ttl: Optional[float] = None):
+        await self._run(self.set_many, items, ttl)
+
+    async def adelete_many(self, keys: Iterable[Key]):
+        await self._run(self.delete_many, list(keys))
+
+    async def aadd(self, key: Key, value: Any, ttl: Optional[float] = None) -> bool:
+        return await self._run(self.add, key, value, ttl)
+
+    async def adelete_group(self, group: Key):
+        await self._run(self.delete_group, group)
+
+
+class MemoryStateStore(StateStore):
+    """State local to this process, for single worker deployments and tests, bounded in entries and bytes."""
+
+    def __init__(self, max_entries: int = 100000, max_bytes: Optional[int] = None):
+        self._data = LRUCache(max_entries, max_bytes, group=_group)
+
+    def get_many(self, keys, default=None):
+        return [self._data.get(key, default) for key in keys]
+
+    def set_many(self, items, ttl=None):
+        for key, value in items.items():
+            self._data.set(key, value, ttl)
+
+    def delete_many(self, keys):
+        for key in keys:
+            self._data.pop(key)
+
+    def add(self, key, value, ttl=None):
+        if key in self._data:
+            return False
+        self._data.set(key, value, ttl)
+        return True
+
+    def delete_group(self, group):
+        self._data.pop_group(tuple(group))
+
+    def stats(self) -> dict:
+        return self._data.stats()
+
+
+def _encode_key(key: Key) -> str:
+    return ':'.join(key)
+
+
+class SqliteStateStore(StateStore):
+    """State shared by all the workers of one node through a SQLite database in WAL mode."""
+
+    _PURGE_EVERY = 1000
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connection = None
+        self._pid = None
+        self._writes = 0
+        # The connection is used by one thread at a time
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # Connections must not be shared across forked workers
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS state '
+                                     '(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL)')
+            self._pid = os.getpid()
+        return self._connection
+
+    def connect(self):
+        self.connection
+
+    def get_many(self, keys, default=None):
+        keys = [_encode_key(key) for key in keys]
+        found = {}
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            rows = self.connection.execute(
+                f'SELECT key, value FROM state WHERE key IN ({",".join("?" * len(batch))}) '
+                f'AND (expires IS NULL OR expires > ?)', batch + [time.time()])
+            found.update(rows)
+        return [pickle.loads(found[key]) if key in found else default for key in keys]
+
+    def set_many(self, items, ttl=None):
+        expires = time.time() + ttl if ttl is not None else None
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO state (key, value, expires) VALUES (?, ?, ?)',
+                                        [(_encode_key(key), pickle.dumps(value, pickle.HIGHEST_PROTOCOL), expires)
+                                         for key, value in items.items()])
+        self._writes += len(items)
+        if self._writes >= self._PURGE_EVERY:
+            self._writes = 0
+            self.connection.execute('DELETE FROM state WHERE expires <= ?', (time.time(),))
+
+    def delete_many(self, keys):
+        with self.connection:
+            self.connection.executemany('DELETE FROM state WHERE key = ?', [(_encode_key(key),) for key in keys])
+
+    def add(self, key, value, ttl=None):
+        key = _encode_key(key)
+        now = time.time()
+        with self.connection:
+            self.connection.execute('DELETE FROM state WHERE key = ? AND expires <= ?', (key, now))
+            cursor = self.connection.execute('INSERT OR IGNORE INTO state (key, value, expires) VALUES (?, ?, ?)',
+                                             (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                                              now + ttl if ttl is not None else None))
+            return cursor.rowcount == 1
+
+    def delete_group(self, group):
+        # A range of the primary key, ';' follows the ':' separator
+        prefix = _encode_key(group)
+        with self.connection:
+            self.connection.execute('DELETE FROM state WHERE key >= ? AND key < ?', (prefix + ':', prefix + ';'))
+
+
+class RedisStateStore(StateStore):
+    """State shared by workers on any number of nodes through a Redis protocol server."""
+
+    def __init__(self, url: str, prefix: str = 'cape-slack:', threads: int = 4):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError("The 'redis' package is required to use a redis:// state backend")
+        self.prefix = prefix
+        self._client = redis.StrictRedis.from_url(url)
+        # Each thread uses a connection of the client's pool
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+
+    def connect(self):
+        self._client.ping()
+
+    def _key(self, key: Key) -> str:
+        return self.prefix + _encode_key(key)
+
+    def _group_key(self, group: Key) -> str:
+        # Set of the keys of a group
+        return self.prefix + 'group:' + _encode_key(group)
+
+    def get_many(self, keys, default=None):
+        keys = list(keys)
+        if not keys:
+            return []
+        return [pickle.loads(value) if value is not None else default
+                for value in self._client.mget([self._key(key) for key in keys])]
+
+    def _index(self, pipeline, key: Key, ttl: Optional[float]):
+        group = _group(key)
+        if group is not None:
+            pipeline.sadd(self._group_key(group), self._key(key))
+            # The index outlives the keys last set, members that have expired are deleted in vain
+            if ttl is not None:
+                pipeline.pexpire(self._group_key(group), int(ttl * 1000))
+            else:
+                pipeline.persist(self._group_key(group))
+
+    def set_many(self, items, ttl=None):
+        pipeline = self._client.pipeline(transaction=False)
+        for key, value in items.items():
+            pipeline.set(self._key(key), pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                         px=int(ttl * 1000) if ttl is not None else None)
+            self._index(pipeline, key, ttl)
+        pipeline.execute()
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return
+        pipeline = self._client.pipeline(transaction=False)
+        pipeline.delete(*[self._key(key) for key in keys])
+        for key in keys:
+            group = _group(key)
+            if group is not None:
+                pipeline.srem(self._group_key(group), self._key(key))
+        pipeline.execute()
+
+    def add(self, key, value, ttl=None):
+        added = bool(self._client.set(self._key(key), pickle.dumps(value, pickle.HIGHEST_PROTOCOL), nx=True,
+                                      px=int(ttl * 1000) if ttl is not None else None))
+        if added and _group(key) is not None:
+            pipeline = self._client.pipeline(transaction=False)
+            self._index(pipeline, key, ttl)
+            pipeline.execute()
+        return added
+
+    def delete_group(self, group):
+        group_key = self._group_key(group)
+        keys = self._client.smembers(group_key)
+        pipeline = self._client.pipeline(transaction=False)
+        if keys:
+            pipeline.delete(*keys)
+        pipeline.delete(group_key)
+        pipeline.execute()
+
+
+def create_state_store(url: str, max_entries: int = 100000, max_bytes: Optional[int] = None,
+                       threads: int = 4) -> StateStore:
+    """Create a store from 'memory://', 'sqlite:///path/to/file.db' or 'redis://host:port/db', threads is the number
+    of calls to a Redis server made at the same time."""
+    scheme = urlparse(url).scheme
+    if scheme == 'memory':
+        return MemoryStateStore(max_entries, max_bytes)
+    elif scheme == 'sqlite':
+        return SqliteStateStore(url[len('sqlite://'):] or ':memory:')
+    elif scheme in {'redis', 'rediss', 'unix'}:
+        return RedisStateStore(url, threads=threads)
+    raise ValueError(f"Unsupported state backend: {url}")
@@ -12,42 +12,87 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import requests
-
-
-def send_slack_message(token, channel, text):
-    slack_request = requests.Session()
-    response = slack_request.post('https://slack.com/api/chat.postMessage', params={
-        'token': token,
-        'channel': channel,
-        'text': text
-    })
-    slack_request.close()
-    return response.json()
-
-
-def fetch_slack_file_info(token, file_id):
-    slack_request = requests.Session()
-    response = slack_request.post('https://slack.com/api/files.info', params={
-        'token': token,
-        'file_id': file_id
-    })
-    slack_request.close()
-    return response.json()
-
-
-def add_slack_file_comment(token, file_id, text):
-    slack_request = requests.Session()
-    slack_request.post('https://slack.com/api/files.comments.add', params={
-        'token': token,
-        'file_id': file_id,
-        'comment': text
-    })
-    slack_request.close()
-
-
-def get_slack_file_contents(token, url):
-    slack_request = requests.Session()
-    text = slack_request.get(url, headers={'Authorization': 'Bearer %s' % token}).text
-    slack_request.close()
-    return text
+import asyncio
+from typing import Optional
+
+import aiohttp
+from cape_slack_plugin.slack_settings import slack_api_url, slack_pool_size, slack_pool_per_host, \
+    slack_keepalive_timeout, slack_connect_timeout, slack_request_timeout
+from cape_slack_plugin.slack_metrics import SLACK_API_SECONDS, SLACK_API_ERRORS
+from cape_slack_plugin.slack_profiler import span
+
+# One keep-alive pool per worker, created lazily so that it is bound to the worker's event loop
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_slack_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=slack_pool_size, limit_per_host=slack_pool_per_host,
+                                         keepalive_timeout=slack_keepalive_timeout)
+        _session = aiohttp.ClientSession(connector=connector,
+                                         timeout=aiohttp.ClientTimeout(total=slack_request_timeout,
+                                                                       connect=slack_connect_timeout))
+    return _session
+
+
+async def close_slack_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def warm_slack_session():
+    """Open a pooled connection to the Slack API ahead of the first call."""
+    await slack_api_call('api.test', None)
+
+
+class SlackRateLimited(Exception):
+    def __init__(self, method: str, retry_after: float):
+        super().__init__(f"Slack rate limited {method}, retry after {retry_after}s")
+        self.method = method
+        self.retry_after = retry_after
+
+
+async def slack_api_call(method, token, **params) -> dict:
+    if token is not None:
+        params['token'] = token
+    with SLACK_API_SECONDS.time(method), span('slack:' + method):
+        try:
+            async with get_slack_session().post(slack_api_url + method, data=params) as response:
+                if response.status == 429:
+                    SLACK_API_ERRORS.inc(method, 'ratelimited')
+                    raise SlackRateLimited(method, float(response.headers.get('Retry-After', 1)))
+                try:
+                    result = await response.json(content_type=None)
+                except ValueError:
+                    # e.g. an HTML error page from a proxy
+                    result = {'ok': False, 'error': 'invalid_response'}
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            SLACK_API_ERRORS.inc(method, 'request_failed')
+            raise
+    if not result.get('ok'):
+        SLACK_API_ERRORS.inc(method, result.get('error', 'unknown'))
+    return result
+
+
+async def send_slack_message(token, channel, text):
+    return await slack_api_call('chat.postMessage', token, channel=channel, text=text)
+
+
+async def fetch_slack_file_info(token, file_id):
+    return await slack_api_call('files.info', token, file=file_id)
+
+
+async def fetch_slack_user_info(token, user):
+    return await slack_api_call('users.info', token, user=user)
+
+
+async def update_slack_message(token, channel, ts, text):
+    return await slack_api_call('chat.update', token, channel=channel, ts=ts, text=text)
+
+
+def open_slack_file(token, url):
+    """Request a private file, to be used as `async with open_slack_file(token, url) as response:`."""
+    return get_slack_session().get(url, headers={'Authorization': 'Bearer %s' % token})
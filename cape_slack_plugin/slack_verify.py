@@ -0,0 +1,92 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import hmac
+import re
+import time
+from typing import Mapping, Optional
+
+from cape_slack_plugin.slack_metrics import Gauge
+from cape_slack_plugin.slack_settings import slack_signing_secret, slack_verification, slack_signature_max_skew
+
+# The legacy verification token is read from the raw body, so that forged requests are rejected before their JSON is
+# parsed. Strings and brackets are scanned to find the top-level "token" key, those nested in the event are the
+# sender's to choose
+_JSON_TOKENS = re.compile(rb'"(?:[^"\\]|\\.)*"|[{}\[\]]')
+_TOKEN_VALUE = re.compile(rb'\s*:\s*"([^"\\]*)"')
+
+_rejections = {}
+Gauge('cape_slack_rejected_requests_total', 'Requests rejected as not coming from Slack, by reason',
+      lambda: {(reason,): count for reason, count in _rejections.items()}, ('reason',), kind='counter')
+
+
+def _configured(setting: str) -> bool:
+    return bool(setting) and setting != 'REPLACEME'
+
+
+def _reject(reason: str) -> str:
+    _rejections[reason] = _rejections.get(reason, 0) + 1
+    return reason
+
+
+def sign_request(secret: str, timestamp: str, body: bytes) -> str:
+    """The X-Slack-Signature of a request, see https://api.slack.com/docs/verifying-requests-from-slack."""
+    base = b'v0:' + timestamp.encode() + b':' + body
+    return 'v0=' + hmac.new(secret.encode(), base, hashlib.sha256).hexdigest()
+
+
+def verify_request(headers: Mapping[str, str], body: bytes, now: Optional[float] = None) -> Optional[str]:
+    """Why a request doesn't come from Slack, None if it does.
+
+    Requests are checked against the signing secret and the legacy verification token, whichever are configured.
+    """
+    body = body or b''
+    if _configured(slack_signing_secret):
+        timestamp = headers.get('X-Slack-Request-Timestamp')
+        signature = headers.get('X-Slack-Signature')
+        if not timestamp or not signature:
+            return _reject('unsigned')
+        try:
+            skew = abs((time.time() if now is None else now) - int(timestamp))
+        except ValueError:
+            return _reject('bad_timestamp')
+        if skew > slack_signature_max_skew:
+            # Possibly a replay of a request captured earlier
+            return _reject('stale')
+        if not hmac.compare_digest(signature.encode(), sign_request(slack_signing_secret, timestamp, body).encode()):
+            return _reject('bad_signature')
+    if _configured(slack_verification):
+        token = _top_level_token(body)
+        if token is None:
+            return _reject('no_token')
+        if not hmac.compare_digest(token, slack_verification.encode()):
+            return _reject('bad_token')
+    return None
+
+
+def _top_level_token(body: bytes) -> Optional[bytes]:
+    depth = 0
+    for match in _JSON_TOKENS.finditer(body):
+        token = match.group()
+        if token == b'{' or token == b'[':
+            depth += 1
+        elif token == b'}' or token == b']':
+            depth -= 1
+        elif depth == 1 and token == b'"token"':
+            # Only a key is followed by a colon
+            value = _TOKEN_VALUE.match(body, match.end())
+            if value is not None:
+                return value.group(1)
+    return None
@@ -37,13 +37,13 @@ setup(
     author_email='contact@bloomsbury.ai',
     packages=PACKAGES,
     include_package_data=True,
-    install_requires=['Authomatic==0.1.0.post1',
+    install_requires=['aiohttp==3.3.2',
+                      'Authomatic==0.1.0.post1',
                       'beautifulsoup4==4.6.0',
                       'markdown==2.6.11',
                       'numexpr==2.6.5.dev0',
                       'pytest==3.6.4',
                       'peewee==3.5.2',
-                      'requests==2.18.1',
                       'sanic==0.6.0',
                       'cape_api_helpers==' + _get_github_sha(
                           'git+https://github.com/bloomsburyai/cape-api-helpers#egg=cape_api_helpers'),
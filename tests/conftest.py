@@ -0,0 +1,67 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The plugin runs against the fakes of benchmarks/, which stand in for the Slack API and the Cape services.
+
+The settings are read when the plugin is imported, so the fake Slack API is started and the fake Cape modules are
+installed before any test module is collected.
+"""
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+from fake_cape import FakeCape
+from fake_slack import FakeSlackApi
+
+_LOOP = asyncio.new_event_loop()
+asyncio.set_event_loop(_LOOP)
+_SLACK = FakeSlackApi()
+os.environ['CAPE_SLACK_API_URL'] = _LOOP.run_until_complete(_SLACK.start())
+os.environ['CAPE_SLACK_EVENT_MODE'] = 'inline'
+os.environ['CAPE_SLACK_CHANNEL_RATE'] = '1000'
+os.environ['CAPE_SLACK_TENANT_RATE'] = '1000'
+os.environ['CAPE_SLACK_TENANT_BURST'] = '1000'
+os.environ['CAPE_SLACK_LEARN_RATE'] = '1000'
+os.environ['CAPE_SLACK_LEARN_PAGE_SIZE'] = '10'
+_CAPE = FakeCape()
+_CAPE.install()
+
+
+@pytest.fixture(scope='session', autouse=True)
+def _stop_fakes():
+    yield
+    from cape_slack_plugin.slack_utils import close_slack_session
+    _LOOP.run_until_complete(close_slack_session())
+    _LOOP.run_until_complete(_SLACK.stop())
+
+
+@pytest.fixture
+def run():
+    return _LOOP.run_until_complete
+
+
+@pytest.fixture
+def slack() -> FakeSlackApi:
+    return _SLACK
+
+
+@pytest.fixture
+def cape() -> FakeCape:
+    return _CAPE
@@ -0,0 +1,103 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+import pytest
+
+from cape_slack_plugin.slack_answers import AnswerCache, normalize_question
+from cape_slack_plugin.slack_state import MemoryStateStore
+
+
+class _Responder:
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.calls = 0
+
+    async def answer(self) -> dict:
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return {'success': True, 'answer': self.calls}
+
+
+def test_questions_are_normalized():
+    assert normalize_question('  How do I  reset my password?? ') == normalize_question('how do i reset my password')
+
+
+def test_concurrent_identical_questions_share_one_call(run):
+    cache = AnswerCache(100, ttl=60)
+    responder = _Responder(delay=0.05)
+
+    async def ask():
+        return await asyncio.gather(*(cache.get_or_fetch('UBOT1', question, (), responder.answer)
+                                      for question in ['Where is it?', 'where is it', 'WHERE IS IT?!']))
+
+    assert run(ask()) == [{'success': True, 'answer': 1}] * 3
+    assert responder.calls == 1 and cache.coalesced == 2
+    # And later ones are answered from the cache
+    assert run(cache.get_or_fetch('UBOT1', 'Where is it?', (), responder.answer))['answer'] == 1
+
+
+def test_failed_call_is_shared_and_not_cached(run):
+    cache = AnswerCache(100, ttl=60)
+    calls = []
+
+    async def fail():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise RuntimeError('responder down')
+
+    async def ask():
+        return await asyncio.gather(cache.get_or_fetch('UBOT1', 'Why?', (), fail),
+                                    cache.get_or_fetch('UBOT1', 'Why?', (), fail), return_exceptions=True)
+
+    assert [str(result) for result in run(ask())] == ['responder down'] * 2
+    with pytest.raises(RuntimeError):
+        run(cache.get_or_fetch('UBOT1', 'Why?', (), fail))
+    assert len(calls) == 2
+
+
+def test_uncacheable_results_are_fetched_again(run):
+    cache = AnswerCache(100, ttl=60)
+    responder = _Responder()
+    for _ in range(2):
+        run(cache.get_or_fetch('UBOT1', 'Why?', (), responder.answer, cacheable=lambda result: False))
+    assert responder.calls == 2
+
+
+@pytest.mark.parametrize('shared', [False, True])
+def test_invalidate_only_drops_the_bots_answers(run, shared):
+    store = MemoryStateStore() if shared else None
+    cache = AnswerCache(100, ttl=60, store=store)
+    responder = _Responder()
+    for bot_id in ('UBOT1', 'UBOT2'):
+        run(cache.get_or_fetch(bot_id, 'Why?', (), responder.answer))
+    run(cache.invalidate('UBOT1'))
+    assert run(cache.get_or_fetch('UBOT1', 'Why?', (), responder.answer))['answer'] == 3
+    assert run(cache.get_or_fetch('UBOT2', 'Why?', (), responder.answer))['answer'] == 2
+    if shared:
+        # Invalidated through another worker sharing the store
+        other = AnswerCache(100, ttl=60, store=store)
+        run(other.invalidate('UBOT2'))
+        assert run(cache.get_or_fetch('UBOT2', 'Why?', (), responder.answer))['answer'] == 4
+
+
+def test_forgotten_bot_starts_afresh(run):
+    cache = AnswerCache(100, ttl=60)
+    responder = _Responder()
+    run(cache.get_or_fetch('UBOT1', 'Why?', (), responder.answer))
+    run(cache.forget_bot('UBOT1'))
+    assert run(cache.get_or_fetch('UBOT1', 'Why?', (), responder.answer))['answer'] == 2
+    assert cache.stats()['entries'] == 1
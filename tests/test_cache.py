@@ -0,0 +1,69 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+from cape_slack_plugin.slack_cache import approximate_size, LRUCache
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = LRUCache(max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert 'b' not in cache and cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats()['evictions'] == 1
+
+
+def test_entries_are_evicted_to_stay_within_the_byte_budget():
+    cache = LRUCache(max_entries=100, max_bytes=10, sizeof=len)
+    cache.set('a', 'xxx')
+    cache.set('b', 'xxx')
+    assert cache.nbytes == 8
+    cache.set('c', 'xxxx')
+    assert 'a' not in cache and cache.nbytes == 9
+    # Replacing a value accounts for its new size
+    cache.set('b', 'x')
+    assert cache.nbytes == 7 and len(cache) == 2
+    cache.pop('c')
+    assert cache.nbytes == 2
+
+
+def test_entries_expire_after_their_ttl():
+    cache = LRUCache(max_entries=10, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=0.01)
+    time.sleep(0.02)
+    assert cache.get('b', 'expired') == 'expired'
+    assert cache.get('a') == 1
+    assert cache.stats()['expirations'] == 1
+
+
+def test_pop_group_only_removes_its_keys():
+    cache = LRUCache(max_entries=10, group=lambda key: key[0])
+    cache.set(('UBOT1', 'a'), 1)
+    cache.set(('UBOT1', 'b'), 2)
+    cache.set(('UBOT2', 'a'), 3)
+    assert cache.pop_group('UBOT1') == 2
+    assert len(cache) == 1 and cache.get(('UBOT2', 'a')) == 3
+    # Popped keys leave their group too
+    cache.set(('UBOT3', 'a'), 4)
+    cache.pop(('UBOT3', 'a'))
+    assert cache.pop_group('UBOT3') == 0
+
+
+def test_approximate_size_follows_containers():
+    assert approximate_size(['x' * 1000]) > 1000
+    assert approximate_size({'key': 'x' * 1000}) > 1000
@@ -0,0 +1,55 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from uuid import uuid4
+
+import pytest
+from fake_cape import FakeRequest
+
+from cape_slack_plugin import slack_events
+from cape_slack_plugin.slack_state import ChannelSession
+
+
+@pytest.fixture
+def say(run, slack):
+    channel = 'D' + uuid4().hex[:8].upper()
+
+    def say(text: str) -> list:
+        """Send a message to the bot, returns the messages it posted in reply."""
+        posted = len(slack.posted)
+        run(slack_events.receive_event(FakeRequest({
+            'event_id': uuid4().hex, 'authed_users': ['UBOT1'],
+            'event': {'type': 'message', 'channel': channel, 'user': 'U1', 'text': text, 'ts': '1.0'}})))
+        return [text for _, posted_channel, text in slack.posted[posted:] if posted_channel == channel]
+
+    say.channel = channel
+    return say
+
+
+def test_why_needs_a_question(say):
+    assert say('.why') == ['Please ask a question first.']
+
+
+def test_why_explains_the_last_answer(say):
+    assert say('How do I reset my password?') == ['answer to How do I reset my password?']
+    assert say('.why')[0].startswith('From _runbook.md_ (Index 0.90)')
+
+
+def test_why_after_a_question_without_answers(run, say):
+    session = ChannelSession()
+    session.ask('What is the meaning of life?', (), None)
+    bot = run(slack_events.get_bot('UBOT1'))
+    run(slack_events._save_session(bot, say.channel, session))
+    assert say('.why') == ["I didn't find an answer to your last question."]
+    assert say('.next') == ["I'm afraid I've run out of answers to that question."]
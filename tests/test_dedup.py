@@ -0,0 +1,58 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+from cape_slack_plugin.slack_dedup import EventDeduplicator
+from cape_slack_plugin.slack_state import MemoryStateStore
+
+
+def test_event_is_a_duplicate_within_the_window(run):
+    dedup = EventDeduplicator(window=0.05)
+    assert run(dedup.add('E1'))
+    assert not run(dedup.add('E1'))
+    assert dedup.duplicates == 1
+    time.sleep(0.06)
+    assert run(dedup.add('E1'))
+
+
+def test_expired_ids_are_dropped(run):
+    dedup = EventDeduplicator(window=0.05)
+    for number in range(100):
+        run(dedup.add(f'E{number}'))
+    time.sleep(0.06)
+    run(dedup.add('E100'))
+    assert len(dedup) == 1
+
+
+def test_discarded_event_is_processed_again(run):
+    dedup = EventDeduplicator(window=60, store=MemoryStateStore())
+    assert run(dedup.add('E1'))
+    run(dedup.discard('E1'))
+    assert run(dedup.add('E1'))
+
+
+def test_retry_received_by_another_worker_is_a_duplicate(run):
+    store = MemoryStateStore()
+    worker, other = EventDeduplicator(window=60, store=store), EventDeduplicator(window=60, store=store)
+    assert run(worker.add('E1'))
+    assert not run(other.add('E1'))
+
+
+def test_restored_ids_are_remembered_until_their_window_ends(run):
+    dedup = EventDeduplicator(window=60)
+    dedup.restore('E1', time.time() - 30)
+    dedup.restore('E2', time.time() - 90)
+    assert not run(dedup.add('E1'))
+    assert run(dedup.add('E2'))
@@ -0,0 +1,65 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from cape_slack_plugin import slack_commands
+from cape_slack_plugin.slack_commands import command, find_command
+
+
+@pytest.fixture
+def commands(monkeypatch):
+    # The plugin's own commands are back once the test is done
+    monkeypatch.setattr(slack_commands, '_COMMANDS', {})
+    monkeypatch.setattr(slack_commands, '_COMMAND_PATTERN', None)
+    monkeypatch.setattr(slack_commands, '_compiled', False)
+
+
+def test_longest_command_wins(commands):
+    @command('.add')
+    async def add(*args):
+        pass
+
+    @command('.addall')
+    async def add_all(*args):
+        pass
+
+    assert find_command('.add how? | like this') is add
+    assert find_command('.addall questions.txt') is add_all
+
+
+def test_messages_must_start_with_a_command(commands):
+    @command('.help', '.h')
+    async def help_(*args):
+        pass
+
+    assert find_command('.h') is help_
+    assert find_command('please .help') is None
+    assert find_command('.unknown') is None
+
+
+def test_commands_registered_after_a_lookup_are_found(commands):
+    assert find_command('.next') is None
+
+    @command('.next')
+    async def next_(*args):
+        pass
+
+    assert find_command('.next') is next_
+
+
+def test_plugin_commands_are_registered():
+    from cape_slack_plugin import slack_events
+    assert find_command('.more') is slack_events._next
+    assert find_command('.why') is slack_events._explain
@@ -0,0 +1,115 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import time
+
+import pytest
+
+from cape_slack_plugin.slack_fairness import FairScheduler, parse_weights, TenantBusy
+
+
+def _scheduler(**kwargs) -> FairScheduler:
+    settings = dict(concurrency=1, bot_concurrency=1, bot_rate=1000, bot_burst=1000, max_waiting=100)
+    settings.update(kwargs)
+    return FairScheduler(**settings)
+
+
+async def _submit(scheduler: FairScheduler, calls: dict) -> list:
+    """Submit calls (bot id -> number of calls) in that order, returns the bot ids in the order the calls ran."""
+    started = []
+
+    def call(bot_id):
+        async def run():
+            started.append(bot_id)
+            await asyncio.sleep(0.001)
+        return run
+
+    await asyncio.gather(*(scheduler.run(bot_id, call(bot_id)) for bot_id, number in calls.items()
+                           for _ in range(number)))
+    return started
+
+
+def test_busy_bot_only_delays_others_by_its_fair_share(run):
+    started = run(_submit(_scheduler(), {'UBOT1': 10, 'UBOT2': 3}))
+    # Taking turns once both are waiting, rather than the second bot waiting for all of the first one's calls
+    assert started[:7].count('UBOT2') == 3
+
+
+def test_weights_share_calls_in_proportion(run):
+    scheduler = _scheduler(weights=parse_weights('UBOT1=2, UBOT2=1'))
+    started = run(_submit(scheduler, {'UBOT1': 20, 'UBOT2': 20}))
+    assert started[:15].count('UBOT1') == 10
+
+
+def test_bot_rate_is_enforced(run):
+    scheduler = _scheduler(concurrency=4, bot_concurrency=4, bot_rate=50, bot_burst=1)
+    started = time.monotonic()
+    run(_submit(scheduler, {'UBOT1': 5}))
+    # The first call uses the burst, the other four wait 20ms each
+    assert time.monotonic() - started >= 0.075
+
+
+def test_bot_is_refused_once_too_many_of_its_calls_wait(run):
+    scheduler = _scheduler(max_waiting=2)
+
+    async def submit():
+        release = asyncio.Event()
+        running = asyncio.ensure_future(scheduler.run('UBOT1', release.wait))
+        await asyncio.sleep(0)
+        waiting = [asyncio.ensure_future(scheduler.run('UBOT1', release.wait)) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(TenantBusy):
+            await scheduler.run('UBOT1', release.wait)
+        # Other bots still get their turn
+        other = asyncio.ensure_future(scheduler.run('UBOT2', release.wait))
+        release.set()
+        await asyncio.gather(running, other, *waiting)
+
+    run(submit())
+    assert scheduler.rejected == 1
+    assert scheduler.stats()['running'] == 0 and scheduler.waiting() == 0
+
+
+def test_delayed_call_is_noticed(run):
+    scheduler = _scheduler()
+    notices = []
+
+    async def submit():
+        first = asyncio.ensure_future(scheduler.run('UBOT1', lambda: asyncio.sleep(0.05)))
+        await asyncio.sleep(0)
+        await scheduler.run('UBOT2', lambda: asyncio.sleep(0), on_delay=lambda: notices.append('busy'),
+                            delay_notice=0.01)
+        await first
+
+    run(submit())
+    assert notices == ['busy'] and scheduler.delayed == 1
+
+
+def test_cancelled_waiting_call_gives_its_turn_up(run):
+    scheduler = _scheduler()
+
+    async def submit():
+        release = asyncio.Event()
+        running = asyncio.ensure_future(scheduler.run('UBOT1', release.wait))
+        await asyncio.sleep(0)
+        waiting = asyncio.ensure_future(scheduler.run('UBOT2', release.wait))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        release.set()
+        await running
+        return await scheduler.run('UBOT3', lambda: asyncio.sleep(0, 'ran'))
+
+    assert run(submit()) == 'ran'
+    assert scheduler.waiting() == 0
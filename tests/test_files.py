@@ -0,0 +1,65 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import logging
+from uuid import uuid4
+
+from fake_cape import FakeRequest
+
+from cape_slack_plugin import slack_events
+
+
+def _share(run, slack, name: str, text: str = '') -> str:
+    """Share a file with the bot, returns its last reply, as edited, once its background tasks are done."""
+    channel = 'D' + uuid4().hex[:8].upper()
+    shared = slack.add_file('F' + uuid4().hex[:8].upper(), name, b'# Runbook\n\nRestart the service.\n', 'markdown')
+
+    async def share():
+        await slack_events.receive_event(FakeRequest({
+            'event_id': uuid4().hex, 'authed_users': ['UBOT1'],
+            'event': {'type': 'message', 'subtype': 'file_share', 'channel': channel, 'user': 'U1', 'text': text,
+                      'file': {'id': shared['id']}, 'ts': '1.0'}}))
+        while slack_events._background_tasks:
+            await asyncio.wait(list(slack_events._background_tasks))
+
+    run(share())
+    edited = [text for _, edited_channel, _, text in slack.edited if edited_channel == channel]
+    return edited[-1] if edited else [text for _, posted_channel, text in slack.posted if posted_channel == channel][-1]
+
+
+def test_file_is_indexed(run, slack):
+    assert _share(run, slack, 'runbook.md') == 'File uploaded'
+
+
+def test_failed_ingestion_ends_its_progress_message(run, slack, monkeypatch, caplog):
+    async def fail(*args):
+        raise RuntimeError('responder down')
+
+    monkeypatch.setattr(slack_events, '_index_file', fail)
+    with caplog.at_level(logging.ERROR):
+        reply = _share(run, slack, 'broken.md')
+    assert reply == "Sorry, something went wrong while reading _broken.md_."
+    assert any(record.exc_info and record.exc_info[1].args == ('responder down',) for record in caplog.records)
+
+
+def test_failed_import_ends_its_progress_message(run, slack, monkeypatch, caplog):
+    async def fail(*args):
+        raise RuntimeError('responder down')
+
+    monkeypatch.setattr(slack_events, '_import_file', fail)
+    with caplog.at_level(logging.ERROR):
+        reply = _share(run, slack, 'replies.txt', '.import')
+    assert reply == "Sorry, something went wrong while importing _replies.txt_."
+    assert any(record.exc_info and record.exc_info[1].args == ('responder down',) for record in caplog.records)
@@ -0,0 +1,64 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from cape_slack_plugin.slack_history import find_question_answers
+
+
+def _message(user, ts, text, **fields):
+    return dict(type='message', user=user, ts=ts, text=text, **fields)
+
+
+def test_thread_answer_is_the_most_approved_reply():
+    question = _message('U1', '1.1', 'How do I reset my password?', reply_count=3)
+    replies = [_message('U2', '1.2', 'Have you tried turning it off and on?'),
+               _message('U3', '1.3', 'Go to settings and click reset.', reactions=[{'name': 'thumbsup', 'count': 2}]),
+               _message('U1', '1.4', 'Thanks, that worked!')]
+    assert find_question_answers([question], {'1.1': replies}) == \
+        [('How do I reset my password?', 'Go to settings and click reset.')]
+
+
+def test_thread_answer_defaults_to_the_first_reply_by_someone_else():
+    question = _message('U1', '1.1', 'Where are the release notes?', reply_count=3)
+    replies = [_message('U1', '1.2', 'Anyone? I need them today please.'),
+               _message('U2', '1.3', 'thanks'),
+               _message('U3', '1.4', 'In the wiki, under Releases.')]
+    assert find_question_answers([question], {'1.1': replies}) == \
+        [('Where are the release notes?', 'In the wiki, under Releases.')]
+
+
+def test_channel_answer_needs_a_positive_reaction():
+    messages = [_message('U2', '4.0', 'You need to clear the cache.', reactions=[{'name': '+1', 'count': 1}]),
+                _message('U1', '3.0', 'Why is the build failing?'),
+                _message('U2', '2.0', 'Probably the network again.'),
+                _message('U1', '1.0', 'Why is the VPN slow?')]
+    assert find_question_answers(messages, {}) == [('Why is the build failing?', 'You need to clear the cache.')]
+
+
+def test_channel_answer_can_be_on_the_previous_page():
+    # The oldest message of the previous page follows the newest message of this one
+    following = _message('U2', '2.0', 'Restart the deploy job.', reactions=[{'name': 'white_check_mark', 'count': 1}])
+    messages = [_message('U1', '1.0', 'How do I unblock the deploy?')]
+    assert find_question_answers(messages, {}, following) == \
+        [('How do I unblock the deploy?', 'Restart the deploy job.')]
+    assert find_question_answers([following], {}) == []
+
+
+def test_bots_mentions_and_repeated_questions():
+    messages = [_message('U3', '6.0', 'Open a ticket with IT support.', reactions=[{'name': 'clap', 'count': 1}]),
+                _message('U1', '5.0', 'how do I get a new laptop?'),
+                _message('U2', '4.0', 'Ask <@U9> for a laptop from the stock.', reactions=[{'name': 'ok', 'count': 1}]),
+                _message('U1', '3.0', '<@UBOT1> How do I get a new laptop?'),
+                {'type': 'message', 'subtype': 'bot_message', 'bot_id': 'B1', 'ts': '2.0', 'text': 'Is this it?'},
+                _message('U1', '1.0', 'Is anyone around?')]
+    assert find_question_answers(messages, {}) == [('How do I get a new laptop?', 'Ask  for a laptop from the stock.')]
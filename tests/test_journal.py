@@ -0,0 +1,129 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import sqlite3
+from uuid import uuid4
+
+import pytest
+from fake_cape import FakeRequest
+
+from cape_slack_plugin import slack_events
+from cape_slack_plugin.slack_journal import EventJournal
+
+
+@pytest.fixture
+def path(tmp_path) -> str:
+    return str(tmp_path / 'events.db')
+
+
+def _journal(path: str, **kwargs) -> EventJournal:
+    return EventJournal(path, commit_interval=0.01, retention=600, **kwargs)
+
+
+def test_concurrent_appends_share_a_commit(run, path):
+    journal = _journal(path)
+
+    async def append():
+        return await asyncio.gather(*(journal.append(f'E{number}', {'number': number}) for number in range(50)))
+
+    assert run(append()) == [True] * 50
+    assert journal.stats() == {'commits': 1, 'appended': 50}
+    # A retry of an event already journaled
+    assert run(journal.append('E7', {'number': 7})) is False
+    run(journal.close())
+
+
+def test_recover_replays_unfinished_events_in_order(run, path):
+    journal = _journal(path)
+    for number in range(4):
+        run(journal.append(f'E{number}', {'number': number}))
+    journal.complete('E1')
+    run(journal.close())
+
+    restarted = _journal(path)
+    seen, unfinished = restarted.recover()
+    assert [event_id for event_id, _ in seen] == ['E0', 'E1', 'E2', 'E3']
+    assert unfinished == [('E0', {'number': 0}), ('E2', {'number': 2}), ('E3', {'number': 3})]
+    run(restarted.close())
+
+
+def test_events_are_given_up_after_max_attempts(run, path):
+    journal = _journal(path)
+    run(journal.append('E0', {}))
+    run(journal.close())
+    for attempt in range(2):
+        restarted = _journal(path, max_attempts=2)
+        assert restarted.recover()[1] == [('E0', {})]
+        # Stopped again before processing it
+        run(restarted.close())
+
+    restarted = _journal(path, max_attempts=2)
+    seen, unfinished = restarted.recover()
+    assert unfinished == []
+    assert [event_id for event_id, _ in seen] == ['E0']
+    run(restarted.close())
+
+
+def test_events_are_taken_over_once_their_lease_expires(run, path):
+    running = _journal(path, lease=0.2)
+    running.start()
+    run(running.append('E0', {}))
+
+    other = _journal(path)
+    assert other.recover()[1] == []
+    # Renewed while the loop runs
+    run(asyncio.sleep(0.3))
+    assert other.recover()[1] == []
+
+    # Stopped without closing its journal
+    running._renewing.cancel()
+    run(asyncio.sleep(0.3))
+    assert other.recover()[1] == [('E0', {})]
+    assert running.recover()[1] == []
+    run(other.close())
+    run(running.close())
+
+
+def _done(path: str, event_id: str) -> bool:
+    with sqlite3.connect(path) as connection:
+        return connection.execute('SELECT done FROM events WHERE event_id = ?', (event_id,)).fetchone()[0] == 1
+
+
+def test_event_is_complete_once_its_background_job_is(run, path, slack, monkeypatch):
+    journal = _journal(path)
+    monkeypatch.setattr(slack_events, '_journal', journal)
+    indexing = asyncio.Event()
+
+    async def index_file(*args):
+        await indexing.wait()
+
+    monkeypatch.setattr(slack_events, '_index_file', index_file)
+    shared = slack.add_file('F' + uuid4().hex[:8].upper(), 'runbook.md', b'# Runbook\n', 'markdown')
+    event_id = uuid4().hex
+
+    async def share():
+        await slack_events.receive_event(FakeRequest({
+            'event_id': event_id, 'authed_users': ['UBOT1'],
+            'event': {'type': 'message', 'subtype': 'file_share', 'channel': 'DFILES', 'user': 'U1', 'text': '',
+                      'file': {'id': shared['id']}, 'ts': '1.0'}}))
+        await asyncio.sleep(0.05)
+        assert not _done(path, event_id)
+        indexing.set()
+        await asyncio.wait(list(slack_events._background_tasks))
+        await asyncio.sleep(0.05)
+        assert _done(path, event_id)
+
+    run(share())
+    run(journal.close())
@@ -0,0 +1,112 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from uuid import uuid4
+
+import pytest
+from fake_cape import FakeRequest
+
+from cape_slack_plugin import slack_events
+from cape_slack_plugin.slack_records import invalidate_bot
+
+_ADMIN = 'UADMIN'
+
+
+def _history(channel: str, questions: int, first_ts: int = 1500000000) -> list:
+    """A channel where every question is answered by the next message, approved with a reaction."""
+    messages = []
+    for number in range(questions):
+        ts = first_ts + number
+        messages.append({'type': 'message', 'user': 'U1', 'ts': f'{ts}.000001',
+                         'text': f'How do I fix problem {channel} {number}?'})
+        messages.append({'type': 'message', 'user': 'U2', 'ts': f'{ts}.000002',
+                         'text': f'Restart the service behind problem {number}.',
+                         'reactions': [{'name': 'thumbsup', 'count': 1}]})
+    return messages
+
+
+async def _learn(channel: str):
+    await slack_events.receive_event(FakeRequest({
+        'event_id': uuid4().hex, 'authed_users': ['UBOT1'],
+        'event': {'type': 'message', 'channel': 'DADMIN', 'user': _ADMIN, 'text': f'.learn <#{channel}|support>',
+                  'ts': '1.0'}}))
+
+
+async def _finish_learning():
+    while slack_events._background_tasks:
+        await asyncio.wait(list(slack_events._background_tasks))
+
+
+def _checkpoint(channel: str):
+    return slack_events._state.get(('learn', 'UBOT1', channel))
+
+
+@pytest.fixture
+def channel(slack):
+    channel = 'C' + uuid4().hex[:8].upper()
+    slack.admins.add(_ADMIN)
+    slack.add_history(channel, _history(channel, 50))
+    return channel
+
+
+def test_learn_resumes_from_its_checkpoint(run, slack, channel):
+    async def interrupted():
+        await _learn(channel)
+        # Stop after the first pages, as a restart would
+        while (_checkpoint(channel) is None or _checkpoint(channel).read < 30) and slack_events._background_tasks:
+            await asyncio.sleep(0.001)
+        for task in list(slack_events._background_tasks):
+            task.cancel()
+        await asyncio.wait(list(slack_events._background_tasks))
+    run(interrupted())
+    stopped = _checkpoint(channel)
+    assert not stopped.done and stopped.cursor is not None
+    read = stopped.read
+    pages = slack.calls['conversations.history']
+
+    run(_learn(channel))
+    run(_finish_learning())
+    checkpoint = _checkpoint(channel)
+    assert checkpoint.done
+    assert checkpoint.read == 100
+    assert checkpoint.learned == 50
+    # Only the pages left were read
+    assert slack.calls['conversations.history'] - pages == (100 - read) // 10
+
+
+def test_learn_again_only_reads_new_messages(run, slack, channel):
+    run(_learn(channel))
+    run(_finish_learning())
+    assert _checkpoint(channel).learned == 50
+
+    slack.history[channel] += _history(channel, 3, first_ts=1600000000)
+    pages = slack.calls['conversations.history']
+    run(_learn(channel))
+    run(_finish_learning())
+    checkpoint = _checkpoint(channel)
+    assert checkpoint.done and checkpoint.read == 6 and checkpoint.learned == 3
+    assert slack.calls['conversations.history'] - pages == 1
+
+
+def test_removed_bot_forgets_its_checkpoints(run, cape, channel):
+    run(_learn(channel))
+    run(_finish_learning())
+    assert _checkpoint(channel) is not None
+    try:
+        run(slack_events.process_app_uninstalled('UBOT1'))
+        assert _checkpoint(channel) is None
+    finally:
+        cape.deleted_bots.discard('UBOT1')
+        run(invalidate_bot('UBOT1'))
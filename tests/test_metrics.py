@@ -0,0 +1,48 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from cape_slack_plugin import slack_metrics
+from cape_slack_plugin.slack_metrics import Counter, Gauge, Histogram
+
+
+@pytest.fixture
+def enabled(monkeypatch):
+    monkeypatch.setattr(slack_metrics, 'slack_metrics_enabled', True)
+
+
+def test_missing_label_values_are_rendered(enabled):
+    counter = Counter('test_events_total', 'Events by type', ('type',))
+    counter.inc('message')
+    counter.inc(None)
+    counter.inc('message')
+    histogram = Histogram('test_stage_seconds', 'Seconds by stage', ('stage',), buckets=(0.1, 1.0))
+    histogram.observe(0.5, None)
+    histogram.observe(0.05, 'dedup')
+    assert list(counter.lines()) == ['test_events_total{type="None"} 1.0', 'test_events_total{type="message"} 2.0']
+    assert 'test_stage_seconds_bucket{stage="None",le="1.0"} 1' in list(histogram.lines())
+    assert 'test_stage_seconds_count{stage="dedup"} 1' in list(histogram.lines())
+
+
+def test_gauge_labels_and_render(enabled):
+    gauge = Gauge('test_queue_depth', 'Depth by queue', lambda: {('b',): 2, (None,): 1}, ('queue',))
+    assert list(gauge.lines()) == ['test_queue_depth{queue="None"} 1.0', 'test_queue_depth{queue="b"} 2.0']
+    assert '# TYPE test_queue_depth gauge\ntest_queue_depth{queue="None"} 1.0' in slack_metrics.render()
+
+
+def test_disabled_metrics_record_nothing():
+    counter = Counter('test_disabled_total', 'Nothing')
+    counter.inc()
+    assert list(counter.lines()) == []
@@ -0,0 +1,70 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import time
+
+import pytest
+
+from cape_slack_plugin.slack_numerical import NumericalEvaluator
+
+
+def _evaluate(question: str):
+    if question == 'pathological':
+        time.sleep(60)
+    return question, str(eval(question, {'__builtins__': {}}))
+
+
+@pytest.fixture
+def evaluator():
+    evaluator = NumericalEvaluator(_evaluate, processes=1, timeout=0.5)
+    yield evaluator
+    evaluator.close()
+
+
+def test_expression_is_evaluated(run, evaluator):
+    assert run(evaluator.evaluate('6*7')) == ('6*7', '42')
+
+
+def test_pathological_expression_is_given_up_and_its_process_replaced(run, evaluator):
+    run(evaluator.evaluate('1+1'))
+    started = time.monotonic()
+    assert run(evaluator.evaluate('pathological')) is None
+    assert time.monotonic() - started < 5
+    assert evaluator.timeouts == 1
+    assert run(evaluator.evaluate('2+2')) == ('2+2', '4')
+
+
+def test_expressions_are_skipped_while_the_processes_are_busy(run, evaluator):
+    async def busy():
+        run_away = asyncio.ensure_future(evaluator.evaluate('pathological'))
+        await asyncio.sleep(0.1)
+        skipped = await evaluator.evaluate('3+3')
+        return skipped, await run_away
+
+    assert run(busy()) == (None, None)
+    assert evaluator.skipped == 1 and evaluator.timeouts == 1
+
+
+def test_abandoned_expression_still_times_out(run, evaluator):
+    async def abandoned():
+        task = asyncio.ensure_future(evaluator.evaluate('pathological'))
+        await asyncio.sleep(0.1)
+        # As when the responder answered confidently first
+        task.cancel()
+        await asyncio.sleep(0.6)
+        return await evaluator.evaluate('4+4')
+
+    assert run(abandoned()) == ('4+4', '8')
+    assert evaluator.timeouts == 1
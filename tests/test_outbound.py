@@ -0,0 +1,158 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from uuid import uuid4
+
+import pytest
+
+from cape_slack_plugin import slack_outbound
+from cape_slack_plugin.slack_outbound import OutboundScheduler, ProgressMessage, PRIORITY_ANSWER, PRIORITY_REPLY, \
+    PRIORITY_NOTICE
+
+
+@pytest.fixture
+def channel() -> str:
+    return 'C' + uuid4().hex[:8].upper()
+
+
+def _scheduler(**kwargs) -> OutboundScheduler:
+    settings = dict(channel_rate=1000, channel_burst=1, workspace_rate=1000, workspace_burst=10, max_retries=3,
+                    coalesce=True)
+    settings.update(kwargs)
+    return OutboundScheduler(**settings)
+
+
+def _posted(slack, channel: str) -> list:
+    return [text for _, posted_channel, text in slack.posted if posted_channel == channel]
+
+
+def test_answers_are_sent_before_replies_and_notices(run, slack, channel):
+    scheduler = _scheduler()
+
+    async def post():
+        # Queued together, before the channel's lane runs
+        futures = [scheduler.post('xoxb-1', channel, 'notice', PRIORITY_NOTICE),
+                   scheduler.post('xoxb-1', channel, 'reply', PRIORITY_REPLY),
+                   scheduler.post('xoxb-1', channel, 'answer', PRIORITY_ANSWER)]
+        responses = await asyncio.gather(*futures)
+        await scheduler.drain(1)
+        return responses
+
+    assert all(response['ok'] for response in run(post()))
+    assert _posted(slack, channel) == ['answer', 'reply', 'notice']
+
+
+def test_rate_limited_message_is_retried_after_retry_after(run, slack, channel, monkeypatch):
+    scheduler = _scheduler()
+    monkeypatch.setattr(slack, 'ratelimit_probability', 1.0)
+    monkeypatch.setattr(slack, 'retry_after', 0.2)
+
+    async def post():
+        future = scheduler.post('xoxb-1', channel, 'hello')
+        await asyncio.sleep(0.1)
+        # Retried once Slack stops rate limiting, not before Retry-After
+        slack.ratelimit_probability = 0.0
+        assert not future.done()
+        return await future
+
+    assert run(post())['ok']
+    assert scheduler.rate_limited >= 1
+    assert _posted(slack, channel) == ['hello']
+    run(scheduler.drain(1))
+
+
+def test_rate_limited_message_is_given_up_after_max_retries(run, slack, channel, monkeypatch):
+    scheduler = _scheduler(max_retries=1)
+    monkeypatch.setattr(slack, 'ratelimit_probability', 1.0)
+    monkeypatch.setattr(slack, 'retry_after', 0.01)
+    assert run(scheduler.post('xoxb-1', channel, 'hello')) == {'ok': False, 'error': 'ratelimited'}
+    assert scheduler.rate_limited == 2
+    run(scheduler.drain(1))
+
+
+def test_only_acknowledgements_of_the_same_priority_are_coalesced(run, slack, channel, monkeypatch):
+    scheduler = _scheduler()
+    monkeypatch.setattr(slack_outbound, '_MAX_COALESCED_LENGTH', 30)
+
+    async def post():
+        futures = [scheduler.post('xoxb-1', channel, 'thanks 1', PRIORITY_NOTICE, coalesce=True),
+                   scheduler.post('xoxb-1', channel, 'thanks 2', PRIORITY_NOTICE, coalesce=True),
+                   scheduler.post('xoxb-1', channel, 'status', PRIORITY_NOTICE),
+                   scheduler.post('xoxb-1', channel, 'thanks 3', PRIORITY_REPLY, coalesce=True),
+                   # Too long to be merged with the ones before it
+                   scheduler.post('xoxb-1', channel, 'thanks 4 ' + 'x' * 20, PRIORITY_NOTICE, coalesce=True)]
+        responses = await asyncio.gather(*futures)
+        await scheduler.drain(1)
+        return responses
+
+    responses = run(post())
+    assert _posted(slack, channel) == ['thanks 3', 'thanks 1\nthanks 2', 'status', 'thanks 4 ' + 'x' * 20]
+    # The merged messages' senders share its response
+    assert responses[0] is responses[1]
+    assert scheduler.coalesced == 1
+
+
+def test_coalescing_can_be_disabled(run, slack, channel):
+    scheduler = _scheduler(coalesce=False)
+
+    async def post():
+        await asyncio.gather(scheduler.post('xoxb-1', channel, 'thanks 1', PRIORITY_NOTICE, coalesce=True),
+                             scheduler.post('xoxb-1', channel, 'thanks 2', PRIORITY_NOTICE, coalesce=True))
+        await scheduler.drain(1)
+
+    run(post())
+    assert _posted(slack, channel) == ['thanks 1', 'thanks 2']
+
+
+def test_drain_stops_the_lanes(run, channel):
+    scheduler = _scheduler(channel_rate=0.001)
+
+    async def post():
+        sent = scheduler.post('xoxb-1', channel, 'sent')
+        # Waits for the channel's allowance, longer than the drain allows
+        waiting = scheduler.post('xoxb-1', channel, 'waiting')
+        await scheduler.drain(0.2)
+        return sent.result(), waiting.result()
+
+    sent, waiting = run(post())
+    assert sent['ok'] and waiting == {'ok': False, 'error': 'scheduler_stopped'}
+    assert not scheduler._tasks
+
+
+def test_progress_message_is_not_posted_again_after_failing(run, channel, monkeypatch):
+    posted = []
+
+    async def post_message(token, channel, text, priority=PRIORITY_REPLY, coalesce=False):
+        posted.append(text)
+        return {'ok': False, 'error': 'channel_not_found'}
+
+    monkeypatch.setattr(slack_outbound, 'post_message', post_message)
+    progress = ProgressMessage('xoxb-1', channel, interval=0)
+    run(progress.update('1 of 3'))
+    run(progress.update('2 of 3'))
+    run(progress.update('done', final=True))
+    assert posted == ['1 of 3', 'done']
+
+
+def test_progress_message_is_posted_anew_when_its_update_fails(run, slack, channel, monkeypatch):
+    async def update_slack_message(token, channel, ts, text):
+        return {'ok': False, 'error': 'message_not_found'}
+
+    monkeypatch.setattr(slack_outbound, 'update_slack_message', update_slack_message)
+    progress = ProgressMessage('xoxb-1', channel, interval=0)
+    run(progress.update('1 of 3'))
+    run(progress.update('2 of 3'))
+    run(progress.update('done', final=True))
+    assert _posted(slack, channel) == ['1 of 3', 'done']
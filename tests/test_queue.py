@@ -0,0 +1,105 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+import pytest
+
+from cape_slack_plugin.slack_queue import EventQueue, EventQueueFull
+
+
+def test_jobs_of_a_key_run_in_order_while_other_keys_go_ahead(run):
+    queue = EventQueue(workers=4, maxsize=100, put_timeout=0.1, drain_timeout=5)
+    done = []
+
+    async def job(key, number, delay):
+        await asyncio.sleep(delay)
+        done.append((key, number))
+
+    async def put():
+        queue.start()
+        # The first job of channel A is the slowest, the ones after it still wait for it
+        await queue.put('A', job, 'A', 0, 0.1)
+        for number in range(1, 5):
+            await queue.put('A', job, 'A', number, 0)
+        await queue.put('B', job, 'B', 0, 0)
+        await queue.drain()
+
+    run(put())
+    assert [number for key, number in done if key == 'A'] == [0, 1, 2, 3, 4]
+    assert done[0] == ('B', 0)
+
+
+def test_events_are_shed_once_the_queue_stays_full(run):
+    queue = EventQueue(workers=1, maxsize=1, put_timeout=0.05, drain_timeout=5)
+    release = asyncio.Event()
+
+    async def blocked():
+        await release.wait()
+
+    async def put():
+        queue.start()
+        # Taken by the only worker, then one waiting in the queue
+        await queue.put('A', blocked)
+        await asyncio.sleep(0)
+        await queue.put('B', blocked)
+        with pytest.raises(EventQueueFull):
+            await queue.put('C', blocked)
+        release.set()
+        await queue.drain()
+
+    run(put())
+    assert queue.shed == 1
+
+
+def test_drain_finishes_queued_jobs_then_refuses_new_ones(run):
+    queue = EventQueue(workers=2, maxsize=100, put_timeout=0.1, drain_timeout=5)
+    done = []
+
+    async def job(number):
+        await asyncio.sleep(0.01)
+        done.append(number)
+
+    async def put():
+        queue.start()
+        for number in range(10):
+            await queue.put(number % 3, job, number)
+        await queue.drain()
+        assert not queue.running
+        with pytest.raises(EventQueueFull):
+            await queue.put(0, job, 10)
+
+    run(put())
+    assert sorted(done) == list(range(10))
+
+
+def test_drain_gives_up_after_its_timeout(run):
+    queue = EventQueue(workers=1, maxsize=100, put_timeout=0.1, drain_timeout=0.05)
+    cancelled = []
+
+    async def stuck():
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def put():
+        queue.start()
+        await queue.put('A', stuck)
+        await queue.put('A', stuck)
+        await queue.drain()
+
+    run(put())
+    assert cancelled == [True]
@@ -0,0 +1,81 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+import pytest
+
+from cape_slack_plugin import slack_records
+from cape_slack_plugin.slack_cache import LRUCache
+from cape_slack_plugin.slack_records import get_bot, get_user, invalidate_bot, invalidate_user
+from cape_slack_plugin.slack_state import MemoryStateStore
+
+
+class _CountingStore(MemoryStateStore):
+    """Stands in for the state store shared with other workers."""
+
+    def __init__(self):
+        super().__init__(1000)
+        self.reads = 0
+
+    async def aget(self, key, default=None):
+        self.reads += 1
+        return await super().aget(key, default)
+
+
+@pytest.fixture
+def shared(monkeypatch) -> _CountingStore:
+    store = _CountingStore()
+    monkeypatch.setattr(slack_records, '_generations', store)
+    monkeypatch.setattr(slack_records, '_local_generations', LRUCache(1000, ttl=0.05))
+    monkeypatch.setattr(slack_records, '_bots', LRUCache(1000, ttl=60, group=lambda key: key[0]))
+    return store
+
+
+def test_cached_record_is_only_looked_up_once(run, cape):
+    lookups = cape.calls.get('db', 0)
+    first = run(get_bot('UBOT7'))
+    assert run(get_bot('UBOT7')) is first
+    assert cape.calls['db'] - lookups == 1
+
+
+def test_generation_is_read_once_per_ttl(run, shared):
+    bot = run(get_bot('UBOT8'))
+    run(get_bot('UBOT8'))
+    assert shared.reads == 1
+    # Invalidated through another worker
+    shared.set(('generation', 'Bot', 'UBOT8'), 'other')
+    assert run(get_bot('UBOT8')) is bot
+    run(asyncio.sleep(0.06))
+    assert run(get_bot('UBOT8')) is not bot
+    assert shared.reads == 2
+
+
+def test_invalidated_bot_is_looked_up_again(run, shared, cape):
+    bot = run(get_bot('UBOT9'))
+    run(invalidate_bot('UBOT9'))
+    assert run(get_bot('UBOT9')) is not bot
+    # The new generation is used by this worker without reading it back
+    assert shared.reads == 1
+
+
+def test_invalidated_user_is_looked_up_again(run, cape, monkeypatch):
+    missing = cape.get_record
+    monkeypatch.setattr(cape, 'get_record', lambda kind, field, value: missing(kind, field, 'USERX'))
+    assert run(get_user('USER42')) is None
+    monkeypatch.setattr(cape, 'get_record', missing)
+    # Cached as missing until the OAuth callback creates it
+    assert run(get_user('USER42')) is None
+    run(invalidate_user('USER42'))
+    assert run(get_user('USER42')).token == 'token-42'
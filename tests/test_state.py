@@ -0,0 +1,60 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+import pytest
+
+from cape_slack_plugin.slack_state import create_state_store, StateStore
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path) -> StateStore:
+    if request.param == 'memory':
+        return create_state_store('memory://')
+    return create_state_store(f'sqlite:///{tmp_path}/state.db')
+
+
+def test_values_round_trip(run, store):
+    store.set(('session', 'UBOT1', 'C1'), {'question': 'Why?'})
+    assert store.get(('session', 'UBOT1', 'C1')) == {'question': 'Why?'}
+    assert run(store.aget_many([('session', 'UBOT1', 'C1'), ('session', 'UBOT1', 'C2')], 'missing')) == \
+        [{'question': 'Why?'}, 'missing']
+    run(store.adelete(('session', 'UBOT1', 'C1')))
+    assert store.get(('session', 'UBOT1', 'C1')) is None
+
+
+def test_values_expire_after_their_ttl(run, store):
+    run(store.aset(('event', 'E1'), True, 0.05))
+    store.set(('event', 'E2'), True)
+    assert store.get(('event', 'E1')) is True
+    time.sleep(0.06)
+    assert store.get(('event', 'E1')) is None
+    assert store.get(('event', 'E2')) is True
+
+
+def test_add_only_sets_missing_or_expired_keys(run, store):
+    assert run(store.aadd(('event', 'E1'), 'first', 0.05))
+    assert not run(store.aadd(('event', 'E1'), 'retry', 0.05))
+    assert store.get(('event', 'E1')) == 'first'
+    time.sleep(0.06)
+    assert run(store.aadd(('event', 'E1'), 'after expiry'))
+
+
+def test_delete_group_only_deletes_its_keys(run, store):
+    store.set_many({('session', 'UBOT1', 'C1'): 1, ('session', 'UBOT1', 'C2'): 2, ('session', 'UBOT10', 'C1'): 3,
+                    ('learn', 'UBOT1', 'C1'): 4})
+    run(store.adelete_group(('session', 'UBOT1')))
+    assert store.get_many([('session', 'UBOT1', 'C1'), ('session', 'UBOT1', 'C2'), ('session', 'UBOT10', 'C1'),
+                           ('learn', 'UBOT1', 'C1')]) == [None, None, 3, 4]
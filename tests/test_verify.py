@@ -0,0 +1,97 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from uuid import uuid4
+
+import pytest
+from fake_cape import FakeRequest
+
+from cape_slack_plugin import slack_events, slack_verify
+from cape_slack_plugin.slack_verify import sign_request, verify_request
+
+_SECRET = 'signing-secret'
+_NOW = 1600000000
+_BODY = json.dumps({'token': 'verification-token', 'type': 'event_callback', 'event': {'type': 'message'}}).encode()
+
+
+@pytest.fixture
+def signed(monkeypatch):
+    monkeypatch.setattr(slack_verify, 'slack_signing_secret', _SECRET)
+    monkeypatch.setattr(slack_verify, 'slack_verification', 'REPLACEME')
+
+
+@pytest.fixture
+def token(monkeypatch):
+    monkeypatch.setattr(slack_verify, 'slack_signing_secret', 'REPLACEME')
+    monkeypatch.setattr(slack_verify, 'slack_verification', 'verification-token')
+
+
+def _headers(timestamp=str(_NOW), body: bytes = _BODY, secret: str = _SECRET) -> dict:
+    return {'X-Slack-Request-Timestamp': timestamp, 'X-Slack-Signature': sign_request(secret, timestamp, body)}
+
+
+def test_valid_signature(signed):
+    assert verify_request(_headers(), _BODY, now=_NOW + 10) is None
+
+
+def test_missing_headers(signed):
+    assert verify_request({}, _BODY, now=_NOW) == 'unsigned'
+    assert verify_request({'X-Slack-Request-Timestamp': str(_NOW)}, _BODY, now=_NOW) == 'unsigned'
+
+
+def test_non_integer_timestamp(signed):
+    assert verify_request(_headers('soon'), _BODY, now=_NOW) == 'bad_timestamp'
+
+
+def test_stale_timestamp(signed):
+    assert verify_request(_headers(), _BODY, now=_NOW + 3600) == 'stale'
+
+
+def test_bad_signature(signed):
+    assert verify_request(_headers(secret='another-secret'), _BODY, now=_NOW) == 'bad_signature'
+    assert verify_request(_headers(), _BODY + b' ', now=_NOW) == 'bad_signature'
+
+
+def test_legacy_token(token):
+    assert verify_request({}, _BODY) is None
+    assert verify_request({}, json.dumps({'type': 'event_callback'}).encode()) == 'no_token'
+    assert verify_request({}, _BODY.replace(b'verification-token', b'forged')) == 'bad_token'
+
+
+def test_legacy_token_must_be_top_level(token):
+    # A token chosen by whoever wrote the event, e.g. a message's text or its attachments, isn't Slack's
+    nested = json.dumps({'event': {'type': 'message', 'token': 'verification-token'}, 'token': 'forged'}).encode()
+    assert verify_request({}, nested) == 'bad_token'
+    nested = json.dumps({'event': {'text': '"token": "verification-token"'}}).encode()
+    assert verify_request({}, nested) == 'no_token'
+    escaped = json.dumps({'event': {'text': 'a \\"quote\\" {'}, 'token': 'verification-token'}).encode()
+    assert verify_request({}, escaped) is None
+
+
+def test_endpoint_rejects_before_looking_the_bot_up(run, signed, monkeypatch):
+    calls = []
+
+    async def get_bot(bot_id):
+        calls.append('get_bot')
+
+    async def call_responder(*args, **kwargs):
+        calls.append('responder')
+
+    monkeypatch.setattr(slack_events, 'get_bot', get_bot)
+    monkeypatch.setattr(slack_events, '_call_responder', call_responder)
+    request = FakeRequest({'event_id': uuid4().hex, 'authed_users': ['UBOT1'],
+                           'event': {'type': 'message', 'channel': 'D1', 'user': 'U1', 'text': 'Hello?', 'ts': '1.0'}})
+    assert run(slack_events.receive_event(request)).status == 401
+    assert calls == []